@@ -25,6 +25,7 @@ Common repository for back-end / Reflex Engine
 
 import os
 import time
+import concurrent.futures
 import stat # chmod
 import subprocess
 import re
@@ -358,6 +359,61 @@ class EngineCli(rfx.Base):
         parsed = {'--content': json4human(obj), 'name': obj_dest}
         return self.edit_cli(obj_type, parsed, [], pause=False)
 
+    ###########################################################################
+    def export_cli(self, dirname, archive=False, parallel=4):
+        """export all tables into a directory, in parallel.  see --help"""
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            tables = self.rcs.export_tables(archive=archive)
+        except (OSError, rfx.client.ClientError) as err:
+            self.ABORT("Cannot export: " + str(err))
+
+        def export(table):
+            """one table, written aside then moved in place"""
+            path = os.path.join(dirname, table + ".ndjson.gz")
+            with open(path + ".tmp", "wb") as outfile:
+                size = self.rcs.export_table(table, outfile)
+            os.rename(path + ".tmp", path)
+            return size
+
+        self._parallel_cli("Exported", export, tables, parallel)
+
+    ###########################################################################
+    def import_cli(self, dirname, archive=False, parallel=4): # pylint: disable=unused-argument
+        """import all tables from an export directory, in parallel.  see --help"""
+        try:
+            tables = [fname[:-10] for fname in sorted(os.listdir(dirname))
+                      if fname[-10:] == ".ndjson.gz"]
+        except OSError as err:
+            self.ABORT("Cannot import: " + str(err))
+        if not tables:
+            self.ABORT("No exported tables found in " + dirname)
+
+        def load(table):
+            """one table"""
+            with open(os.path.join(dirname, table + ".ndjson.gz"), "rb") as infile:
+                return self.rcs.import_table(table, infile).get('rows', 0)
+
+        self._parallel_cli("Imported", load, tables, parallel)
+        self.rcs.import_finish()
+        self.NOTIFY("Policy maps rebuilt")
+
+    ###########################################################################
+    def _parallel_cli(self, label, func, tables, parallel):
+        """run func(table) across a pool of threads, reporting as they finish"""
+        failed = list()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+            futures = dict([(pool.submit(func, table), table) for table in tables])
+            for future in concurrent.futures.as_completed(futures):
+                table = futures[future]
+                try:
+                    self.NOTIFY("{} {} ({})".format(label, table, future.result()))
+                except (OSError, rfx.client.ClientError) as err:
+                    self.NOTIFY("Failed {}: {}".format(table, err))
+                    failed.append(table)
+        if failed:
+            self.ABORT("Unable to complete: " + ", ".join(sorted(failed)))
+
     ###########################################################################
     def get_cli(self, obj_type, parsed, argv):
         """get an object.  see --help"""
@@ -29,6 +29,7 @@ Future: add SSL client certificates
 """
 
 import urllib
+import copy
 import time
 import base64
 import requests
@@ -60,6 +61,8 @@ class Session(rfx.Base):
     apikey_name = None
     apikey_secret = None
     _cache = None
+    _etags = None
+    _watches = None
     headers = None
 
     def __init__(self, **kwargs):
@@ -68,6 +71,8 @@ class Session(rfx.Base):
         if base:
             rfx.Base.__inherit__(self, base)
         self._cache = dict()
+        self._etags = dict()
+        self._watches = dict()
         self.headers = dict()
 
     ############################################################################
@@ -111,9 +116,37 @@ class Session(rfx.Base):
             raise Unauthorized("Unable to authorize session")
 
     ############################################################################
-    # pylint: disable=too-many-branches
     def _call(self, func, target, *args, **kwargs):
         """Call Reflex Engine, wrapped with authentication and session management"""
+        return self._call_result(self._call_raw(func, target, *args, **kwargs))
+
+    ############################################################################
+    def _call_result(self, result):
+        """Check the response status and content type, and decode the result"""
+        if result.status_code == 500:
+            raise ClientError("Server side error")
+
+        if result.status_code == 404:
+            raise ClientError("Endpoint or object not found (" + result.url + ")")
+
+        if "application/json" not in result.headers.get('Content-Type', ''):
+            self.DEBUG("error", result.content.decode())
+            raise ClientError("Result is not valid content type")
+
+        if result.status_code == 204:
+            return {}
+
+        if result.status_code in (200, 201, 202):
+            return result.json()
+
+        raise ClientError(result.json()['message'])
+
+    ############################################################################
+    def _call_raw(self, func, target, *args, **kwargs):
+        """
+        Call Reflex Engine, wrapped with authentication and session management,
+        returning the requests response as-is (such as for streamed content)
+        """
         try:
             self._login()
         except Unauthorized as err:
@@ -139,33 +172,25 @@ class Session(rfx.Base):
                 query += "?"
             query += "abac=log"
 
+        # a file object body is read by the call, note where to resend it from
+        body = kwargs.get('data')
+        start = None
+        if hasattr(body, 'seekable') and body.seekable():
+            start = body.tell()
+
         # make the call
         result = self._call_sub(func, query, *args, **kwargs)
 
         # unlikely, as self._login() should take care of this, unless our timing
         # is off from the server's, but just in case...
-        if result.status_code == 401:
+        if result.status_code == 401 and (start is not None or not hasattr(body, 'read')):
             self.DEBUG("Unauthorized received, Retrying Login")
             self._login(force=True)
+            if start is not None:
+                body.seek(start)
             result = self._call_sub(func, query, *args, **kwargs)
 
-        if result.status_code == 500:
-            raise ClientError("Server side error")
-
-        if result.status_code == 404:
-            raise ClientError("Endpoint or object not found (" + query + ")")
-
-        if "application/json" not in result.headers.get('Content-Type', ''):
-            self.DEBUG("error", result.content.decode())
-            raise ClientError("Result is not valid content type")
-
-        if result.status_code == 204:
-            return {}
-
-        if result.status_code in (200, 201, 202):
-            return result.json()
-
-        raise ClientError(result.json()['message'])
+        return result
 
     ############################################################################
     def _call_sub(self, func, *args, **kwargs):
@@ -189,12 +214,49 @@ class Session(rfx.Base):
 
     ############################################################################
     def get(self, obj_type, obj_target, archive=False):
-        """session GET"""
+        """
+        session GET.  Current objects are revalidated by their ETag, so a
+        repeat read of an unchanged object is answered without a body.
+        """
         args = []
         if archive:
             args.append("archive=" + str(archive['start']))
-        return self._call(requests.get,
-                          obj_type + "/" + str(obj_target) + "?" + "&".join(args))
+            return self._call(requests.get,
+                              obj_type + "/" + str(obj_target) + "?" + "&".join(args))
+
+        target = obj_type + "/" + str(obj_target)
+        cached = self._etags.get(target)
+        headers = {}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        result = self._call_raw(requests.get, target, headers=headers)
+        if result.status_code == 304 and cached:
+            return copy.deepcopy(cached[1])
+
+        data = self._call_result(result)
+        etag = result.headers.get('ETag')
+        if etag and result.status_code == 200:
+            self._etags[target] = (etag, copy.deepcopy(data))
+        else:
+            self._etags.pop(target, None)
+        return data
+
+    ############################################################################
+    def get_flattened(self, obj_target):
+        """
+        Config flattened by the engine (extends and imports merged, macros
+        not processed), with the configs it read.  See ConfigProcessor.
+        """
+        return self._call(requests.get, "config/" + str(obj_target) + "/_flattened")
+
+    ############################################################################
+    def relatives(self, obj_target, direction="descendants"):
+        """
+        Configs related to a config through extends, imports and exports:
+        direction=ancestors (what it draws from) or descendants (what draws
+        from it).  A list of dict(id, name, kind, depth), nearest first.
+        """
+        return self._call(requests.get, "config/" + str(obj_target) + "/_" + direction)
 
     ############################################################################
     # pylint: disable=too-many-arguments
@@ -232,6 +294,40 @@ class Session(rfx.Base):
         """session CREATE"""
         return self._call(requests.post, obj_type, data=json4store(obj_data))
 
+    ############################################################################
+    def members(self, obj_target):
+        """instance lists of a service"""
+        return self._call(requests.get, "service/" + str(obj_target) + "/_members")
+
+    ############################################################################
+    def update_members(self, obj_target, key, add=None, remove=None):
+        """
+        add and remove instances from one of a service's instance lists
+        (dynamic-instances, active-instances or static-instances)
+        """
+        return self._call(requests.post,
+                          "service/" + str(obj_target) + "/_members/" + key,
+                          data=json4store(dict(add=add or [], remove=remove or [])))
+
+    ############################################################################
+    def bulk(self, obj_type, objs, batch=None, merge=False):
+        """
+        session BULK create or update, sent as NDJSON.  Returns a summary
+        with a result for each object, in order.  With merge, updates are
+        merged into the stored objects.
+        """
+        query = list()
+        if batch:
+            query.append("batch=" + str(batch))
+        if merge:
+            query.append("merge=true")
+        path = obj_type + "/_bulk"
+        if query:
+            path += "?" + "&".join(query)
+        data = "".join([json4store(obj) + "\n" for obj in objs])
+        return self._call(requests.post, path, data=data,
+                          headers={'Content-Type': 'application/x-ndjson'})
+
     ############################################################################
     def update(self, obj_type, obj_target, obj_data):
         """session UPDATE"""
@@ -244,6 +340,12 @@ class Session(rfx.Base):
         path = obj_type + "/" + str(obj_target) + "?merge=true"
         return self._call(requests.put, path, data=json4store(obj_data))
 
+    ############################################################################
+    def instance_status(self, obj_target, status):
+        """set just the status of an instance"""
+        path = "instance/" + str(obj_target) + "/_status"
+        return self._call(requests.put, path, data=json4store({"status": status}))
+
     ############################################################################
     def instance_ping(self, obj_target, obj_data):
         """special instance update ping"""
@@ -255,6 +357,126 @@ class Session(rfx.Base):
         """session DELETE"""
         return self._call(requests.delete, obj_type + "/" + str(obj_target))
 
+    ############################################################################
+    def export_tables(self, archive=False):
+        """list the tables available to export"""
+        path = "_export"
+        if archive:
+            path += "?archive=true"
+        return self._call(requests.get, path)['tables']
+
+    ############################################################################
+    def export_table(self, table, outfile):
+        """stream one table's gzipped NDJSON export into the file object outfile"""
+        result = self._call_raw(requests.get, "_export/" + table, stream=True)
+        if result.status_code != 200:
+            raise ClientError("Unable to export {}: HTTP {}".format(table, result.status_code))
+        size = 0
+        for chunk in result.raw.stream(65536, decode_content=False):
+            outfile.write(chunk)
+            size += len(chunk)
+        return size
+
+    ############################################################################
+    def import_table(self, table, infile):
+        """
+        send gzipped NDJSON (as from export_table) from the file object infile,
+        which must be seekable to be sent again after a login retry
+        """
+        return self._call(requests.post, "_import/" + table, data=infile,
+                          headers={'Content-Type': 'application/gzip'})
+
+    ############################################################################
+    def import_finish(self):
+        """after importing tables, have the engine rebuild its policy maps"""
+        return self._call(requests.post, "_import")
+
+    ############################################################################
+    def changes(self, since=None, limit=None, types=None):
+        """
+        The change feed: with since=None just the current token, else the
+        changes after since.  types is an optional list of object types.
+        """
+        args = []
+        if since is not None:
+            args.append("since=" + str(since))
+        if limit:
+            args.append("limit=" + str(limit))
+        if types:
+            args.append("types=" + ",".join(types))
+        querystr = "_changes"
+        if args:
+            querystr += "?" + "&".join(args)
+        return self._call(requests.get, querystr)
+
+    ############################################################################
+    def abac_profile(self, limit=None, reset=False):
+        """policy and policyscope evaluation counters, or reset them"""
+        if reset:
+            return self._call(requests.delete, "_abac")
+        querystr = "_abac"
+        if limit:
+            querystr += "?limit=" + str(limit)
+        return self._call(requests.get, querystr)
+
+    ############################################################################
+    def rotate_keys(self, start=False, stop=False, **opts):
+        """
+        Progress of re-encrypting stored values with the default key; start
+        (or resume) it, with optional batch, pause and workers, or stop it.
+        """
+        if start:
+            return self._call(requests.post, "_rotate", data=json4store(opts))
+        if stop:
+            return self._call(requests.delete, "_rotate")
+        return self._call(requests.get, "_rotate")
+
+    ############################################################################
+    def watch(self, obj_type, obj_target, since=None, timeout=60):
+        """
+        Wait up to timeout seconds for an object to change (for configs, also
+        anything in its extends/imports chain).  Returns a dict with changed
+        (True/False) and a token, to give as since on the next call.
+        """
+        key = obj_type + "/" + str(obj_target)
+        for _ in range(2):
+            watch = self._watches.get(key)
+            if not watch:
+                watch = self._call(requests.get, key + "/_watch")
+                self._watches[key] = watch
+            if since is None:
+                since = watch['token']
+            result = requests.get(watch['url'],
+                                  params={'since': since, 'timeout': timeout},
+                                  timeout=timeout + 30)
+            if result.status_code == 200:
+                return result.json()
+            del self._watches[key] # expired or a different engine; register again
+        raise ClientError("Unable to watch " + key)
+
+    ############################################################################
+    @threadlock
+    def cache_changes(self, since, types=None):
+        """
+        Apply the changes after token since to the cache, returning the new
+        token, or None if the cache must be reloaded instead (it is reset).
+        """
+        while True:
+            result = self.changes(since=since, types=types)
+            if result.get('reset'):
+                self._cache = dict()
+                return None
+            for change in result.get('changes', []):
+                objs = self._cache.setdefault(change['type'], dict())
+                if change['action'] == 'put':
+                    objs[change['name']] = change['object']
+                else:
+                    objs.pop(change['name'], None)
+                self._etags.pop(change['type'] + "/" + change['name'], None)
+            since = result['token']
+            if not result.get('more'):
+                return since
+
     ############################################################################
     @threadlock
     def cache_get(self, obj_type, obj_target, **kwargs):
@@ -309,6 +531,7 @@ class Session(rfx.Base):
     def cache_reset(self):
         """Clear the cache"""
         self._cache = dict()
+        self._etags = dict()
 
     ###########################################################################
     def cache_drop(self, obj_type, obj_target):
@@ -209,9 +209,40 @@ class ConfigProcessor(VerboseBase):
     ############################################################################
     def flatten(self, name, exported=False):
         conf = Config(name, base=self, rcs=self.rcs, verbose=self.verbose).conf
-        conf = self._flatten(conf, name, exported=exported, toplevel=True)
+        flat = None
+        if not exported:
+            flat = self._flatten_remote(conf, name)
+        if flat:
+            conf = flat
+        else:
+            conf = self._flatten(conf, name, exported=exported, toplevel=True)
         return self._process(conf)
 
+    ############################################################################
+    def _flatten_remote(self, conf, name):
+        """
+        Have Reflex Engine do the merge, in one call.  The configs it read are
+        kept, so exports are processed from them as well.  Returns None if
+        the engine cannot, and we should flatten locally.
+        """
+        if not hasattr(self.rcs, 'get_flattened'):
+            return None
+        flat = self.rcs.get_flattened(name)
+        if not isinstance(flat, dict) or not isinstance(flat.get('config'), dict) \
+           or not isinstance(flat.get('objects'), dict):
+            return None # older engine
+
+        self.rcs = PrefetchedConfigs(self.rcs, flat['objects'])
+        for key in ('imp', 'ext'):
+            for did in flat.get('did', {}).get(key, []):
+                self.did[key][did] = True
+
+        # local parts (peers) of the skeleton take precedence, as in _flatten()
+        setenv = copy.deepcopy(conf.setenv)
+        conf = dictlib.union(conf, flat['config'])
+        conf.setenv = dictlib.union(conf.setenv, setenv)
+        return conf
+
     ############################################################################
     def _process(self, conf):
         subname = (conf.name + ".").split(".")[0]
@@ -508,6 +539,23 @@ class ConfigProcessor(VerboseBase):
 
         return conf
 
+################################################################################
+# pylint: disable=too-few-public-methods
+class PrefetchedConfigs(object):
+    """
+    Stand-in for a Reflex Engine session, serving configs which were already
+    read (as from a server side flatten), and passing anything else on.
+    """
+
+    def __init__(self, rcs, objects):
+        self.rcs = rcs
+        self.objects = objects
+
+    def get(self, obj_type, name, **kwargs):
+        if obj_type == 'config' and name in self.objects:
+            return copy.deepcopy(self.objects[name])
+        return self.rcs.get(obj_type, name, **kwargs)
+
 ################################################################################
 class Config(VerboseBase):
     """
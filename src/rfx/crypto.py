@@ -60,12 +60,14 @@ class Cipher(object):
     """
 
     key = None
+    box = None
 
     ############################################################################
     def __init__(self, key):
         """Create a secret key"""
         if isinstance(key, Key):
             self.key = key
+            self.box = nacl.secret.SecretBox(key.value)
         else:
             raise ValueError("argument is not a Key object")
 
@@ -76,7 +78,7 @@ class Cipher(object):
         Note: insert 'struct' to pull the first byte of data out as a "version"
         """
         nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
-        encrypted = nacl.secret.SecretBox(self.key.value).encrypt(data.encode(), nonce)
+        encrypted = self.box.encrypt(data.encode(), nonce)
         if raw:
             return encrypted
         return base64.b64encode(encrypted).decode()
@@ -86,6 +88,6 @@ class Cipher(object):
         """Decrypt data"""
         if not raw:
             data = base64.b64decode(data)
-        return nacl.secret.SecretBox(self.key.value).decrypt(data).decode()
+        return self.box.decrypt(data).decode()
 
     # future: add pki_encrypt/decrypt
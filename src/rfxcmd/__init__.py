@@ -777,12 +777,21 @@ Regions and Lanes are configured in the config:reflex object.
         # top_config = env_name
         trap = self.engine.TRAP
         trap(self.engine.cache_update_object, 'pipeline', pipeline, pipe_o)
-        trap(self.engine.cache_update_object, 'config', pipeline, cfg_o)
-        trap(self.engine.cache_update_object, 'config', env_name, cfg_env_o)
-        trap(self.engine.cache_update_object, 'service', svc_name, svc_o)
 
+        # configs go in one bulk call, ordered so extends resolve
+        configs = [(pipeline, cfg_o), (env_name, cfg_env_o)]
         if multitenant:
-            trap(self.engine.cache_update_object, 'config', top_config, cfg_tenant_o)
+            configs.append((top_config, cfg_tenant_o))
+        for name, cfg in configs:
+            cfg['name'] = name
+            self.engine.cache.get('config', {}).pop(name, None)
+        result = trap(self.engine.session.bulk, 'config', [cfg for name, cfg in configs]) or {}
+        for res in result.get('results', []):
+            if res['status'] == 'failed':
+                self.engine.ABORT("Unable to store config {}: {}"
+                                  .format(res.get('name'), res.get('message')))
+
+        trap(self.engine.cache_update_object, 'service', svc_name, svc_o)
 
         return {
             'pipeline': pipeline,
@@ -906,6 +915,15 @@ Arguments and options vary by action:
    create a cross sectional set-union of {key} values on all objects matching
    {name-filter} and {limit-expression}
 
+=> """ + self.cmd + """ export {directory} [--archive] [--parallel=N]
+   write every table as a gzipped NDJSON file in {directory}, N tables at a
+   time (default 4).  --archive includes archive tables.  Sensitive values
+   stay encrypted.  Requires admin.
+
+=> """ + self.cmd + """ import {directory} [--parallel=N]
+   load the files from an export, then have the engine rebuild its policy maps.
+   Rows replace existing rows with the same id.  Requires admin.
+
 Additionally:
 
    --p?assword|--pwd|-p may be provided, to prompt for a password
@@ -918,6 +936,9 @@ Additionally:
     ############################################################################
     # pylint: disable=missing-docstring
     def start(self, argv=None, opts=None):
+        if (argv if argv is not None else sys.argv[1:])[:1] in (["export"], ["import"]):
+            return self.start_dump(argv=argv, opts=opts)
+
         parsed = self.args.handle_parse(caller=self, argv=argv, opts=opts)
         if not parsed or parsed.get('--help') and not self.args.argv:
             self.fail()
@@ -955,6 +976,47 @@ Additionally:
                                          opts=parsed)
             getattr(cli, action + "_cli")(objtype, parsed2, args2.argv)
 
+    ############################################################################
+    # pylint: disable=missing-docstring
+    def start_dump(self, argv=None, opts=None):
+        args = Args(
+            [
+                "operation", {
+                    "type": "from-set",
+                    "set": ["export", "import"]
+                }
+            ], [
+                "directory", {
+                    "type": "set-value"
+                }
+            ], [
+                "--archive|-a", {
+                    "type": "set-true",
+                }
+            ], [
+                "--parallel", {
+                    "type": "set-value",
+                }
+            ], [
+                "--d?ebug|-d", {
+                    "type": "set-add"
+                }
+            ]
+        )
+        parsed = args.handle_parse(caller=self, argv=argv, opts=opts)
+        if not parsed:
+            self.fail()
+
+        try:
+            parallel = int(parsed.get('--parallel') or 4)
+        except ValueError:
+            self.fail("--parallel must be a number")
+
+        cli = EngineCli(base=new_base(parsed))
+        getattr(cli, parsed['operation'] + "_cli")(parsed['directory'],
+                                                   archive=parsed.get('--archive'),
+                                                   parallel=parallel)
+
 # short name
 class CliRxe(CliEngine):
     pass
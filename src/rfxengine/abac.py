@@ -23,15 +23,18 @@
 """
 Attribute Based Access Controls
 
-Uses python 'eval' to evaluate expressions.  Generally this can be highly dangerous,
-however we only accept policies from administrators.  We should still be careful.
+Expressions are python, checked and compiled once (see Expression).  Generally
+this can be highly dangerous, however we only accept policies from
+administrators.  We should still be careful.
 
 Policies should only call locals defined by us.  Lambda's are disallowed.
 
 Be very careful.
 """
 
+import ast
 import re
+import time
 import traceback
 import cherrypy
 import dictlib
@@ -39,9 +42,243 @@ import dictlib
 from rfxengine import log #, trace
 from rfxengine import exceptions
 
+################################################################################
+def debug_hook(*args):
+    """debug hook"""
+    log("ABAC DEBUG", *args, type="debug")
+
+# shared by every evaluation; treat as read-only.  Only plain callables,
+# never modules: anything reachable from here is reachable from a policy.
+ABAC_CONTEXT = {
+    '__builtins__':{},
+    'true': True,
+    'false': False,
+    'rx': re.search,
+    'debug': debug_hook
+}
+
+ATTRS_ARG = '_abac_attrs_'
+
+# attributes which lead to frames, code or string formatting (which can
+# itself reach attributes), besides anything private
+DENIED_ATTRS = frozenset(['format', 'format_map', 'mro',
+                          'gi_frame', 'gi_code', 'cr_frame', 'cr_code',
+                          'ag_frame', 'ag_code', 'tb_frame', 'tb_next',
+                          'f_back', 'f_builtins', 'f_code', 'f_globals', 'f_locals'])
+
 ################################################################################
 # classes
 
+class Stat(object):
+    """evaluation counters for one policy or scope"""
+    __slots__ = ('label', 'count', 'cpu', 'errors', 'last')
+
+    def __init__(self, label=''):
+        self.label = label
+        self.zero()
+
+    def zero(self):
+        """reset the counters"""
+        self.count = 0
+        self.cpu = 0.0
+        self.errors = 0
+        self.last = 0
+
+    def add(self, start, error=False):
+        """count an evaluation which began at thread_time() start"""
+        self.count += 1
+        self.cpu += time.thread_time() - start
+        if error:
+            self.errors += 1
+        self.last = time.time()
+
+class Profile(object):
+    """
+    Evaluation counters per policy and per scope, for finding costly
+    expressions.  Updated without a lock, so counts under concurrency are
+    close rather than exact.
+
+    >>> prof = Profile()
+    >>> stat = prof.stat('policy', 4, 'slow one')
+    >>> stat.add(time.thread_time(), error=True)
+    >>> [(row['id'], row['name'], row['count'], row['errors']) for row in prof.report('policy')]
+    [(4, 'slow one', 1, 1)]
+    >>> prof.reset()
+    >>> prof.report('policy')
+    []
+    """
+
+    def __init__(self):
+        self.stats = dict()
+
+    def stat(self, kind, obj_id, label=''):
+        """the counters for kind ('policy' or 'scope') and id"""
+        stat = self.stats.get((kind, obj_id))
+        if stat is None:
+            stat = self.stats.setdefault((kind, obj_id), Stat(label))
+        elif label:
+            stat.label = label
+        return stat
+
+    def report(self, kind, limit=0):
+        """counters of those evaluated, most cpu first"""
+        rows = [dict(id=key[1], name=stat.label, count=stat.count, cpu=round(stat.cpu, 6),
+                     errors=stat.errors, last=stat.last,
+                     avg=round(stat.cpu / stat.count, 9))
+                for key, stat in list(self.stats.items()) if key[0] == kind and stat.count]
+        rows.sort(key=lambda row: row['cpu'], reverse=True)
+        if limit:
+            rows = rows[:limit]
+        return rows
+
+    def reset(self):
+        """zero all counters"""
+        for stat in list(self.stats.values()):
+            stat.zero()
+
+PROFILE = Profile()
+
+################################################################################
+class Expression(object):
+    """
+    A policy or scope expression, checked and compiled once into a function
+    of the attributes.  Names in the shared context (true, rx, ...) are
+    reserved; others are looked up in the attributes only when the expression
+    reaches them, so a lazy attribute is not loaded if short circuited away.
+    A constant pattern given to rx is compiled once, with the expression.
+
+    >>> expr = Expression("token_name == 'sinatra' or groups['rat']", '<test>')
+    >>> expr({'token_name': 'sinatra'})
+    True
+    >>> expr.names
+    ('groups', 'token_name')
+    >>> expr({'token_name': 'frank', 'groups': {'rat': ['pack']}})
+    ['pack']
+    >>> Expression("[x for x in groups if rx('^r', x)]", '<test>')({'groups': ['rat']})
+    ['rat']
+    >>> Expression("(lambda: 1)()", '<test>')
+    Traceback (most recent call last):
+    ...
+    rfxengine.exceptions.InvalidPolicy: Policy is invalid: lambda is not allowed
+    >>> Expression("true.__class__", '<test>')
+    Traceback (most recent call last):
+    ...
+    rfxengine.exceptions.InvalidPolicy: Policy is invalid: __class__ is not allowed
+    >>> Expression("re.enum.sys.modules['os'].getpid() > 0", '<test>')({})
+    Traceback (most recent call last):
+    ...
+    KeyError: 're'
+    >>> Expression("'{0.__globals__}'.format(debug)", '<test>')
+    Traceback (most recent call last):
+    ...
+    rfxengine.exceptions.InvalidPolicy: Policy is invalid: format is not allowed
+    >>> Expression("rx('(', token_name)", '<test>')
+    Traceback (most recent call last):
+    ...
+    rfxengine.exceptions.InvalidPolicy: Policy is invalid: rx pattern: missing ), unterminated subpattern at position 0
+    """
+
+    def __init__(self, source, label):
+        self.source = source
+        tree = ast.parse(source, label, 'eval')
+        names = set()
+        helpers = dict()
+        body = _Rewrite(names, helpers).visit(tree.body)
+        func = ast.Expression(body=ast.Lambda(
+            args=ast.arguments(posonlyargs=[], args=[ast.arg(arg=ATTRS_ARG)],
+                               kwonlyargs=[], kw_defaults=[], defaults=[]),
+            body=body))
+        ast.fix_missing_locations(func)
+        # pylint: disable=eval-used
+        self.func = eval(compile(func, label, 'eval'),
+                         dict(ABAC_CONTEXT, **helpers) if helpers else ABAC_CONTEXT)
+        self.names = tuple(sorted(names))
+
+    def __call__(self, attrs):
+        return self.func(attrs)
+
+    def missing(self, err, attrs):
+        """is this KeyError an attribute the expression named, but not given?"""
+        return bool(err.args) and err.args[0] in self.names and err.args[0] not in attrs
+
+################################################################################
+class _Rewrite(ast.NodeTransformer):
+    """
+    Check an expression, and turn each free name which is not in the shared
+    context into a subscript of the attributes argument.  rx calls with a
+    constant pattern become calls of a compiled pattern, kept in helpers
+    under a name no free name can reach (those are all rewritten).
+    """
+
+    def __init__(self, names, helpers, bound=frozenset()):
+        self.names = names
+        self.helpers = helpers
+        self.bound = bound
+
+    # pylint: disable=invalid-name,no-self-use
+    def visit_Lambda(self, node):
+        """lambdas are not allowed"""
+        raise exceptions.InvalidPolicy("Policy is invalid: lambda is not allowed")
+
+    def visit_NamedExpr(self, node):
+        """neither is assignment"""
+        raise exceptions.InvalidPolicy("Policy is invalid: assignment is not allowed")
+
+    def visit_Attribute(self, node):
+        """nor reaching into private attributes, frames or formatting"""
+        if node.attr.startswith('_') or node.attr in DENIED_ATTRS:
+            raise exceptions.InvalidPolicy("Policy is invalid: " + node.attr + " is not allowed")
+        return self.generic_visit(node)
+
+    def visit_Call(self, node):
+        """rx('constant', value) to a compiled pattern's search(value)"""
+        if isinstance(node.func, ast.Name) and node.func.id == 'rx' and \
+           'rx' not in self.bound and len(node.args) == 2 and not node.keywords and \
+           isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+            try:
+                search = re.compile(node.args[0].value).search
+            except re.error as err:
+                raise exceptions.InvalidPolicy("Policy is invalid: rx pattern: " + str(err))
+            name = '_rx' + str(len(self.helpers))
+            self.helpers[name] = search
+            return ast.copy_location(ast.Call(func=ast.Name(id=name, ctx=ast.Load()),
+                                              args=[self.visit(node.args[1])],
+                                              keywords=[]), node)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        """free name to attrs['name']"""
+        if node.id in self.bound or node.id in ABAC_CONTEXT:
+            return node
+        self.names.add(node.id)
+        return ast.copy_location(ast.Subscript(value=ast.Name(id=ATTRS_ARG, ctx=ast.Load()),
+                                               slice=ast.Constant(value=node.id),
+                                               ctx=node.ctx), node)
+
+    def _visit_comprehension(self, node):
+        """targets are bound within the comprehension, but not its first iterable"""
+        bound = set(self.bound)
+        for gen in node.generators:
+            bound.update([elem.id for elem in ast.walk(gen.target)
+                          if isinstance(elem, ast.Name)])
+        inner = _Rewrite(self.names, self.helpers, frozenset(bound))
+        first = node.generators[0]
+        first.iter = self.visit(first.iter)
+        first.target = inner.visit(first.target)
+        first.ifs = [inner.visit(elem) for elem in first.ifs]
+        for gen in node.generators[1:]:
+            inner.visit(gen)
+        for field in ('elt', 'key', 'value'):
+            if hasattr(node, field):
+                setattr(node, field, inner.visit(getattr(node, field)))
+        return node
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+
+################################################################################
 # pylint: disable=too-few-public-methods,too-many-instance-attributes
 class Policy(object):
     """
@@ -61,73 +298,72 @@ class Policy(object):
     sort_key = ""
     target_id = 0
 
-    disallowed_rx = re.compile("lambda ", flags=re.IGNORECASE)
-
     # pylint: disable=too-many-arguments
-    def __init__(self, action, result, order, pid, pname, pexpr, pdata, ptimestamp, target_id):
-        # matches array, as pulled from db.objects.RCObject._get_policy
+    def __init__(self, action, result, order, pid, pname, pexpr, pdata, ptimestamp, target_id,
+                 expr=None):
+        # matches array, as pulled from db.objects.PolicySet; expr is
+        # an Expression already compiled from pexpr, to share it
         self.policy_action = action
         self.policy_fail = result == 'fail'
         self.policy_id = pid
         self.policy_order = order
         self.policy_name = pname
-        self.policy_expr = self.compile(pexpr)
-        self.policy_ast = compile(self.policy_expr, '<abac policy ' + str(pid) + '>', "eval")
+        self.policy_expr = pexpr
+        self.policy_ast = expr or self.compile(pexpr)
         self.policy_data = pdata
         self.policy_timestamp = ptimestamp
         self.sort_key = str(order) + ":" + str(ptimestamp)
         self.target_id = target_id
+        self.stats = PROFILE.stat('policy', pid, pname)
 
     ############################################################################
     def compile(self, expression):
         """
         Take an human readable expression and make it something python can run
         """
-        if self.disallowed_rx.search(expression):
-            raise exceptions.InvalidPolicy("Policy is invalid")
-
-        return expression
+        return Expression(expression, '<abac policy ' + str(self.policy_id) + '>')
 
     ############################################################################
     def allowed(self, attrs, debug=False, base=None):
         """
         process an ABAC policy expression.  Context is provided as a dict
-        to add to the namespace of the expression.
-
-        policy is always added to the context
-
-        >>> p=Policy()
-        >>> attrs=attrs_skeleton(token_nbr=1, token_name='sinatra')
-        >>> p.compile("__import__('os').system('echo oops')").allowed({})
-        Traceback (most recent call last):
-        ...
-        NameError: name '__import__' is not defined
-        >>> p.compile("token_name == 'frank'").allowed(attrs)
-        Traceback (most recent call last):
-        ...
-        exceptions.PolicyFailed: Policy failed to evaluate (token_name == 'frank')
-        >>> p.compile("re('^sin', token_name)").allowed(attrs)
+        of attributes the expression may name.
+
+        >>> attrs = _attrs_skeleton(token_nbr=1, token_name='sinatra')
+        >>> def allowed(expr, attrs):
+        ...     return Policy('read', 'pass', 1, 1, 'test', expr, {}, 0, 0).allowed(attrs)
+        >>> allowed("__import__('os').system('echo oops')", {})
+        False
+        >>> allowed("token_name == 'frank'", attrs)
+        False
+        >>> allowed("rx('^sin', token_name)", attrs)
         True
-        >>> p.compile("token_name == 'sinatra'").allowed(attrs)
+        >>> allowed("token_name == 'sinatra'", attrs)
         True
-        >>> p.compile("token_nbr == 0").allowed(attrs)
-        Traceback (most recent call last):
-        ...
-        exceptions.PolicyFailed: Policy failed to evaluate (token_nbr == 0)
-        >>> p.compile("token_nbr > 0").allowed(attrs)
+        >>> allowed("token_nbr == 0", attrs)
+        False
+        >>> allowed("token_nbr > 0", attrs)
         True
         """
 
         if not isinstance(attrs, dict):
             raise exceptions.InvalidContext("Context is not a dictionary")
 
+        start = time.thread_time()
         try:
-            # pylint: disable=eval-used
-            if eval(self.policy_ast, abac_context(), attrs):
+            if self.policy_ast.func(attrs):
+                self.stats.add(start)
                 return True
+            self.stats.add(start)
         except KeyError as err:
-            log("policy failure id={} missing key={}".format(self.policy_id, err), type="error")
+            self.stats.add(start, error=True)
+            if not self.policy_ast.missing(err, attrs):
+                log("policy failure id={} missing key={}".format(self.policy_id, err),
+                    type="error")
+            elif debug and base:
+                base.DEBUG("abac error=name {} is not defined".format(err), module="abac")
         except Exception as err: # pylint: disable=broad-except
+            self.stats.add(start, error=True)
             if debug and base:
                 base.DEBUG("abac error={}, traceback={}"
                            .format(err, traceback.format_exc()), module="abac")
@@ -135,19 +371,293 @@ class Policy(object):
 
 ################################################################################
 def abac_context():
-    """standard policy context"""
-    def debug_hook(*args):
-        """debug hook"""
-        log("ABAC DEBUG", *args, type="debug")
-
-    return {
-        '__builtins__':{},
-        'true': True,
-        'false': False,
-        're': re,
-        'rx': re.search,
-        'debug': debug_hook
-    }
+    """standard policy context, shared: copy it before changing"""
+    return ABAC_CONTEXT
+
+################################################################################
+class Untranslatable(Exception):
+    """expression cannot be turned into SQL"""
+    pass
+
+# pylint: disable=too-few-public-methods
+class _Column(object):
+    """a column of the row, or a prefix/suffix slice of it"""
+    def __init__(self, name, slice_from=None, slice_to=None):
+        self.name = name
+        self.slice_from = slice_from
+        self.slice_to = slice_to
+
+    def sql(self):
+        """as a case sensitive SQL expression"""
+        if self.name == 'id':
+            return 'id'
+        return 'CAST(' + self.name + ' AS BINARY)'
+
+_OBJ = object() # marker for the obj attribute, whose fields are columns
+_LIKE_RX = re.compile(r'([\\%_])')
+_RX_META = set('.^$*+?{}[]|()\\')
+
+def _like(value):
+    """escape a literal for LIKE"""
+    return _LIKE_RX.sub(r'\\\1', value)
+
+def _rx_like(pattern):
+    """LIKE pattern matching as re.search(pattern) would, for simple ones"""
+    head = pattern.startswith('^')
+    tail = pattern.endswith('$') and not pattern.endswith('\\$')
+    body = pattern[1 if head else 0:-1 if tail else len(pattern)]
+    literal = ''
+    escaped = False
+    for char in body:
+        if escaped:
+            if char.isalnum(): # \d, \w and friends
+                raise Untranslatable(pattern)
+            literal += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in _RX_META:
+            raise Untranslatable(pattern)
+        else:
+            literal += char
+    if escaped:
+        raise Untranslatable(pattern)
+    return ('' if head else '%') + _like(literal) + ('' if tail else '%')
+
+class _Cond(object):
+    """an SQL condition and its args"""
+    def __init__(self, sql, args):
+        self.sql = sql
+        self.args = args
+
+class _Sql(object):
+    """
+    Partial evaluation: attributes are constants, obj fields are columns.
+    Each visit returns a python constant, a _Column, or a _Cond.
+    """
+
+    def __init__(self, attrs, columns):
+        self.attrs = attrs
+        self.columns = columns
+
+    def visit(self, node):
+        """dispatch on node type"""
+        method = getattr(self, 'visit_' + node.__class__.__name__, None)
+        if not method:
+            raise Untranslatable(node.__class__.__name__)
+        return method(node)
+
+    def constant(self, node):
+        """visit, requiring a constant"""
+        value = self.visit(node)
+        if value is _OBJ or isinstance(value, (_Column, _Cond)):
+            raise Untranslatable("not constant")
+        return value
+
+    @staticmethod
+    def condition(value):
+        """_Cond for a condition or constant"""
+        if isinstance(value, _Cond):
+            return value
+        if value is _OBJ or isinstance(value, _Column):
+            raise Untranslatable("column as condition")
+        return _Cond('1' if value else '0', [])
+
+    # pylint: disable=invalid-name,missing-docstring
+    def visit_Constant(self, node):
+        return node.value
+
+    def visit_Tuple(self, node):
+        return tuple([self.constant(elem) for elem in node.elts])
+
+    def visit_List(self, node):
+        return [self.constant(elem) for elem in node.elts]
+
+    def visit_Name(self, node):
+        if node.id == 'obj':
+            return _OBJ
+        if node.id in self.attrs:
+            return self.attrs[node.id]
+        if node.id in ABAC_CONTEXT:
+            return ABAC_CONTEXT[node.id]
+        raise Untranslatable(node.id)
+
+    def visit_Attribute(self, node):
+        value = self.constant(node.value)
+        if node.attr.startswith('_'):
+            raise Untranslatable(node.attr)
+        try:
+            return getattr(value, node.attr)
+        except Exception as err:
+            raise Untranslatable(str(err))
+
+    def visit_Subscript(self, node):
+        value = self.visit(node.value)
+        if isinstance(node.slice, ast.Slice):
+            if not isinstance(value, _Column) or value.name != 'name' or value.slice_from \
+               or value.slice_to or node.slice.step:
+                raise Untranslatable("slice")
+            lower = node.slice.lower and self.constant(node.slice.lower)
+            upper = node.slice.upper and self.constant(node.slice.upper)
+            if not lower and isinstance(upper, int) and upper > 0:
+                return _Column('name', slice_to=upper)
+            if not upper and isinstance(lower, int) and lower < 0:
+                return _Column('name', slice_from=lower)
+            raise Untranslatable("slice")
+        key = self.constant(node.slice)
+        if value is _OBJ:
+            if key not in self.columns:
+                raise Untranslatable(str(key))
+            return _Column(key)
+        if isinstance(value, (_Column, _Cond)):
+            raise Untranslatable("column subscript")
+        try:
+            return value[key]
+        except Exception as err:
+            raise Untranslatable(str(err))
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.USub):
+            value = self.constant(node.operand)
+            if not isinstance(value, (int, float)):
+                raise Untranslatable("operator")
+            return -value
+        if not isinstance(node.op, ast.Not):
+            raise Untranslatable("operator")
+        cond = self.condition(self.visit(node.operand))
+        if not cond.args and cond.sql in ('0', '1'):
+            return cond.sql == '0'
+        return _Cond('NOT (' + cond.sql + ')', cond.args)
+
+    def visit_BoolOp(self, node):
+        is_and = isinstance(node.op, ast.And)
+        parts = list()
+        for elem in node.values:
+            value = self.visit(elem)
+            if not isinstance(value, _Cond):
+                if bool(self.constant(elem)) != is_and: # False in an and, True in an or
+                    return not is_and
+                continue
+            parts.append(value)
+        if not parts:
+            return is_and
+        if len(parts) == 1:
+            return parts[0]
+        args = list()
+        for part in parts:
+            args += part.args
+        return _Cond('(' + (' AND ' if is_and else ' OR ').join([part.sql for part in parts]) +
+                     ')', args)
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1:
+            raise Untranslatable("chained compare")
+        left = self.visit(node.left)
+        right = self.visit(node.comparators[0])
+        oper = node.ops[0]
+        for value in (left, right):
+            if value is _OBJ or isinstance(value, _Cond):
+                raise Untranslatable("compare")
+        if not isinstance(left, _Column) and not isinstance(right, _Column):
+            try:
+                return _FOLD[oper.__class__](left, right)
+            except Exception as err:
+                raise Untranslatable(str(err))
+        if isinstance(right, _Column) and isinstance(oper, (ast.Eq, ast.NotEq)):
+            left, right = right, left
+        if not isinstance(left, _Column) or isinstance(right, _Column):
+            raise Untranslatable("compare")
+        return self._compare(left, oper, right)
+
+    @staticmethod
+    def _compare(col, oper, value):
+        """column compared to a constant"""
+        kind = int if col.name == 'id' else str
+        negate = isinstance(oper, (ast.NotEq, ast.NotIn))
+        # pylint: disable=unidiomatic-typecheck
+        if isinstance(oper, (ast.In, ast.NotIn)):
+            if col.slice_from or col.slice_to or not isinstance(value, (list, tuple, set)) \
+               or not all([type(elem) is kind for elem in value]):
+                raise Untranslatable("in")
+            if not value:
+                return negate
+            cond = _Cond(col.sql() + ' IN (' + ','.join(['?'] * len(value)) + ')', list(value))
+        elif isinstance(oper, (ast.Eq, ast.NotEq)):
+            if type(value) is not kind:
+                raise Untranslatable("type")
+            if col.slice_to:
+                if len(value) != col.slice_to:
+                    raise Untranslatable("slice length")
+                cond = _Cond(col.sql() + ' LIKE ?', [_like(value) + '%'])
+            elif col.slice_from:
+                if len(value) != -col.slice_from:
+                    raise Untranslatable("slice length")
+                cond = _Cond(col.sql() + ' LIKE ?', ['%' + _like(value)])
+            else:
+                cond = _Cond(col.sql() + ' = ?', [value])
+        else:
+            raise Untranslatable("operator")
+        if negate:
+            cond.sql = 'NOT (' + cond.sql + ')'
+        return cond
+
+    def visit_Call(self, node):
+        func = self.constant(node.func)
+        if node.keywords:
+            raise Untranslatable("keywords")
+        args = [self.visit(elem) for elem in node.args]
+        if func is re.search and len(args) == 2 and isinstance(args[0], str) and \
+           isinstance(args[1], _Column) and args[1].name == 'name' and \
+           not (args[1].slice_from or args[1].slice_to):
+            return _Cond(args[1].sql() + ' LIKE ?', [_rx_like(args[0])])
+        raise Untranslatable("call")
+
+_FOLD = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    ast.Is: lambda a, b: a is b,
+    ast.IsNot: lambda a, b: a is not b,
+}
+
+def sql_predicate(source, attrs, columns=('id', 'name')):
+    """
+    Partially evaluate an expression for every row of a table: attrs are
+    known, and obj[column] are the row's columns.  Returns the SQL condition
+    and its args, or None where the expression cannot be translated (and
+    must be evaluated per row instead).  Matching is case sensitive, as in
+    python.
+
+    >>> groups = {'ops': ['web-1', 'web-2']}
+    >>> sql_predicate("obj_type == 'Config' and obj['name'][:4] == 'web-'",
+    ...               {'obj_type': 'Config'})
+    ('CAST(name AS BINARY) LIKE ?', ['web-%'])
+    >>> sql_predicate("obj_type in ('Service',) and rx(r'^web\\.', obj['name'])",
+    ...               {'obj_type': 'Config'})
+    ('0', [])
+    >>> sql_predicate("rx(r'^web\\.', obj['name']) or obj['name'] in groups['ops']",
+    ...               {'groups': groups})
+    ('(CAST(name AS BINARY) LIKE ? OR CAST(name AS BINARY) IN (?,?))', ['web.%', 'web-1', 'web-2'])
+    >>> sql_predicate("obj['name'][-12:] == '-keymaterial'", {})
+    ('CAST(name AS BINARY) LIKE ?', ['%-keymaterial'])
+    >>> sql_predicate("not obj['id'] == 3 and True", {})
+    ('NOT (id = ?)', [3])
+    >>> sql_predicate("rx('w+b', obj['name'])", {}) is None
+    True
+    >>> sql_predicate("obj['name'] in groups['nothere']", {'groups': groups}) is None
+    True
+    """
+    try:
+        tree = ast.parse(source, '<sql>', 'eval')
+        cond = _Sql.condition(_Sql(attrs, columns).visit(tree.body))
+    except (Untranslatable, SyntaxError):
+        return None
+    return cond.sql, cond.args
 
 ################################################################################
 def _attrs_skeleton(**kwargs):
@@ -173,6 +683,74 @@ def attrs_skeleton(**kwargs):
 
 MASTER_ATTRS = _attrs_skeleton(token_nbr=100, token_name='master')
 
+################################################################################
+class LazyAttrs(dictlib.Obj):
+    """
+    Attributes where some values are computed the first time they are read,
+    by a policy expression (as eval locals) or anything else.  Costly values
+    which most policies never use (groups, headers) are given to lazy().
+
+    >>> calls = []
+    >>> attrs = LazyAttrs(token_name='sinatra')
+    >>> attrs.lazy('groups', lambda: calls.append(1) or {'rat': ['pack']})
+    >>> 'groups' in attrs, calls
+    (True, [])
+    >>> def allowed(expr):
+    ...     return Policy('read', 'pass', 1, 1, 'test', expr, {}, 0, 0).allowed(attrs)
+    >>> allowed("token_name == 'sinatra'"), calls
+    (True, [])
+    >>> allowed("'pack' in groups['rat']"), calls
+    (True, [1])
+    >>> attrs.groups, attrs.get('groups'), calls
+    ({'rat': ['pack']}, {'rat': ['pack']}, [1])
+    >>> allowed("nothere == 1")
+    False
+    """
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, '_loaders', dict())
+        object.__setattr__(self, 'decisions', dict()) # see RCObject.authorized
+        super(LazyAttrs, self).__init__(*args, **kwargs)
+
+    ############################################################################
+    def lazy(self, key, loader):
+        """value for key is loader(), when first read"""
+        self.pop(key, None)
+        self._loaders[key] = loader
+
+    ############################################################################
+    def __missing__(self, key):
+        loader = self._loaders.pop(key, None)
+        if not loader:
+            raise KeyError(key)
+        value = loader()
+        self[key] = value
+        return value
+
+    ############################################################################
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._loaders
+
+    ############################################################################
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+# attributes which are the same for every request of a token, so decisions
+# using only these may be cached across requests (see RCObject.authorized).
+# Not obj: its content may change within the second of updated_at, which is
+# all a decision key can tell apart, so decisions reading it are per request.
+STABLE_ATTRS = frozenset(['token_nbr', 'token_name', 'groups',
+                          'action', 'sensitive', 'obj_type'])
+
+################################################################################
+def lazy_attrs():
+    """attrs_skeleton() as LazyAttrs"""
+    attrs = LazyAttrs(**_attrs_skeleton())
+    cherrypy.serving.request.login = attrs
+    return attrs
+
 ################################################################################
 # pylint: disable=too-few-public-methods
 class AuthService(object):
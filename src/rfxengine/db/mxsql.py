@@ -70,11 +70,16 @@ class Interface(pool.Interface):
     _last_used = 0
     max_idle_time = 3600 # reconnect after 1 hour
     dbc = None
+    _txn_depth = 0
+    _before = None
+    _after = None
 
     ############################################################################
     def __init__(self, **kwargs):
         kwargs['dbc'] = None
         super(Interface, self).__init__(**kwargs)
+        self._before = list()
+        self._after = list()
 
     ############################################################################
     def __del__(self):
@@ -93,6 +98,9 @@ class Interface(pool.Interface):
             self.dbc.close()
             super(Interface, self).close()
             self.dbc = None
+            self._txn_depth = 0
+            self._before = list()
+            self._after = list()
 
     ############################################################################
     def expired(self):
@@ -133,6 +141,91 @@ class Interface(pool.Interface):
         self._last_used = time.time()
         return self
 
+    ############################################################################
+    def begin(self):
+        """
+        Start a transaction.  Nested calls use a savepoint, so a method
+        may wrap its own work while being part of a larger batch.
+        """
+        if not self._txn_depth:
+            self.connect()
+            self.dbc.start_transaction()
+        else:
+            self.dbc.cmd_query("SAVEPOINT txn" + str(self._txn_depth))
+        self._txn_depth += 1
+
+    ############################################################################
+    def commit(self):
+        """Commit a transaction, once the outermost begin() is matched"""
+        if self._txn_depth <= 0:
+            return
+        if self._txn_depth == 1 and self._before:
+            # still open, so a failure here is rolled back by the caller
+            before, self._before = self._before, list()
+            for _, func in before:
+                func(self)
+        self._txn_depth -= 1
+        if self._txn_depth:
+            self.dbc.cmd_query("RELEASE SAVEPOINT txn" + str(self._txn_depth))
+        else:
+            self.dbc.commit()
+            self._run_after()
+
+    ############################################################################
+    def rollback(self):
+        """
+        Roll back to the matching begin(): a nested call only undoes its own
+        work, leaving the outer transaction open.
+        """
+        if not self._txn_depth:
+            return
+        self._txn_depth -= 1
+        self._before = [elem for elem in self._before if elem[0] <= self._txn_depth]
+        if self._txn_depth:
+            self.dbc.cmd_query("ROLLBACK TO SAVEPOINT txn" + str(self._txn_depth))
+        elif self.dbc:
+            self.dbc.rollback()
+        if not self._txn_depth:
+            self._run_after()
+
+    ############################################################################
+    def before_commit(self, func):
+        """
+        Call func(dbi) as the last work of the outermost transaction, just
+        before it commits (dropped if its part is rolled back), or now in a
+        transaction of its own if none is open.  For locks which should be
+        held only briefly, and taken after any others.
+        """
+        if self._txn_depth:
+            self._before.append((self._txn_depth, func))
+            return
+        self.begin()
+        try:
+            func(self)
+            self.commit()
+        except:
+            self.rollback()
+            raise
+
+    ############################################################################
+    def after_transaction(self, func):
+        """
+        Call func once the outermost transaction ends, or now if none is
+        open.  For dropping cached copies of rows being changed: if dropped
+        before the commit, another thread may cache the old rows again.
+        Also called on rollback, where dropping is only wasted work.
+        """
+        if self._txn_depth:
+            self._after.append(func)
+        else:
+            func()
+
+    def _run_after(self):
+        """call what after_transaction() held"""
+        after, self._after = self._after, list()
+        for func in after:
+            func()
+
     ############################################################################
     # pylint: disable=invalid-name
     def prepare(self, stmt):
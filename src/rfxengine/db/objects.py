@@ -31,21 +31,27 @@ A few unit tests are embedded, however, most of them are external.
 """
 
 import re
+import copy
 import uuid
 import time
+import datetime
+import threading
 import base64
+import binascii
+import hmac
 import hashlib # hashlib is fastest for hashing
 import nacl.utils # for keys -- faster than cryptography lib
 import nacl.pwhash # for password hashing
 from mysql.connector.errors import ProgrammingError, IntegrityError, DatabaseError
 import rfx
 from rfx import json4store, json2data #, json4human
+from rfx.config import ConfigProcessor, Config as ConfigDef
 from rfxengine.exceptions import ObjectNotFound, NoArchive, ObjectExists,\
                                  NoChanges, InvalidParameter,\
-                                 PolicyFailed
+                                 PolicyFailed, InvalidPolicy
 from rfxengine import abac, log, do_DEBUG#, trace
 from rfxengine.db.pool import db_interface
-from rfxengine.db.mxsql import row_to_dict
+from rfxengine.db.mxsql import row_to_dict, decode_row
 import dictlib
 
 # todo: want to hook object and its relationships
@@ -82,6 +88,133 @@ class RCMap(dictlib.Obj):
                                     hasid=hasid,
                                     sensitive=sensitive)
 
+################################################################################
+class PolicySet(object):
+    """
+    Policies as mapped by PolicyFor, for authorization lookups.
+
+    Immutable once built, apart from per-target maps added as targets are
+    first looked up (or dropped by forget() when a target is remapped).
+    A lookup which overlaps a forget() of its target is not kept, as it may
+    have read the rows from before the change.
+    A new set is built and swapped in as master.policyset when the version
+    (the 'policymap' cache generation, changed by any Policy or Policyscope
+    change) moves on, or when it expires (for changes by other engines).
+    Each map is {action: [policies]}, sorted by sort_key, highest first.
+    """
+
+    lock = threading.Lock()
+    columns = """action, result, sort_order, id, name, policy, data,
+                 unix_timestamp(updated_at), target_id"""
+
+    def __init__(self, version, expires):
+        self.version = version
+        self.expires = expires
+        self.tables = dict()  # table -> map of policies for every target
+        self.targets = dict() # (table, target_id) -> map with the target's own
+        self.exprs = dict()   # (policy id, updated) -> abac.Expression
+        self.forgets = dict() # (table, target_id) -> count of forget() calls
+        self.guard = threading.Lock() # for targets and forgets
+
+    ############################################################################
+    @classmethod
+    def current(cls, master, dbi):
+        """the current set, building a new one if it is out of date"""
+        cache = master.cache
+        pset = master.policyset
+        if pset and pset.version == cache.generation('policymap') and \
+           pset.expires > time.time():
+            return pset
+        with cls.lock:
+            pset = master.policyset
+            version = cache.generation('policymap')
+            if pset and pset.version == version and pset.expires > time.time():
+                return pset
+            pset = cls(version, time.time() + cache.ctypes['policymap'])
+            pset.load(dbi)
+            master.policyset = pset
+        return pset
+
+    ############################################################################
+    @staticmethod
+    def forget(master, table, target_id, dbi):
+        """
+        a target's PolicyFor rows changed, look them up again (once the
+        change is committed)
+        """
+        def forget():
+            """drop the target's map from the current set"""
+            pset = master.policyset
+            if pset:
+                key = (table, target_id)
+                with pset.guard:
+                    pset.forgets[key] = pset.forgets.get(key, 0) + 1
+                    pset.targets.pop(key, None)
+        dbi.after_transaction(forget)
+
+    ############################################################################
+    def load(self, dbi):
+        """the policies mapped to whole tables (target 0)"""
+        cursor = dbi.do("SELECT obj, " + self.columns + """
+                           FROM Policy, PolicyFor
+                          WHERE id = policy_id AND target_id = 0""")
+        for row in cursor:
+            row = decode_row(row)
+            pmap = self.tables.setdefault(row[0], dict(read=list(), write=list(), admin=list()))
+            pmap[row[1]].append(self.policy(row[1:]))
+        cursor.close()
+        for pmap in self.tables.values():
+            self.sort(pmap)
+
+    ############################################################################
+    def policy(self, row):
+        """abac.Policy for a row of columns, sharing compiled expressions"""
+        key = (row[3], row[7])
+        expr = self.exprs.get(key)
+        if not expr:
+            expr = self.exprs[key] = stored_expr(row[5], '<abac policy ' + str(row[3]) + '>')
+        return abac.Policy(*row, expr=expr)
+
+    ############################################################################
+    @staticmethod
+    def sort(pmap):
+        """order each list of a map"""
+        for ptype in pmap:
+            pmap[ptype].sort(key=lambda elem: elem.sort_key, reverse=True)
+        return pmap
+
+    ############################################################################
+    def table(self, table):
+        """map of the policies for every target of a table"""
+        pmap = self.tables.get(table)
+        if pmap is None:
+            pmap = self.tables[table] = dict(read=list(), write=list(), admin=list())
+        return pmap
+
+    ############################################################################
+    def target(self, table, target_id, dbi):
+        """map of the policies for a target, its own and those of its table"""
+        key = (table, target_id)
+        pmap = self.targets.get(key)
+        if pmap is not None:
+            return pmap
+        with self.guard:
+            forgets = self.forgets.get(key, 0)
+        rows = dbi.do_getlist("SELECT " + self.columns + """
+                                 FROM Policy, PolicyFor
+                                WHERE id = policy_id AND obj = ? AND target_id = ?""",
+                              table, target_id)
+        pmap = self.table(table)
+        if rows:
+            pmap = dict([(action, list(policies)) for action, policies in pmap.items()])
+            for row in rows:
+                pmap[row[0]].append(self.policy(row))
+            self.sort(pmap)
+        with self.guard:
+            if self.forgets.get(key, 0) == forgets:
+                self.targets[key] = pmap
+        return pmap
+
 ################################################################################
 # pylint: disable=too-many-public-methods
 class RCObject(rfx.Base):
@@ -118,6 +251,15 @@ class RCObject(rfx.Base):
     policy_map = True
     policies = None
 
+    # is this table carried by export/import?
+    exported = True
+
+    # are writes recorded in ChangeLog (for the change feed)?
+    changelog = True
+
+    # hash of the stored row, from the last get()
+    etag_hash = None
+
     def __init__(self, *args, **kwargs):
         if not self.omap:
             self.omap = dictlib.Obj()
@@ -141,61 +283,15 @@ class RCObject(rfx.Base):
         super(RCObject, self).__init__(*args, **kwargs)
 
     ############################################################################
+    @db_interface
     def _get_policies(self, dbi=None):
         if not self.policy_map:
             return dict(read=list(), write=list(), admin=list())
 
-        target_id = 0
+        pset = PolicySet.current(self.master, dbi)
         if self.obj and self.obj.get('id'):
-            target_id = self.obj['id']
-        cache = self.master.cache
-        start = time.time() # so it is all matching the same time
-        self.start = start
-        key = self.table + "." + str(target_id)
-        pmap = cache.get_cache('policymap', key)
-        if not pmap:
-            return self._get_policies_direct(target_id, key, cache, start, dbi=dbi)
-
-        # if any single policy is expired, re-grab the entire set, as it has
-        # dependent information
-        for action in pmap:
-            for policy in pmap[action]:
-                if policy.expires <= start:
-                    return self._get_policies_direct(target_id, key, cache, start, dbi=dbi)
-
-        return pmap
-
-    ############################################################################
-    # pylint: disable=too-many-arguments
-    def _get_policies_direct(self, target_id, key, cache, start, dbi=None):
-        if target_id:
-            result = dbi.do_getlist("""
-                SELECT action, result, sort_order, id, name, policy, data, unix_timestamp(updated_at), target_id
-                  FROM Policy, PolicyFor
-                 WHERE id=policy_id AND obj = ? AND (target_id = ? OR target_id = 0)
-              """, self.table, target_id)
-        else:
-            result = dbi.do_getlist("""
-                SELECT action, result, sort_order, id, name, policy, data, unix_timestamp(updated_at), target_id
-                  FROM Policy, PolicyFor
-                 WHERE id=policy_id AND obj = ? AND target_id = 0
-              """, self.table)
-
-        pmap = dict(read=list(), write=list(), admin=list())
-        for row in result:
-            policy = abac.Policy(*row)
-            policy.expires = cache.set_cache('policy',
-                                             policy.policy_id,
-                                             policy,
-                                             base_time=start)
-            pmap[policy.policy_action].append(policy)
-
-        for ptype in pmap:
-            if pmap[ptype]:
-                pmap[ptype].sort(key=lambda elem: elem.sort_key, reverse=True)
-
-        cache.set_cache('policymap', key, pmap, base_time=start)
-        return pmap
+            return pset.target(self.table, self.obj['id'], dbi)
+        return pset.table(self.table)
 
     ############################################################################
     def name2id_direct(self, target, dbi):
@@ -268,7 +364,7 @@ class RCObject(rfx.Base):
         If a archive is specified, pull the archived version (value is the date)
         archive is only appropriate for tables supporting Archive.
         """
-        sql = "SELECT * FROM " + self.table
+        sql = "SELECT *, " + self._etag_sql() + " AS _etag FROM " + self.table
         if isinstance(target, str):
 #            trace("name2id")
             idnbr = self.name2id_direct(target, dbi)[0]
@@ -303,6 +399,7 @@ class RCObject(rfx.Base):
                                  .format(self.table, target))
 
 #        trace("decode start")
+        self.etag_hash = dbin.get('_etag')
         self.obj = self._get_decode(attrs, dbin)
 #        trace("decode done")
 
@@ -314,6 +411,86 @@ class RCObject(rfx.Base):
         # are there any policies targeted to this object?
         return self
 
+    ############################################################################
+    def _etag_sql(self):
+        """
+        SQL expression hashing the stored columns of a row, so an entity tag
+        can be had without pulling or decoding the row.
+        """
+        cols = set(['updated_at'])
+        for name, col in self.omap.items():
+            if col.stored != 'data' and name not in ('id', 'updated_at', 'updated_by'):
+                cols.add(col.stored)
+            if col.hasid:
+                cols.add(col.hasid)
+        cols = sorted(cols)
+        if self.vardata:
+            cols.append('data')
+        return "MD5(CONCAT_WS('|', " + ", ".join(cols) + "))"
+
+    ############################################################################
+    def _etag_flags(self, attrs):
+        """
+        Which sensitive views are authorized, as these change the representation
+        """
+        flags = ""
+        if attrs is True:
+            attrs = None
+        if any([col.encrypt for col in self.omap.values()]):
+            if attrs is None or self.authorized("read", attrs, sensitive=True):
+                flags += "r"
+            else:
+                flags += "-"
+        if any([col.sensitive for col in self.omap.values()]):
+            if attrs is None or self.authorized("write", attrs, sensitive=True):
+                flags += "w"
+            else:
+                flags += "-"
+        return flags
+
+    ############################################################################
+    def etag(self, attrs):
+        """Entity tag for the object from the last get()"""
+        if not self.etag_hash:
+            return None
+        return '"{}-{}{}"'.format(self.obj['id'], self.etag_hash[:20], self._etag_flags(attrs))
+
+    ############################################################################
+    @db_interface
+    def get_etag(self, target, attrs, dbi=None):
+        """
+        Cheap form of get(): one indexed read, authorized against the row as
+        get() would, but with no related rows, dump or body.  Returns None
+        if the tag cannot be had this way (not found, or not authorized), in
+        which case the caller should fall back to a full get().
+        """
+        sql = "SELECT *, " + self._etag_sql() + " AS _etag FROM " + self.table
+        name, obj_id = target, 0
+        if isinstance(target, int):
+            name, obj_id = None, target
+        elif isinstance(target, str):
+            name, obj_id = self.split_name2id(target)
+        else:
+            return None
+
+        dbin = None
+        if obj_id:
+            dbin = dbi.do_getone(sql + " WHERE id = ?", obj_id)
+        if not dbin and name:
+            dbin = dbi.do_getone(sql + " WHERE name = ?", name)
+        if not dbin:
+            return None
+
+        # policies may read any field, so authorize the decoded row
+        self.obj = {'id': dbin['id']} # mockup ID so policies will match
+        if attrs is not True:
+            self.policies = self._get_policies(dbi=dbi)
+        self.etag_hash = dbin['_etag']
+        self.obj = self._get_decode(attrs, dbin)
+        if attrs is not True and not self.authorized("read", attrs, sensitive=False):
+            return None
+        return self.etag(attrs)
+
     ############################################################################
     def _get_decode(self, attrs, dbin, cols=None):
         """
@@ -392,11 +569,13 @@ class RCObject(rfx.Base):
         if not self.authorized("write", attrs, sensitive=False, raise_error=False):
             raise PolicyFailed("Unable to get permission to delete object")
 
-        obj_id = self.name2id_direct(target, dbi)[0]
+        obj_id, obj_name = self.name2id_direct(target, dbi)
         if obj_id:
             deleted = dbi.do_count("DELETE FROM " + self.table + " WHERE id = ?", obj_id)
         else:
             raise ObjectNotFound("Target not found")
+        if deleted and self.changelog:
+            changelog_record(dbi, self.table, obj_id, obj_name, 'delete')
         self.obj = dict(id=obj_id)
         self.deleted(attrs, dbi=dbi)
 
@@ -500,9 +679,12 @@ class RCObject(rfx.Base):
 
     ############################################################################
     # pylint: disable=too-many-locals, too-many-statements
-    def _put(self, attrs, dbi=None, doabac=True):
+    def _put(self, attrs, dbi=None, doabac=True, remap=True):
         """
         Store an object into DB
+
+        remap=False skips changed(), for callers (bulk_upsert) which follow
+        up with changed_batch() instead.
         """
         obj = self.obj
         errors = []
@@ -596,28 +778,131 @@ class RCObject(rfx.Base):
             log("type=error", msg=str(err), subtype="dberror", sql=sql)
             raise InvalidParameter(str(err))
 
-        if self.obj['id']:
+        if self.changelog:
+            changelog_record(dbi, self.table, self.obj['id'], self.obj.get('name', ''), 'put')
+
+        if self.obj['id'] and remap:
             errors += self.changed(attrs, dbi=dbi)
 
         return errors
 
     ############################################################################
     @db_interface
-    def update(self, attrs, dbi=None):
+    def update(self, attrs, dbi=None, remap=True):
         """Update data from self into db.  Use on pre-existing objects"""
         if not self.obj.get('id') and self.obj.get('name'):
             self.obj['id'] = self.name2id_direct(self.obj['name'], dbi)[0]
-        return self._put(attrs, dbi=dbi)
+        return self._put(attrs, dbi=dbi, remap=remap)
 
     ############################################################################
     @db_interface
-    def create(self, attrs, dbi=None, doabac=True):
+    def create(self, attrs, dbi=None, doabac=True, remap=True):
         """Create data from self into db.  Use on new objects"""
         if self.obj.get('id') and self.name2id_direct(self.obj['id'], dbi)[0] \
            or self.name2id_direct(self.obj['name'], dbi)[0]:
             raise ObjectExists(self.table + " named `{name}` already exists"
                                .format(**self.obj))
-        return self._put(attrs, dbi=dbi, doabac=doabac)
+        return self._put(attrs, dbi=dbi, doabac=doabac, remap=remap)
+
+    ############################################################################
+    # pylint: disable=too-many-arguments
+    @db_interface
+    def bulk_upsert(self, attrs, objs, dbi=None, batch_size=500, merge=False):
+        """
+        Create or update many objects, committing in batches of batch_size.
+
+        objs is an iterable of (line, data), where data is the decoded object
+        (or the exception raised decoding it).  Objects are matched to existing
+        rows by id, or else by name, and stored with update() (merged into the
+        stored object if merge is set) or create().  Each object is still
+        authorized, but the PolicyFor mapping is done once per batch, with
+        changed_batch().
+
+        Returns a list of results, one per line.
+        """
+        results = list()
+        batch = list()
+        for line, data in objs:
+            batch.append((line, data))
+            if len(batch) >= batch_size:
+                results += self._bulk_batch(attrs, batch, dbi, merge)
+                batch = list()
+        if batch:
+            results += self._bulk_batch(attrs, batch, dbi, merge)
+        return results
+
+    ############################################################################
+    # pylint: disable=too-many-branches,too-many-statements
+    def _bulk_batch(self, attrs, batch, dbi, merge):
+        """store a single batch for bulk_upsert(), in one transaction"""
+        existing = dict()
+        ids = set()
+        names = [data['name'] for line, data in batch
+                 if isinstance(data, dict) and data.get('name') and not data.get('id')]
+        if names:
+            sql = "SELECT id, name FROM " + self.table + \
+                  " WHERE name IN (" + ",".join(["?"] * len(names)) + ")"
+            for obj_id, name in dbi.do_getlist(sql, *names):
+                existing[name] = obj_id
+        given = [data['id'] for line, data in batch
+                 if isinstance(data, dict) and isinstance(data.get('id'), int)]
+        if given:
+            sql = "SELECT id FROM " + self.table + \
+                  " WHERE id IN (" + ",".join(["?"] * len(given)) + ")"
+            ids = set([row[0] for row in dbi.do_getlist(sql, *given)])
+
+        results = list()
+        stored = list()
+        dbi.begin()
+        try:
+            for line, data in batch:
+                result = dict(line=line)
+                results.append(result)
+                if isinstance(data, Exception):
+                    result.update(status="failed", message="Invalid JSON: " + str(data))
+                    continue
+                if not isinstance(data, dict):
+                    result.update(status="failed", message="Line is not an object")
+                    continue
+
+                result['name'] = data.get('name')
+                try:
+                    if data.get('id'):
+                        if data['id'] not in ids:
+                            raise ObjectNotFound("No {} with id {}".format(self.table,
+                                                                          data['id']))
+                    elif existing.get(data.get('name')):
+                        data['id'] = existing[data['name']]
+                    if data.get('id'):
+                        if merge:
+                            data = dictlib.union(self.get(data['id'], attrs, dbi=dbi).dump(),
+                                                 data)
+                        self.load(data)
+                        result['status'] = "updated"
+                        warnings = self.update(attrs, dbi=dbi, remap=False)
+                    else:
+                        self.load(data)
+                        result['status'] = "created"
+                        warnings = self.create(attrs, dbi=dbi, remap=False)
+                    if warnings:
+                        result['warning'] = "; ".join(warnings)
+                    existing[self.obj['name']] = self.obj['id']
+                    ids.add(self.obj['id'])
+                    stored.append(self.obj)
+                except NoChanges:
+                    result['status'] = "unchanged"
+                except PolicyFailed:
+                    result.update(status="failed", message="Forbidden")
+                except (ObjectNotFound, ObjectExists, InvalidParameter, ValueError) as err:
+                    result.update(status="failed", message=str(err))
+
+            self.changed_batch(attrs, stored, dbi=dbi)
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
+
+        return results
 
     ############################################################################
     def validate(self):
@@ -668,7 +953,10 @@ class RCObject(rfx.Base):
     ############################################################################
     # Future: add layers to this, allowing for group level additional crypto
     def decrypt(self, data):
-        """Wrapper for Cipher"""
+        """
+        Wrapper for Cipher.  Plaintext is cached by a digest of the
+        ciphertext, which changes on every write (a new nonce).
+        """
         crypto = self.master.crypto
         if crypto:
             key_name = data[3:6]
@@ -677,8 +965,15 @@ class RCObject(rfx.Base):
             if not crypto.get(key_name):
                 log("type=error", msg="cannot decrypt data: crypto key {} missing".format(key_name))
                 return '"unencryptable--see logs"'
+            cache = self.master.cache
+            digest = hashlib.sha256(data.encode()).digest()
+            plain = cache.get_cache('plaintext', digest)
+            if plain is not None:
+                return plain
             try:
-                return crypto[key_name]['cipher'].key_decrypt(data[6:])
+                plain = crypto[key_name]['cipher'].key_decrypt(data[6:])
+                cache.set_cache('plaintext', digest, plain)
+                return plain
             except nacl.exceptions.CryptoError as err:
                 log("type=error", msg="cannot decrypt data: {}".format(err))
                 return '"unencryptable--see logs"'
@@ -690,7 +985,62 @@ class RCObject(rfx.Base):
         """
         Cross reference ABAC policy for attrs and action.  To evaluate policies
         for debugging, add --debug=abac.
+
+        Decisions are remembered for the rest of a request (request attrs are
+        abac.LazyAttrs), so the columns of a row, or the checks of get() and
+        etag(), evaluate the policies once.  With the 'decision' cache
+        configured, reads are also remembered across requests of the same
+        token, where the policies name only abac.STABLE_ATTRS (so not obj).
+        """
+
+        key = None
+        if isinstance(attrs, abac.LazyAttrs) and not self.do_DEBUG(module="abac"):
+            key = self._decision_key(action, attrs, sensitive)
+            allowed = attrs.decisions.get(key)
+            if allowed is None and key[0]:
+                allowed = self.master.cache.get_cache('decision', key)
+            if allowed is not None:
+                attrs.decisions[key] = allowed
+                if not allowed and raise_error:
+                    raise PolicyFailed("Unable to get permission, try adding --debug=abac arg to engine or --debug=remote-abac to cli") # pylint: disable=line-too-long
+                return allowed
+
+        allowed = self._authorized(action, attrs, sensitive, raise_error)
+        if key:
+            attrs.decisions[key] = allowed
+            if key[0] and self._decision_stable(action):
+                self.master.cache.set_cache('decision', key, allowed)
+        if not allowed and raise_error:
+            raise PolicyFailed("Unable to get permission, try adding --debug=abac arg to engine or --debug=remote-abac to cli") # pylint: disable=line-too-long
+        return allowed
+
+    ############################################################################
+    def _decision_key(self, action, attrs, sensitive):
+        """
+        What a decision depends on: the policy set version, the token (only if
+        it may be shared across requests), and the object.
         """
+        cache = self.master.cache
+        token = None
+        if action == 'read' and cache.ctypes.get('decision') and attrs.get('token_nbr'):
+            token = (attrs['token_nbr'], attrs.get('token_name'))
+        obj = self.obj or {}
+        return (token, cache.generation('policymap'), cache.generation('groups'),
+                self.table, obj.get('id'), obj.get('name'), obj.get('updated_at'),
+                action, sensitive)
+
+    ############################################################################
+    def _decision_stable(self, action):
+        """do the policies for action only use attributes which are the same per token?"""
+        for act in set([action, 'admin']):
+            for policy in self.policies[act]:
+                if not abac.STABLE_ATTRS.issuperset(policy.policy_ast.names):
+                    return False
+        return True
+
+    ############################################################################
+    def _authorized(self, action, attrs, sensitive, raise_error):
+        """evaluate the policies for authorized()"""
 
         attrs['action'] = action
         attrs['sensitive'] = sensitive
@@ -726,14 +1076,22 @@ class RCObject(rfx.Base):
                     dbg(step="AUTHORIZED", id=policy.policy_id, act=act)
                     return True
                 if policy.policy_fail: # always drop out -- dangerous if misapplied
-                    if raise_error:
-                        raise PolicyFailed("Unable to get permission, try adding --debug=abac arg to engine or --debug=remote-abac to cli") # pylint: disable=line-too-long
                     return False
-        if raise_error:
-            raise PolicyFailed("Unable to get permission, try adding --debug=abac arg to engine or --debug=remote-abac to cli") # pylint: disable=line-too-long
-        dbg(step="FAILED")
+        if not raise_error:
+            dbg(step="FAILED")
         return False
 
+    ############################################################################
+    @db_interface
+    def authorize_table(self, action, attrs, dbi=None):
+        """
+        Authorize an action against the table as a whole (no target), raising
+        PolicyFailed if not allowed.  Used by admin endpoints.
+        """
+        self.obj = dict()
+        self.policies = self._get_policies(dbi=dbi)
+        return self.authorized(action, attrs, sensitive=False, raise_error=True)
+
     ############################################################################
     def map_soft_relationships(self, dbi): # pylint: disable=unused-argument
         """
@@ -826,6 +1184,19 @@ class RCObject(rfx.Base):
             raise ValueError("class object must be Pipeline or Service")
         return list()
 
+    ############################################################################
+    def clear_cache(self, dbi, *ctypes):
+        """
+        drop cached ctypes, once dbi's transaction (if any) ends: cleared
+        before the commit, another thread may cache the old rows again
+        """
+        cache = self.master.cache
+        def clear():
+            """drop them"""
+            for ctype in ctypes:
+                cache.clear_type(ctype)
+        dbi.after_transaction(clear)
+
     ############################################################################
     def _delete_policyfor(self, dbi):
         """Delete PolicyFor pertaning to this object"""
@@ -833,6 +1204,7 @@ class RCObject(rfx.Base):
                   WHERE obj = ? AND target_id = ?
                """, self.table, self.obj['id'])
         cursor.close()
+        PolicySet.forget(self.master, self.table, self.obj['id'], dbi)
 
     ############################################################################
     def deleted(self, attrs, dbi=None): # pylint: disable=unused-argument
@@ -856,6 +1228,34 @@ class RCObject(rfx.Base):
         self.map_targeted_policies(scopelist, dbi=dbi)
         return list()
 
+    ############################################################################
+    def changed_batch(self, attrs, objs, dbi=None): # pylint: disable=unused-argument
+        """
+        Batched form of changed(), for objects stored by bulk_upsert().
+        PolicyFor is cleared and remapped with a single statement each.
+        """
+        if not objs:
+            return list()
+        scopelist = policyscope_get_cached(self.master.cache, dbi, 'targeted')
+        ids = [obj['id'] for obj in objs]
+        dbi.do_count("DELETE FROM PolicyFor WHERE obj = ? AND target_id IN (" +
+                     ",".join(["?"] * len(ids)) + ")", self.table, *ids)
+
+        debug = self.do_DEBUG('abac')
+        rows = list()
+        for obj in objs:
+            attribs = dict(obj=obj, obj_type=self.table)
+            for pscope in scopelist:
+                rows += policyscope_map_rows(pscope, attribs, self.table, obj['id'],
+                                             debug=debug)
+        if rows:
+            dbi.do_count("REPLACE INTO PolicyFor (obj, policy_id, target_id, pscope_id, action)"
+                         " VALUES " + ",".join(["(?,?,?,?,?)"] * len(rows)),
+                         *[value for row in rows for value in row])
+        for obj_id in ids:
+            PolicySet.forget(self.master, self.table, obj_id, dbi)
+        return list()
+
     #############################################################################
     def map_targeted_policies(self, scopelist, dbi=None):
         """
@@ -867,6 +1267,7 @@ class RCObject(rfx.Base):
         for pscope in scopelist:
             policyscope_map_for(pscope, dbi, attribs, self.table, self.obj['id'],
                                 debug=debug)
+        PolicySet.forget(self.master, self.table, self.obj['id'], dbi)
 
 ################################################################################
 class Pipeline(RCObject):
@@ -977,16 +1378,300 @@ class Service(RCObject):
         """map out my relationships"""
         errors = super(Service, self).map_soft_relationships(dbi)
 
-        instance = Instance(clone=self)
-
         errors += self._map_soft_relationship(dbi, Pipeline(clone=self), "pipeline")
         errors += self._map_soft_relationship(dbi, Config(clone=self), "config")
-        errors += self._map_soft_relationships(dbi, instance, "dynamic-instances")
-        errors += self._map_soft_relationships(dbi, instance, "static-instances")
-        errors += self._map_soft_relationships(dbi, instance, "active-instances")
+        for key in ServiceMember.kinds:
+            if self.obj.get(key):
+                self.obj[key], errs = ServiceMember(clone=self).resolve(dbi, self.obj[key])
+                errors += errs
+
+        return errors
+
+    ############################################################################
+    def _etag_sql(self):
+        """members are kept in ServiceMember, so are part of the tag"""
+        members = ("(SELECT GROUP_CONCAT(kind, ':', name, '.', instance_id"
+                   "                     ORDER BY kind, name)"
+                   "   FROM ServiceMember WHERE service_id = id)")
+        return ("MD5(CONCAT_WS('|', " + super(Service, self)._etag_sql() +
+                ", " + members + "))")
+
+    ############################################################################
+    @db_interface
+    def get(self, target, attrs, dbi=None, archive=None):
+        """Get a service, with its instance lists from ServiceMember"""
+        super(Service, self).get(target, attrs, dbi=dbi, archive=archive)
+        if not archive:
+            members = ServiceMember(clone=self).members(dbi, self.obj['id'])
+            ServiceMember.overlay(self.obj, members)
+        return self
+
+    ############################################################################
+    # pylint: disable=too-many-arguments
+    @db_interface
+    def list_cols(self, attrs, cols, dbi=None, limit=0, match=None, archive=None):
+        """List services, with their instance lists from ServiceMember"""
+        result = super(Service, self).list_cols(attrs, cols, dbi=dbi, limit=limit,
+                                                match=match, archive=archive)
+        if not archive and set(cols) & set(['*'] + list(ServiceMember.kinds)):
+            members = ServiceMember(clone=self).members_of(dbi, [row['id'] for row in result])
+            for row in result:
+                ServiceMember.overlay(row, members.get(row['id'], dict()), cols=cols)
+        return result
+
+    ############################################################################
+    def _put(self, attrs, dbi=None, doabac=True, remap=True):
+        """store, along with the ServiceMember rows, in one transaction"""
+        dbi.begin()
+        try:
+            errors = super(Service, self)._put(attrs, dbi=dbi, doabac=doabac, remap=remap)
+            ServiceMember(clone=self).store(dbi, self.obj['id'], self.obj)
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
+        return errors
+
+    ############################################################################
+    def deleted(self, attrs, dbi=None):
+        """drop the membership rows"""
+        dbi.do_count("DELETE FROM ServiceMember WHERE service_id = ?", self.obj['id'])
+        return super(Service, self).deleted(attrs, dbi=dbi)
+
+    ############################################################################
+    def export_prepare(self, dbi):
+        """
+        Called by Schema.export_rows() before the rows stream: update_members()
+        leaves the document lists stale, so return a function which puts the
+        current lists into each exported row's data, for the rebuild on import.
+        """
+        members = ServiceMember(clone=self).members_of(dbi)
+
+        def export_row(row):
+            """set the instance lists of one raw Service row"""
+            data = json2data(row.get('data') or '{}')
+            current = members.get(row['id'], dict())
+            for key in ServiceMember.kinds:
+                if key in current:
+                    data[key] = json4store(current[key])
+                elif key in data:
+                    data[key] = json4store(list())
+            row['data'] = json4store(data)
+            return row
+
+        return export_row
 
+    ############################################################################
+    # pylint: disable=too-many-arguments
+    @db_interface
+    def update_members(self, target, key, attrs, add=None, remove=None, dbi=None):
+        """
+        Add and remove instances from one of the instance lists (key), without
+        rewriting the service document (so no archive row, nor policy remap).
+        Returns a list of warnings, as with update().
+        """
+        if key not in ServiceMember.kinds:
+            raise InvalidParameter("Invalid member list=" + str(key) + " not one of: " +
+                                   ", ".join(sorted(ServiceMember.kinds)))
+        self.get(target, attrs, dbi=dbi)
+        self.authorized("write", attrs, sensitive=False, raise_error=True)
+
+        members = ServiceMember(clone=self)
+        kind = ServiceMember.kinds[key]
+        refs, errors = members.resolve(dbi, add or [])
+        dbi.begin()
+        try:
+            count = members.insert(dbi, [members.row(self.obj['id'], kind, ref) for ref in refs])
+            if remove:
+                names = [name.split(".", 1)[0] for name in remove]
+                count += dbi.do_count("DELETE FROM ServiceMember" +
+                                      " WHERE service_id = ? AND kind = ? AND name IN (" +
+                                      ",".join(["?"] * len(names)) + ")",
+                                      self.obj['id'], kind, *names)
+            if count and self.changelog:
+                changelog_record(dbi, self.table, self.obj['id'], self.obj['name'], 'put')
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
         return errors
 
+################################################################################
+class ServiceMember(RCObject):
+    """
+    DROP> drop table if exists ServiceMember;
+     ADD> create table ServiceMember (
+     ADD>     service_id int not null,
+     ADD>     kind enum('dynamic', 'active', 'static') not null,
+     ADD>     name varchar(64) not null,
+     ADD>     instance_id int not null default 0,
+     ADD>     primary key(service_id, kind, name),
+     ADD>     index(instance_id)
+     ADD> ) engine=InnoDB;
+
+    The instance lists of a Service, one row per member.  An instance which
+    is not found is kept by name, with instance_id 0.  Not exported: the
+    Service rows carry their lists, and import_finish() rebuilds from them.
+    """
+
+    table = 'ServiceMember'
+    policy_map = False
+    exported = False
+    changelog = False
+    kinds = {'dynamic-instances': 'dynamic',
+             'active-instances': 'active',
+             'static-instances': 'static'}
+
+    ############################################################################
+    def resolve(self, dbi, refs):
+        """
+        Map instance references to name.id form with one query, preferring
+        the .id when it is given (as name2id_direct does).
+        Returns (refs, errors).
+        """
+        if not refs:
+            return list(), list()
+        wanted = [self.split_name2id(ref) for ref in refs]
+        ids = [obj_id for _, obj_id in wanted if obj_id]
+        names = [name for name, _ in wanted if name]
+        where = list()
+        args = list()
+        if ids:
+            where.append("id IN (" + ",".join(["?"] * len(ids)) + ")")
+            args += ids
+        if names:
+            where.append("name IN (" + ",".join(["?"] * len(names)) + ")")
+            args += names
+        by_id = dict()
+        by_name = dict()
+        for obj_id, name in dbi.do_getlist("SELECT id, name FROM Instance WHERE " +
+                                           " OR ".join(where), *args):
+            by_id[obj_id] = name
+            by_name[name] = obj_id
+
+        result = list()
+        errors = list()
+        for name, obj_id in wanted:
+            if obj_id in by_id:
+                result.append(by_id[obj_id] + "." + str(obj_id))
+            elif name in by_name:
+                result.append(name + "." + str(by_name[name]))
+            else:
+                result.append(name + ".notfound")
+                errors.append("Instance:" + name + " not found")
+        return result, errors
+
+    ############################################################################
+    def row(self, service_id, kind, ref):
+        """
+        (service_id, kind, name, instance_id) for a name.id reference
+
+        >>> ServiceMember().row(4, 'active', 'tardis-1.12')
+        (4, 'active', 'tardis-1', 12)
+        >>> ServiceMember().row(4, 'active', 'tardis-2.notfound')
+        (4, 'active', 'tardis-2', 0)
+        """
+        name, obj_id = self.split_name2id(ref)
+        return (service_id, kind, name, obj_id)
+
+    ############################################################################
+    def rows(self, service_id, obj):
+        """all member rows for a service object"""
+        rows = dict()
+        for key, kind in self.kinds.items():
+            for ref in obj.get(key) or []:
+                row = self.row(service_id, kind, ref)
+                rows[row[:3]] = row
+        return list(rows.values())
+
+    ############################################################################
+    # pylint: disable=no-self-use
+    def insert(self, dbi, rows):
+        """add or refresh member rows, returning the count changed"""
+        if not rows:
+            return 0
+        return dbi.do_count("INSERT INTO ServiceMember (service_id, kind, name, instance_id)" +
+                            " VALUES " + ",".join(["(?,?,?,?)"] * len(rows)) +
+                            " ON DUPLICATE KEY UPDATE instance_id = VALUES(instance_id)",
+                            *[value for row in rows for value in row])
+
+    ############################################################################
+    def store(self, dbi, service_id, obj):
+        """replace the members of one service (lists absent from obj are emptied)"""
+        dbi.do_count("DELETE FROM ServiceMember WHERE service_id = ?", service_id)
+        self.insert(dbi, self.rows(service_id, obj))
+
+    ############################################################################
+    def members(self, dbi, service_id):
+        """the instance lists of a service, by key, sorted by name"""
+        return self.members_of(dbi, [service_id]).get(service_id, dict())
+
+    ############################################################################
+    def members_of(self, dbi, service_ids=None):
+        """members() for many services (or all, if None) in one query, by service id"""
+        if service_ids is not None and not service_ids:
+            return dict()
+        where = ""
+        if service_ids is not None:
+            where = " WHERE service_id IN (" + ",".join(["?"] * len(service_ids)) + ")"
+        names = dict([(kind, key) for key, kind in self.kinds.items()])
+        result = dict()
+        for service_id, kind, name, obj_id in dbi.do_getlist("""
+                SELECT service_id, kind, name, instance_id
+                  FROM ServiceMember""" + where + """
+                 ORDER BY service_id, kind, name""", *(service_ids or [])):
+            result.setdefault(service_id, dict()).setdefault(names[kind], list()).append(
+                name + "." + (str(obj_id) if obj_id else "notfound"))
+        return result
+
+    ############################################################################
+    @classmethod
+    def overlay(cls, obj, members, cols=None):
+        """
+        set the instance lists of a service object from its members
+
+        >>> obj = {'active-instances': ['old.1'], 'static-instances': ['old.2']}
+        >>> ServiceMember.overlay(obj, {'active-instances': ['new.3']}, cols=['*'])
+        >>> sorted(obj.items())
+        [('active-instances', ['new.3']), ('static-instances', [])]
+        """
+        for key in cls.kinds:
+            if cols and '*' not in cols and key not in cols:
+                continue
+            if key in members:
+                obj[key] = members[key]
+            elif key in obj:
+                obj[key] = list()
+
+    ############################################################################
+    @db_interface
+    def rebuild(self, dbi=None, batch_size=500):
+        """Rebuild all members from the Service documents (a new table, or an older import)"""
+        dbi2 = self.master.connect()
+        dbi2.begin()
+        try:
+            dbi2.do_count("DELETE FROM ServiceMember")
+            rows = list()
+            cursor = dbi.do("SELECT id, data FROM Service")
+            for obj_id, data in cursor:
+                data = json2data(data or '{}')
+                obj = dict()
+                for key in self.kinds:
+                    refs = data.get(key)
+                    obj[key] = json2data(refs) if isinstance(refs, str) else refs
+                rows += self.rows(obj_id, obj)
+                if len(rows) >= batch_size:
+                    self.insert(dbi2, rows)
+                    rows = list()
+            cursor.close()
+            self.insert(dbi2, rows)
+            dbi2.commit()
+        except:
+            dbi2.rollback()
+            raise
+        finally:
+            dbi2.done()
+
 ################################################################################
 class Config(RCObject):
     """
@@ -1051,40 +1736,348 @@ class Config(RCObject):
 
         return errors
 
-################################################################################
-class Instance(RCObject):
-    """
-    DROP> drop table if exists Instance;
-     ADD> create table Instance (
-     ADD>     id int auto_increment not null,
-     ADD>     name varchar(64) not null,
-     ADD>     updated_at timestamp not null,
-     ADD>     updated_by varchar(32) not null,
-     ADD>     service_id int not null,
-     ADD>     data text,
-     ADD>     primary key(id),
-     ADD>     unique(name)
-     ADD> ) engine=InnoDB;
-    """
-    # a list of object attributes which are part of the actual db object
+    ############################################################################
+    def changed(self, attrs, dbi=None):
+        """drop flattened results which read this config, or missed its name"""
+        self._unflatten(dbi, [self.obj['id'], ('name', self.obj.get('name'))])
+        return super(Config, self).changed(attrs, dbi=dbi)
 
-    table = 'Instance'
+    ############################################################################
+    def changed_batch(self, attrs, objs, dbi=None):
+        """drop flattened results which read these configs, or missed their names"""
+        deps = list()
+        for obj in objs:
+            deps += [obj['id'], ('name', obj.get('name'))]
+        self._unflatten(dbi, deps)
+        return super(Config, self).changed_batch(attrs, objs, dbi=dbi)
 
-    def __init__(self, *args, **kwargs):
-        self.omap = dictlib.Obj()
-        self.omap['service'] = RCMap(stored="data", hasid='service_id')
-        self.omap['service_id'] = RCMap(stype="read", stored='service_id')
-        self.omap['status'] = RCMap(stored="data")
-        self.omap['address'] = RCMap(stored="data", dtype=dict)
-        super(Instance, self).__init__(*args, **kwargs)
+    ############################################################################
+    def deleted(self, attrs, dbi=None):
+        """drop flattened results which read this config"""
+        self._unflatten(dbi, [self.obj['id']])
+        return super(Config, self).deleted(attrs, dbi=dbi)
 
-    def skeleton(self): # pylint: disable=no-self-use
-        """return a set of required attributes with default values"""
-        return dict(
-            address=dict(),
-            service="unknown",
-            status="new"
-        )
+    ############################################################################
+    def _unflatten(self, dbi, deps):
+        """
+        drop flattened results depending on deps, once the transaction ends
+        (before the commit, a flatten could cache the old rows again)
+        """
+        cache = self.master.cache
+        if not cache:
+            return
+        def invalidate():
+            """drop them"""
+            for dep in deps:
+                cache.invalidate('flattened', dep)
+        dbi.after_transaction(invalidate)
+
+    ############################################################################
+    # pylint: disable=protected-access
+    @db_interface
+    def flatten(self, target, attrs, dbi=None):
+        """
+        Flatten a config as rfx.config.ConfigProcessor.flatten() does, but
+        reading from the db.  Macros are not processed, as they reference the
+        client's environment.
+
+        Returns dict(config=merged config, did=what was merged, objects=every
+        config read, by the name it was read as), so the client can process
+        exports the same way without more calls.
+
+        The full result is cached by target, until any config it read changes,
+        or one it looked for but did not find is created (see changed()).  A
+        cached result is used if the caller may read each
+        of its configs, sensitive values included; otherwise it is done again
+        as the caller, for the redacted view.
+        """
+        cache = self.master.cache
+        if not cache:
+            return self._flatten_direct(target, attrs, dbi)
+
+        flat = cache.get_cache('flattened', target)
+        if not flat:
+            generation = cache.generation('flattened')
+            flat = self._flatten_direct(target, True, dbi)
+            cache.set_cache('flattened', target, flat, generation=generation,
+                            deps=[obj['id'] for obj in flat['objects'].values()] +
+                            [('name', name) for name in flat['missing']])
+
+        if attrs is True or self._flatten_authorized(flat, attrs, dbi):
+            return flat
+        return self._flatten_direct(target, attrs, dbi)
+
+    ############################################################################
+    def _flatten_authorized(self, flat, attrs, dbi):
+        """may the caller read every config of a flattened result, as get() would?"""
+        for obj in flat['objects'].values():
+            check = Config(clone=self)
+            check.obj = obj
+            check.policies = check._get_policies(dbi=dbi)
+            if not check.authorized("read", attrs, sensitive=False):
+                return False
+            if obj.get('sensitive') and not check.authorized("read", attrs, sensitive=True):
+                return False
+        return True
+
+    ############################################################################
+    # pylint: disable=protected-access
+    def _flatten_direct(self, target, attrs, dbi):
+        """flatten, as attrs"""
+        source = ConfigReader(self, attrs, dbi)
+        cproc = ConfigProcessor(base=self, rcs=source, verbose=False)
+        conf = ConfigDef(target, base=cproc, rcs=source, verbose=False).conf
+        conf = cproc._flatten(conf, target, toplevel=True)
+        did = dict(imp=list(cproc.did.imp.keys()), ext=list(cproc.did.ext.keys()))
+
+        # walk exports the same way, just to gather their objects
+        for name in conf.exports:
+            if name in cproc.did.exp:
+                continue
+            cproc.did.exp[name] = True
+            exp = copy.deepcopy(conf)
+            exp.name = name
+            cproc._flatten(exp, name, exported=True)
+
+        return dict(config=conf, did=did, objects=source.objects,
+                    missing=sorted(source.missing))
+
+    ############################################################################
+    @db_interface
+    def dependencies(self, target_id, dbi=None):
+        """
+        The configs a config draws from, following extends, imports and
+        exports recursively (a superset of what flattening reads).  Returns
+        a dict of id: name, including target_id itself.
+        """
+        found = dict()
+        found[target_id] = self.name2id_direct(target_id, dbi)[1]
+        for rel in self.relatives(target_id, 'ancestors', dbi=dbi):
+            found[rel['id']] = rel['name']
+        return found
+
+    ############################################################################
+    @db_interface
+    def relatives(self, target_id, direction, dbi=None):
+        """
+        Configs related through extends, imports and exports, from ConfigEdge.
+        direction is 'ancestors' (what the config draws from) or 'descendants'
+        (what draws from it).  Returns a list of dict(id, name, kind, depth),
+        nearest first.
+        """
+        if direction == 'ancestors':
+            match, other = 'child_id', 'parent_id'
+        elif direction == 'descendants':
+            match, other = 'parent_id', 'child_id'
+        else:
+            raise InvalidParameter("direction is one of: ancestors, descendants")
+
+        seen = set([target_id])
+        result = list()
+        todo = [target_id]
+        depth = 0
+        while todo:
+            depth += 1
+            rows = dbi.do_getlist("SELECT e." + other + ", e.kind, c.name" +
+                                  "  FROM ConfigEdge e, Config c" +
+                                  " WHERE c.id = e." + other + " AND e." + match +
+                                  " IN (" + ",".join(["?"] * len(todo)) + ")" +
+                                  " ORDER BY c.name", *todo)
+            todo = list()
+            for rel_id, kind, name in rows:
+                if rel_id in seen:
+                    continue
+                seen.add(rel_id)
+                todo.append(rel_id)
+                result.append(dict(id=rel_id, name=name, kind=kind, depth=depth))
+        return result
+
+    ############################################################################
+    @db_interface
+    def relatives_visible(self, target, direction, attrs, dbi=None):
+        """relatives() of a config, limited to those the caller may read"""
+        self.get(target, attrs, dbi=dbi)
+        result = list()
+        for rel in self.relatives(self.obj['id'], direction, dbi=dbi):
+            try:
+                Config(clone=self).get(rel['id'], attrs, dbi=dbi)
+                result.append(rel)
+            except (ObjectNotFound, PolicyFailed):
+                pass
+        return result
+
+    ############################################################################
+    def _put(self, attrs, dbi=None, doabac=True, remap=True):
+        """store, along with the ConfigEdge references, in one transaction"""
+        dbi.begin()
+        try:
+            errors = super(Config, self)._put(attrs, dbi=dbi, doabac=doabac, remap=remap)
+            ConfigEdge(master=self.master).store(dbi, self.obj['id'], self.obj)
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
+        return errors
+
+    ############################################################################
+    @db_interface
+    def delete(self, target, attrs, dbi=None):
+        """delete, along with the ConfigEdge references, in one transaction"""
+        dbi.begin()
+        try:
+            deleted = super(Config, self).delete(target, attrs, dbi=dbi)
+            dbi.do_count("DELETE FROM ConfigEdge WHERE child_id = ?", self.obj['id'])
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
+        return deleted
+
+################################################################################
+class ConfigEdge(RCObject):
+    """
+    DROP> drop table if exists ConfigEdge;
+     ADD> create table ConfigEdge (
+     ADD>     child_id int not null,
+     ADD>     parent_id int not null,
+     ADD>     kind enum('extends', 'imports', 'exports') not null,
+     ADD>     primary key(child_id, parent_id, kind),
+     ADD>     index(parent_id)
+     ADD> ) engine=InnoDB;
+
+    References between configs: child lists parent in its extends, imports
+    or exports.  Kept by Config._put() and delete(), rebuilt by rebuild().
+    """
+
+    table = 'ConfigEdge'
+    policy_map = False
+    exported = False
+    changelog = False
+    kinds = ('extends', 'imports', 'exports')
+
+    ############################################################################
+    def edges(self, child_id, obj):
+        """
+        (child_id, parent_id, kind) rows for a config's references, which
+        are in name.id form once mapped (unresolved names are skipped).
+
+        >>> ConfigEdge().edges(3, {'extends': ['a.1', 'b.notfound'], 'imports': ['c.2']})
+        [(3, 1, 'extends'), (3, 2, 'imports')]
+        """
+        rows = set()
+        for kind in self.kinds:
+            for ref in obj.get(kind) or []:
+                parent_id = self.split_name2id(ref)[1]
+                if parent_id:
+                    rows.add((child_id, parent_id, kind))
+        return sorted(rows)
+
+    ############################################################################
+    # pylint: disable=no-self-use
+    def insert(self, dbi, rows):
+        """add edge rows"""
+        if rows:
+            dbi.do_count("INSERT IGNORE INTO ConfigEdge (child_id, parent_id, kind) VALUES " +
+                         ",".join(["(?,?,?)"] * len(rows)),
+                         *[value for row in rows for value in row])
+
+    ############################################################################
+    def store(self, dbi, child_id, obj):
+        """replace the edges of one config"""
+        dbi.do_count("DELETE FROM ConfigEdge WHERE child_id = ?", child_id)
+        self.insert(dbi, self.edges(child_id, obj))
+
+    ############################################################################
+    @db_interface
+    def rebuild(self, dbi=None, batch_size=500):
+        """Rebuild all edges from the stored configs (new table, or after an import)"""
+        dbi2 = self.master.connect()
+        dbi2.begin()
+        try:
+            dbi2.do_count("DELETE FROM ConfigEdge")
+            rows = list()
+            cursor = dbi.do("SELECT id, data FROM Config")
+            for obj_id, data in cursor:
+                data = json2data(data or '{}')
+                obj = dict()
+                for kind in self.kinds:
+                    refs = data.get(kind)
+                    obj[kind] = json2data(refs) if isinstance(refs, str) else refs
+                rows += self.edges(obj_id, obj)
+                if len(rows) >= batch_size:
+                    self.insert(dbi2, rows)
+                    rows = list()
+            cursor.close()
+            self.insert(dbi2, rows)
+            dbi2.commit()
+        except:
+            dbi2.rollback()
+            raise
+        finally:
+            dbi2.done()
+
+################################################################################
+# pylint: disable=too-few-public-methods
+class ConfigReader(object):
+    """
+    Stand-in for rfx.client.Session used by Config.flatten(), reading configs
+    from the db as the caller, and keeping what was read (or not found).
+    """
+
+    def __init__(self, config, attrs, dbi):
+        self.config = config
+        self.attrs = attrs
+        self.dbi = dbi
+        self.objects = dict()
+        self.missing = set()
+
+    def get(self, obj_type, name):
+        """session GET"""
+        if obj_type != 'config':
+            raise InvalidParameter("Cannot read " + obj_type + " while flattening")
+        if name not in self.objects:
+            obj = Config(clone=self.config)
+            try:
+                self.objects[name] = obj.get(name, self.attrs, dbi=self.dbi).dump()
+            except ObjectNotFound:
+                self.missing.add(obj.split_name2id(name)[0] or name)
+                raise
+        return copy.deepcopy(self.objects[name])
+
+################################################################################
+class Instance(RCObject):
+    """
+    DROP> drop table if exists Instance;
+     ADD> create table Instance (
+     ADD>     id int auto_increment not null,
+     ADD>     name varchar(64) not null,
+     ADD>     updated_at timestamp not null,
+     ADD>     updated_by varchar(32) not null,
+     ADD>     service_id int not null,
+     ADD>     data text,
+     ADD>     primary key(id),
+     ADD>     unique(name)
+     ADD> ) engine=InnoDB;
+    """
+    # a list of object attributes which are part of the actual db object
+
+    table = 'Instance'
+
+    def __init__(self, *args, **kwargs):
+        self.omap = dictlib.Obj()
+        self.omap['service'] = RCMap(stored="data", hasid='service_id')
+        self.omap['service_id'] = RCMap(stype="read", stored='service_id')
+        self.omap['status'] = RCMap(stored="data")
+        self.omap['address'] = RCMap(stored="data", dtype=dict)
+        super(Instance, self).__init__(*args, **kwargs)
+
+    def skeleton(self): # pylint: disable=no-self-use
+        """return a set of required attributes with default values"""
+        return dict(
+            address=dict(),
+            service="unknown",
+            status="new"
+        )
 
     def validate(self):
         errors = super(Instance, self).validate()
@@ -1103,6 +2096,319 @@ class Instance(RCObject):
 
         return errors
 
+    ############################################################################
+    def _etag_sql(self):
+        """the hot fields are kept in InstanceStatus, so are part of the tag"""
+        status = ("(SELECT CONCAT_WS(':', status, ping_from_ip, last_seen)"
+                  "   FROM InstanceStatus WHERE instance_id = id)")
+        return ("MD5(CONCAT_WS('|', " + super(Instance, self)._etag_sql() +
+                ", " + status + "))")
+
+    ############################################################################
+    @db_interface
+    def ping(self, target, body, attrs, dbi=None):
+        """
+        Heartbeat fast path: authorize once, then store status, ping-from-ip
+        and last-seen as one InstanceStatus row.  The document is rewritten,
+        and the change logged, only if other address fields changed.  Either
+        may instead go to the write-behind buffer, if enabled.  Validation of
+        unchanged fields, relationship mapping and policy remapping are
+        skipped.
+
+        Returns None when a full update is needed instead: a new instance, a
+        change of service (or one not yet found), or other fields in body.
+        """
+        if set(body.keys()) - set(['id', 'name', 'status', 'address', 'service']):
+            return None
+        if body.get('id'):
+            dbin = dbi.do_getone("SELECT * FROM Instance WHERE id = ?", body['id'])
+        else:
+            dbin = dbi.do_getone("SELECT * FROM Instance WHERE name = ?", target)
+        if not dbin:
+            return None
+
+        self.obj = self._get_decode(attrs, dbin)
+        if body.get('service'):
+            cur_name, cur_id = self.split_name2id(self.obj['service'])
+            if not cur_id or self.split_name2id(body['service'])[0] != cur_name:
+                return None
+
+        self.policies = self._get_policies(dbi=dbi)
+        self.authorized("write", attrs, sensitive=False, raise_error=True)
+
+        if not self._pending():
+            self._hot(dbi)
+        before = self._cold_data(self.obj)
+        service = self.obj['service'] # keep the mapped name.id
+        obj = dictlib.union(self.obj, body)
+        obj['service'] = service
+        if not isinstance(obj.get('address'), dict):
+            raise InvalidParameter("address is not an object")
+        obj['last-seen'] = time.time()
+
+        data = self._cold_data(obj)
+        if data == before:
+            data = None # only hot fields changed
+        self.obj = obj
+        if self.master.pings:
+            self.master.pings.add(obj['id'], obj['name'], obj, data, str(attrs.token_nbr))
+            return list()
+
+        if data:
+            dbi.do_count("UPDATE Instance SET data = ?, updated_by = ? WHERE id = ?",
+                         data, str(attrs.token_nbr), obj['id'])
+        InstanceStatus(clone=self).store(dbi, [InstanceStatus.row(obj)])
+        if data and self.changelog: # status alone is not a change of the document
+            changelog_record(dbi, self.table, obj['id'], obj['name'], 'put')
+        return list()
+
+    ############################################################################
+    def _cold_data(self, obj):
+        """the encoded data column, for values other than the hot fields"""
+        data = dict()
+        for name, col in self.omap.items():
+            if col.stored == "data" and obj.get(name) is not None:
+                data[name] = obj[name] if col.dtype == "value" else json4store(obj[name])
+        return json4store(data)
+
+    ############################################################################
+    @db_interface
+    def set_status(self, target, status, attrs, dbi=None):
+        """
+        Change just the status: one InstanceStatus row, leaving the document
+        and policy mappings alone.
+        """
+        obj_id = self.name2id_direct(target, dbi)[0]
+        dbin = obj_id and dbi.do_getone("SELECT * FROM Instance WHERE id = ?", obj_id)
+        if not dbin:
+            raise ObjectNotFound("Unable to load {}: {}".format(self.table, target))
+        self.obj = self._get_decode(attrs, dbin)
+        self.policies = self._get_policies(dbi=dbi)
+        self.authorized("write", attrs, sensitive=False, raise_error=True)
+
+        if self.master.pings:
+            ping = self.master.pings.get(obj_id)
+            if ping:
+                ping.obj['status'] = status
+        changed = dbi.do_count("""
+            INSERT INTO InstanceStatus (instance_id, status, last_seen)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON DUPLICATE KEY UPDATE status = VALUES(status)""", obj_id, status)
+        if changed and self.changelog:
+            changelog_record(dbi, self.table, obj_id, self.obj['name'], 'put')
+        return changed
+
+    ############################################################################
+    def _hot(self, dbi):
+        """take the hot fields from InstanceStatus"""
+        hot = InstanceStatus(clone=self).lookup(dbi, [self.obj['id']])
+        if self.obj['id'] in hot:
+            InstanceStatus.overlay(self.obj, hot[self.obj['id']])
+
+    ############################################################################
+    def _pending(self):
+        """take a ping still waiting in the write-behind buffer, if any"""
+        if self.master.pings:
+            ping = self.master.pings.get(self.obj['id'])
+            if ping:
+                self.obj = copy.deepcopy(ping.obj)
+                self.etag_hash = None # the stored row is behind
+                return True
+        return False
+
+    ############################################################################
+    @db_interface
+    def get(self, target, attrs, dbi=None, archive=None):
+        """Get an instance, with its hot fields and any buffered ping"""
+        super(Instance, self).get(target, attrs, dbi=dbi, archive=archive)
+        if not archive and not self._pending():
+            self._hot(dbi)
+        return self
+
+    ############################################################################
+    # pylint: disable=too-many-arguments
+    @db_interface
+    def list_cols(self, attrs, cols, dbi=None, limit=0, match=None, archive=None):
+        """List instances, with their hot fields"""
+        result = super(Instance, self).list_cols(attrs, cols, dbi=dbi, limit=limit,
+                                                 match=match, archive=archive)
+        if not archive and set(cols) & set(['*', 'status', 'address', 'last-seen']):
+            hot = InstanceStatus(clone=self).lookup(dbi, [row['id'] for row in result])
+            for row in result:
+                if row['id'] in hot:
+                    InstanceStatus.overlay(row, hot[row['id']], cols=cols)
+        return result
+
+    ############################################################################
+    @db_interface
+    def get_etag(self, target, attrs, dbi=None):
+        """no cheap tag while a ping is buffered"""
+        etag = super(Instance, self).get_etag(target, attrs, dbi=dbi)
+        if etag and self.master.pings and \
+           self.master.pings.get(int(etag[1:].split("-", 1)[0])):
+            return None
+        return etag
+
+    ############################################################################
+    def _put(self, attrs, dbi=None, doabac=True, remap=True):
+        """
+        A full update supersedes any buffered ping, and sets the hot fields
+        along with the document.
+        """
+        if self.master.pings and self.obj.get('id'):
+            self.master.pings.discard(self.obj['id'])
+        self.obj.pop('last-seen', None) # read only
+        dbi.begin()
+        try:
+            errors = super(Instance, self)._put(attrs, dbi=dbi, doabac=doabac, remap=remap)
+            InstanceStatus(clone=self).store(dbi, [InstanceStatus.row(self.obj)], seen=False)
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
+        return errors
+
+    ############################################################################
+    def deleted(self, attrs, dbi=None):
+        """drop the hot fields and any buffered ping"""
+        if self.master.pings:
+            self.master.pings.discard(self.obj['id'])
+        dbi.do_count("DELETE FROM InstanceStatus WHERE instance_id = ?", self.obj['id'])
+        return super(Instance, self).deleted(attrs, dbi=dbi)
+
+################################################################################
+class InstanceStatus(RCObject):
+    """
+    DROP> drop table if exists InstanceStatus;
+     ADD> create table InstanceStatus (
+     ADD>     instance_id int not null,
+     ADD>     status varchar(32) not null default '',
+     ADD>     ping_from_ip varchar(45) not null default '',
+     ADD>     last_seen timestamp not null default current_timestamp,
+     ADD>     primary key(instance_id)
+     ADD> ) engine=InnoDB;
+
+    The hot fields of an Instance: status, address.ping-from-ip and
+    last-seen.  These change on every ping or health check, so are kept
+    apart from the document, and win over it on read.  Exported along with
+    Instance (as the document may be behind), under its policies.
+    """
+
+    table = 'InstanceStatus'
+    policy_map = False
+    changelog = False
+
+    ############################################################################
+    def authorize_table(self, action, attrs, dbi=None):
+        """no policies of its own: as for Instance"""
+        return Instance(clone=self).authorize_table(action, attrs, dbi=dbi)
+
+    ############################################################################
+    @staticmethod
+    def row(obj):
+        """
+        (instance_id, status, ping_from_ip, last_seen) for an instance
+
+        >>> InstanceStatus.row({'id': 3, 'status': 'ok', 'last-seen': 10,
+        ...                     'address': {'ping-from-ip': '10.0.0.1'}})
+        (3, 'ok', '10.0.0.1', 10)
+        """
+        address = obj.get('address') or dict()
+        return (obj['id'], obj.get('status') or '', address.get('ping-from-ip') or '',
+                obj.get('last-seen') or time.time())
+
+    ############################################################################
+    @staticmethod
+    def overlay(obj, hot, cols=None):
+        """
+        put the hot fields onto an instance (or just those in cols)
+
+        >>> obj = {'status': 'new', 'address': {'host': 'a'}}
+        >>> InstanceStatus.overlay(obj, ('ok', '10.0.0.1', 10))
+        >>> obj == {'status': 'ok', 'last-seen': 10,
+        ...         'address': {'host': 'a', 'ping-from-ip': '10.0.0.1'}}
+        True
+        """
+        status, ping_from_ip, last_seen = hot
+        cols = set(cols or ['*'])
+        if cols & set(['*', 'status']):
+            obj['status'] = status
+        if cols & set(['*', 'last-seen']):
+            obj['last-seen'] = last_seen
+        if cols & set(['*', 'address']) and ping_from_ip:
+            if not isinstance(obj.get('address'), dict):
+                obj['address'] = dict()
+            obj['address']['ping-from-ip'] = ping_from_ip
+
+    ############################################################################
+    # pylint: disable=no-self-use
+    def store(self, dbi, rows, seen=True, batch_size=500):
+        """
+        set the hot fields for rows from row(); seen=False leaves last_seen
+        on existing rows (an update which is not from the instance)
+        """
+        update = "status = VALUES(status), ping_from_ip = VALUES(ping_from_ip)"
+        if seen:
+            update += ", last_seen = VALUES(last_seen)"
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            dbi.do_count("INSERT INTO InstanceStatus" +
+                         " (instance_id, status, ping_from_ip, last_seen) VALUES " +
+                         ",".join(["(?,?,?,FROM_UNIXTIME(?))"] * len(batch)) +
+                         " ON DUPLICATE KEY UPDATE " + update,
+                         *[value for row in batch for value in row])
+
+    ############################################################################
+    # pylint: disable=no-self-use
+    def lookup(self, dbi, ids, batch_size=1000):
+        """hot fields by instance id: {id: (status, ping_from_ip, last_seen)}"""
+        result = dict()
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            for obj_id, status, ping_from_ip, last_seen in dbi.do_getlist(
+                    "SELECT instance_id, status, ping_from_ip, unix_timestamp(last_seen)" +
+                    "  FROM InstanceStatus WHERE instance_id IN (" +
+                    ",".join(["?"] * len(batch)) + ")", *batch):
+                result[obj_id] = (status, ping_from_ip, float(last_seen))
+        return result
+
+    ############################################################################
+    @db_interface
+    def count(self, dbi=None):
+        """how many rows"""
+        return dbi.do_getone("SELECT COUNT(*) FROM InstanceStatus", output=list)[0]
+
+    ############################################################################
+    @db_interface
+    def rebuild(self, dbi=None, batch_size=500):
+        """Fill from the Instance documents (a new table, or an older import)"""
+        dbi2 = self.master.connect()
+        dbi2.begin()
+        try:
+            dbi2.do_count("DELETE FROM InstanceStatus")
+            rows = list()
+            cursor = dbi.do("SELECT id, data, unix_timestamp(updated_at) FROM Instance")
+            for obj_id, data, updated_at in cursor:
+                data = json2data(data or '{}')
+                address = data.get('address') or '{}'
+                rows.append(self.row({
+                    'id': obj_id,
+                    'status': data.get('status'),
+                    'address': json2data(address) if isinstance(address, str) else address,
+                    'last-seen': float(updated_at)
+                }))
+                if len(rows) >= batch_size:
+                    self.store(dbi2, rows)
+                    rows = list()
+            cursor.close()
+            self.store(dbi2, rows)
+            dbi2.commit()
+        except:
+            dbi2.rollback()
+            raise
+        finally:
+            dbi2.done()
+
 ################################################################################
 class State(RCObject):
     """
@@ -1263,13 +2569,19 @@ class Group(RCObject):
     #############################################################################
     def changed(self, attrs, dbi=None):
         errors = super(Group, self).changed(attrs, dbi=dbi)
-        self.master.cache.clear_type('groups')
+        self.clear_cache(dbi, 'groups', 'pwverify')
+        return errors
+
+    #############################################################################
+    def changed_batch(self, attrs, objs, dbi=None):
+        errors = super(Group, self).changed_batch(attrs, objs, dbi=dbi)
+        self.clear_cache(dbi, 'groups', 'pwverify')
         return errors
 
     #############################################################################
     def deleted(self, attrs, dbi=None):
         errors = super(Group, self).deleted(attrs, dbi=dbi)
-        self.master.cache.clear_type('groups')
+        self.clear_cache(dbi, 'groups', 'pwverify')
         return errors
 
 ################################################################################
@@ -1312,7 +2624,7 @@ class Apikey(RCObject):
 
     ############################################################################
     @db_interface
-    def create(self, attrs, dbi=None, doabac=True):
+    def create(self, attrs, dbi=None, doabac=True, remap=True):
         """
         create new apikey
         """
@@ -1323,13 +2635,73 @@ class Apikey(RCObject):
         self.obj['uuid'] = str(uuid.uuid4())
         self.obj['secrets'] = [base64.b64encode(nacl.utils.random(self.keysize)).decode()]
 
-        return self._put(attrs, dbi=dbi, doabac=doabac)
+        return self._put(attrs, dbi=dbi, doabac=doabac, remap=remap)
+
+    ############################################################################
+    def login_secrets(self, name):
+        """
+        The secrets to verify a login with (as given and base64 decoded),
+        cached so a warm login does not touch the db.  Leaves the id and
+        name in self.obj.
+        """
+        cache = self.master.cache
+        login = cache.get_cache('apikey', name)
+        if not login:
+            self.get(name, True)
+            secrets = list()
+            for secret in self.obj.get('secrets', []):
+                # there is a problem with binary secrets across language bases
+                secrets.append(secret)
+                try:
+                    secrets.append(base64.b64decode(secret))
+                except binascii.Error:
+                    pass
+            login = dict(obj=dict(id=self.obj['id'], name=self.obj['name']), secrets=secrets)
+            cache.set_cache('apikey', name, login)
+        self.obj = dict(login['obj'])
+        return login['secrets']
+
+    #############################################################################
+    def changed(self, attrs, dbi=None):
+        errors = super(Apikey, self).changed(attrs, dbi=dbi)
+        self.clear_cache(dbi, 'apikey')
+        return errors
+
+    #############################################################################
+    def changed_batch(self, attrs, objs, dbi=None):
+        errors = super(Apikey, self).changed_batch(attrs, objs, dbi=dbi)
+        self.clear_cache(dbi, 'apikey')
+        return errors
+
+    #############################################################################
+    def deleted(self, attrs, dbi=None):
+        errors = super(Apikey, self).deleted(attrs, dbi=dbi)
+        self.clear_cache(dbi, 'apikey')
+        return errors
 
     # override update to deal with params changing and deleting secrets
     # do not accept secrets as changes, must use new_secrete
 
     # create new_secret
 
+################################################################################
+def hkdf(key, info, length=64, salt=b''):
+    """
+    HKDF-SHA256 (RFC 5869), the first test vector:
+
+    >>> hkdf(bytes([0x0b] * 22), bytes(range(0xf0, 0xfa)), 42, bytes(range(0, 13))).hex()
+    '3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db02d56ecc4c5bf34007208d5b887185865'
+    """
+    prk = hmac.new(salt or bytes(32), key, hashlib.sha256).digest()
+    okm = block = b''
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+        counter += 1
+    return okm[:length]
+
+################################################################################
 class AuthSession(RCObject):
     """
     DROP> drop table if exists AuthSession;
@@ -1347,6 +2719,8 @@ class AuthSession(RCObject):
 
     table = 'AuthSession'
     policy_map = False
+    exported = False
+    changelog = False
 
     def __init__(self, *args, **kwargs):
         self.omap = dictlib.Obj()
@@ -1385,12 +2759,81 @@ class AuthSession(RCObject):
         self.obj['secret_raw'] = secret_raw
         self.obj['secret_encoded'] = secret_encoded.decode()
         self.obj['data'] = data
+        self.obj['expires_at'] = expires
 
         key = str(tok_id) + ":" + str(session_id)
         self.master.cache.set_cache('session', key, dict(expires=expires, obj=self))
 
         return True
 
+    ############################################################################
+    def new_stateless(self, token_obj, expires):
+        """
+        a session which is not stored: its id carries the expiry and token
+        name, and its secret is derived from the id, so any engine can
+        validate it (see get_stateless)
+        """
+
+        tok_id = token_obj.obj['id']
+        tok_name = token_obj.obj['name']
+        session_id = "s.{}.{}.{}".format(
+            int(expires), nacl.utils.random(12).hex(),
+            base64.urlsafe_b64encode(tok_name.encode()).decode().rstrip('='))
+        secret_raw = self.stateless_secret(tok_id, session_id)
+
+        if not self.obj:
+            self.obj = dict()
+
+        self.obj['token_id'] = tok_id
+        self.obj['session_id'] = session_id
+        self.obj['name'] = session_id
+        self.obj['secret_raw'] = secret_raw
+        self.obj['secret_encoded'] = base64.b64encode(secret_raw).decode()
+        self.obj['data'] = {'token_id': tok_id, 'token_name': tok_name}
+        self.obj['expires_at'] = int(expires)
+
+        return True
+
+    ############################################################################
+    def stateless_secret(self, token_id, session_id):
+        """the secret of a stateless session, from the default crypto key"""
+        master = self.master
+        server_key = master.crypto[master.default_key]['cipher'].key.value
+        return hkdf(server_key, "{}:{}".format(token_id, session_id).encode(),
+                    salt=b'rfx-session')
+
+    ############################################################################
+    def get_stateless(self, token_id, session_id):
+        """
+        a stateless session, without the database.  The secret is derived
+        again, so the secret of a forged id is not one the client knows.
+        """
+
+        if session_id[:2] != "s.":
+            return False
+        try:
+            _, expires, _, name = session_id.split(".")
+            expires = int(expires)
+            name = base64.urlsafe_b64decode(name + '=' * (-len(name) % 4)).decode()
+            token_id = int(token_id)
+        except ValueError:
+            return False
+        if expires < time.time():
+            return False
+
+        if not self.obj:
+            self.obj = dict()
+
+        secret_raw = self.stateless_secret(token_id, session_id)
+        self.obj['token_id'] = token_id
+        self.obj['name'] = session_id
+        self.obj['secret_raw'] = secret_raw
+        self.obj['secret_encoded'] = base64.b64encode(secret_raw).decode()
+        self.obj['data'] = {'token_id': token_id, 'token_name': name}
+        self.obj['expires_at'] = expires
+
+        return self
+
     ############################################################################
     # pylint: disable=no-self-use
     @db_interface
@@ -1423,6 +2866,7 @@ class AuthSession(RCObject):
         self.obj['secret_raw'] = base64.b64decode(row[0])
         self.obj['secret_encoded'] = row[0]
         self.obj['data'] = json2data(row[1])
+        self.obj['expires_at'] = row[2]
 
         cache.set_cache('session', key, dict(expires=row[2], obj=self))
 
@@ -1441,6 +2885,166 @@ class AuthSession(RCObject):
              WHERE expires_at < ?
             """, time.time())
 
+################################################################################
+def changelog_record(dbi, table, target_id, name, action):
+    """add an entry to the ChangeLog"""
+    changelog_records(dbi, [(table, target_id, name or '', action)])
+
+def changelog_records(dbi, entries):
+    """
+    add (obj, target_id, name, action) entries to the ChangeLog, numbered
+    as the transaction commits (see ChangeLog)
+    """
+    def write(dbi):
+        """take the next seqs, holding ChangeSeq until the commit"""
+        dbi.do_count("UPDATE ChangeSeq SET seq = LAST_INSERT_ID(seq + ?) WHERE id = 1",
+                     len(entries))
+        last = int(dbi.do_getone("SELECT LAST_INSERT_ID()", output=list)[0])
+        args = list()
+        for seq, entry in enumerate(entries, last - len(entries) + 1):
+            args += [seq] + list(entry)
+        dbi.do_count("INSERT INTO ChangeLog (seq, obj, target_id, name, action) VALUES " +
+                     ",".join(["(?,?,?,?,?)"] * len(entries)), *args)
+    dbi.before_commit(write)
+
+################################################################################
+class ChangeLog(RCObject):
+    """
+    DROP> drop table if exists ChangeLog;
+     ADD> create table ChangeLog (
+     ADD>     seq bigint not null,
+     ADD>     obj varchar(32) not null,
+     ADD>     target_id int not null default 0,
+     ADD>     name varchar(64) not null default '',
+     ADD>     action enum('put', 'delete', 'reset') not null default 'put',
+     ADD>     updated_at timestamp not null,
+     ADD>     primary key(seq),
+     ADD>     index(updated_at)
+     ADD> ) engine=InnoDB;
+
+    DROP> drop table if exists ChangeSeq;
+     ADD> create table ChangeSeq (
+     ADD>     id tinyint not null,
+     ADD>     seq bigint not null,
+     ADD>     primary key(id)
+     ADD> ) engine=InnoDB;
+     ADD> INSERT INTO ChangeSeq SET id=1, seq=0;
+
+    A log of writes to the other tables, by a monotonic sequence (the token
+    given to clients).  Written in _put() and delete(), read by /_changes.
+
+    A seq is taken from the ChangeSeq row as the last work of the writing
+    transaction (changelog_records), whose row lock is held until it
+    commits.  So seqs are given out in commit order, a rollback gives its
+    seqs back, and readers never see a gap or a later seq before an earlier.
+    """
+
+    table = 'ChangeLog'
+    policy_map = False
+    exported = False
+    changelog = False
+
+    ############################################################################
+    @db_interface
+    def token(self, dbi=None):
+        """The current change token: the latest change"""
+        row = dbi.do_getone("SELECT max(seq) FROM ChangeLog", output=list)
+        return int(row[0] or 0) if row else 0
+
+    ############################################################################
+    # pylint: disable=too-many-arguments,too-many-locals
+    @db_interface
+    def changes(self, attrs, since, dbi=None, limit=1000, types=None):
+        """
+        Changes after the token since, as a dict of:
+
+            token   -- give as since on the next call
+            more    -- there are more changes after token (hit the limit)
+            reset   -- since is too old (pruned) or an import happened; the
+                       client should reload everything, and continue from token
+            changes -- list of the latest change for each object, with the
+                       object itself for puts.  Objects the caller may not
+                       read are left out.
+
+        types is an optional list of object types (as in the REST paths).
+        """
+        tables = dict([(table.table, table) for table in Schema.tables
+                       if table.changelog])
+        if types:
+            tables = dict([(table.table, table) for table in Schema.tables
+                           if table.changelog and table.__name__.lower() in types])
+
+        row = dbi.do_getone("SELECT min(seq), max(seq) FROM ChangeLog", output=list)
+        first, last = (int(row[0] or 0), int(row[1] or 0)) if row else (0, 0)
+        result = dict(token=since, more=False, reset=False, changes=list())
+        if since > last:
+            result['token'] = last
+            return result
+        if first and since < first - 1:
+            result['reset'] = True
+        elif dbi.do_getone("SELECT seq FROM ChangeLog WHERE seq > ? AND action = 'reset'",
+                           since, output=list):
+            result['reset'] = True
+        if result['reset']:
+            result['token'] = self.token(dbi=dbi)
+            return result
+
+        rows = dbi.do_getlist("""
+            SELECT seq, obj, target_id, name, action FROM ChangeLog
+             WHERE seq > ? ORDER BY seq LIMIT ?
+            """, since, limit)
+        if len(rows) >= limit:
+            result['more'] = True
+        if rows:
+            result['token'] = rows[-1][0]
+
+        # only the latest change to each object matters
+        latest = dict()
+        for seq, table, target_id, name, action in rows:
+            if table in tables:
+                latest[(table, target_id)] = (seq, name, action)
+
+        for (table, target_id), (seq, name, action) in sorted(latest.items(),
+                                                              key=lambda elem: elem[1][0]):
+            change = dict(seq=seq, type=tables[table].__name__.lower(),
+                          id=target_id, name=name, action=action)
+            if action == 'put':
+                obj = tables[table](master=self.master, reqid=self.reqid)
+                try:
+                    change['object'] = obj.get(target_id, attrs, dbi=dbi).dump()
+                except ObjectNotFound: # deleted since, a later entry has it
+                    continue
+                except PolicyFailed:
+                    continue
+            result['changes'].append(change)
+
+        return result
+
+    ############################################################################
+    @db_interface
+    def after(self, since, dbi=None, limit=1000):
+        """Raw entries after since, as a list of (seq, obj, target_id, action)"""
+        return dbi.do_getlist("""
+            SELECT seq, obj, target_id, action FROM ChangeLog
+             WHERE seq > ? ORDER BY seq LIMIT ?
+            """, since, limit)
+
+    ############################################################################
+    @db_interface
+    def reset(self, dbi=None):
+        """Note that everything changed (such as after an import)"""
+        changelog_record(dbi, '*', 0, '', 'reset')
+
+    ############################################################################
+    @db_interface
+    def prune(self, retention, dbi=None):
+        """Remove entries older than retention seconds, keeping the latest"""
+        last = self.token(dbi=dbi)
+        return dbi.do_count("""
+            DELETE FROM ChangeLog
+             WHERE updated_at < from_unixtime(?) AND seq < ?
+            """, int(time.time() - retention), last)
+
 ################################################################################
 class Policy(RCObject):
     # pylint: disable=line-too-long
@@ -1506,12 +3110,12 @@ class Policy(RCObject):
         if self.obj['result'] not in ('pass', 'fail'):
             raise InvalidParameter("Result may be only pass or fail")
         try:
-            compile(self.obj['policy'], '<policy>', 'eval')
+            abac.Expression(self.obj['policy'], '<policy>')
             # Future note: put in an eval here with mock data
         except SyntaxError as err:
             raise InvalidParameter("Cannot prepare policy: " + err.args[0] + "\n" +
                                    "Character {}: {}".format(err.offset, err.text))
-        except TypeError as err:
+        except (TypeError, InvalidPolicy) as err:
             raise InvalidParameter("Cannot prepare policy: " + str(err))
         return errors
 
@@ -1520,7 +3124,15 @@ class Policy(RCObject):
         # changes to parent matching self
         errors = super(Policy, self).changed(attrs, dbi=dbi)
 
-        self.master.cache.clear_type('policymap')
+        self.clear_cache(dbi, 'policymap')
+
+        return errors
+
+    #############################################################################
+    def changed_batch(self, attrs, objs, dbi=None):
+        errors = super(Policy, self).changed_batch(attrs, objs, dbi=dbi)
+
+        self.clear_cache(dbi, 'policymap')
 
         return errors
 
@@ -1531,7 +3143,7 @@ class Policy(RCObject):
 
         dbi.do_count("""DELETE FROM PolicyFor WHERE policy_id = ?""", self.obj['id'])
         dbi.do_count("""DELETE FROM Policyscope WHERE policy_id = ?""", self.obj['id'])
-        self.master.cache.clear_type('policymap')
+        self.clear_cache(dbi, 'policymap')
 
         return errors
 
@@ -1552,32 +3164,103 @@ def policyscope_get_direct(cache, dbi, mtype):
                         WHERE type = ?""", mtype)
     for row in cursor:
         pscope = row_to_dict(cursor, row)
-        pscope['ast'] = compile(pscope['matches'], '<scope ' + str(pscope['id']) + '>', "eval")
+        pscope['expr'] = policyscope_expr(pscope)
         scopelist.append(pscope)
     cursor.close()
 
     cache.set_cache('policyscope', mtype, scopelist)
     return scopelist
 
+################################################################################
+def policyscope_expr(pscope):
+    """compile the matches of a policyscope"""
+    return stored_expr(pscope['matches'], '<scope ' + str(pscope['id']) + '>')
+
+################################################################################
+def stored_expr(source, label):
+    """
+    compile a stored expression; one saved before a restriction was added
+    (which no longer compiles) never matches, rather than failing the load
+    """
+    try:
+        return abac.Expression(source, label)
+    except (SyntaxError, InvalidPolicy) as err:
+        log("type=error", msg="expression no longer valid: " + str(err), expr=label)
+        return abac.Expression("false", label)
+
 ################################################################################
 # pylint: disable=too-many-arguments
 def policyscope_map_for(pscope, dbi, attribs, table, target_id, debug=False):
     """"map policyscope objects into PolicyFor table"""
+    for row in policyscope_map_rows(pscope, attribs, table, target_id, debug=debug):
+        dbi.do_count("""REPLACE INTO PolicyFor
+                        SET obj = ?, policy_id = ?, target_id = ?,
+                            pscope_id = ?, action = ?
+                     """, *row)
+
+################################################################################
+def policyscope_map_sql(pscope, dbi, attribs, table, debug=False):
+    """
+    Map a targeted policyscope onto all matching rows of table, with one
+    statement per action, if its matches translate to SQL given attribs
+    (see abac.sql_predicate).  Returns False if they do not, and each row
+    must be evaluated with policyscope_map_for() instead.
+    """
+    objs = pscope.get('objects', [])
+    if objs and objs[0] != '*' and table not in objs:
+        return True
+    stats = abac.PROFILE.stat('scope', pscope['id'], pscope['matches'])
+    start = time.thread_time()
+    pred = abac.sql_predicate(pscope['matches'], attribs)
+    if pred is None:
+        return False
+    stats.add(start)
+    where, args = pred
+    if where == '0':
+        return True
+    for action in pscope['actions'].split(","):
+        count = dbi.do_count("""REPLACE INTO PolicyFor (obj, policy_id, target_id, pscope_id, action)
+                                SELECT ?, ?, id, ?, ? FROM """ + table + " WHERE " + where,
+                             table, pscope['policy_id'], pscope['id'], action, *args)
+        if debug:
+            log("type=policymap",
+                action=action,
+                table=table,
+                scope=pscope['id'],
+                policy=pscope['policy_id'],
+                where=where,
+                targets=count)
+    return True
+
+################################################################################
+def policyscope_map_rows(pscope, attribs, table, target_id, debug=False):
+    """
+    Evaluate a policyscope for one target, returning the PolicyFor rows
+    (obj, policy_id, target_id, pscope_id, action) it maps to.
+    """
+    rows = list()
     try:
-        # pylint: disable=eval-used
-        if not pscope.get('ast'):
-            pscope['ast'] = compile(pscope['matches'], '<scope ' + str(pscope['id']) + '>', "eval")
+        if not pscope.get('expr'):
+            pscope['expr'] = policyscope_expr(pscope)
 
         objs = pscope.get('objects', [])
         if objs:
             if objs[0] != '*' and attribs['obj_type'] not in objs:
-                return
+                return rows
 
 #        log("matches={} attrs={}".format(pscope['matches'], attribs))
 #        log("context={}".format(abac.abac_context()))
 #        log("attribs={}".format(attribs))
 
-        if eval(pscope['ast'], abac.abac_context(), attribs):
+        stats = abac.PROFILE.stat('scope', pscope['id'], pscope['matches'])
+        start = time.thread_time()
+        try:
+            matched = pscope['expr'].func(attribs)
+        except Exception:
+            stats.add(start, error=True)
+            raise
+        stats.add(start)
+        if matched:
             for action in pscope['actions'].split(","):
                 if debug:
                     log("type=policymap",
@@ -1586,15 +3269,11 @@ def policyscope_map_for(pscope, dbi, attribs, table, target_id, debug=False):
                         scope=pscope['id'],
                         policy=pscope['policy_id'],
                         target=target_id)
-                dbi.do_count("""REPLACE INTO PolicyFor
-                                SET obj = ?, policy_id = ?, target_id = ?,
-                                    pscope_id = ?, action = ?
-                             """, table, pscope['policy_id'], target_id,
-                             pscope['id'], action)
+                rows.append((table, pscope['policy_id'], target_id, pscope['id'], action))
 
     except Exception as err: # pylint: disable=broad-except
         if do_DEBUG("abac"):
-            context = dictlib.union(abac.abac_context(), attribs)
+            context = dictlib.union(dict(abac.abac_context()), attribs)
             log("type=error", msg="policymap failure: " + str(err),
                 expr=pscope.get('matches'),
                 context=context,
@@ -1607,6 +3286,7 @@ def policyscope_map_for(pscope, dbi, attribs, table, target_id, debug=False):
                 scope=pscope.get('id', 0),
                 policy=pscope.get('policy_id', 0),
                 target=target_id)
+    return rows
 
 ################################################################################
 class Policyscope(RCObject):
@@ -1693,12 +3373,12 @@ class Policyscope(RCObject):
     def validate(self):
         errors = super(Policyscope, self).validate()
         try:
-            compile(self.obj['matches'], '<matches>', 'eval')
+            abac.Expression(self.obj['matches'], '<matches>')
             # Future note: put in an eval here with mock data
         except SyntaxError as err:
             raise InvalidParameter("Cannot prepare match expression: " + err.args[0] +
                                    "\n" + "Character {}: {}".format(err.offset, err.text))
-        except TypeError as err:
+        except (TypeError, InvalidPolicy) as err:
             raise InvalidParameter("Cannot prepare match expression: " + str(err))
 
         if self.obj['type'].lower() not in ('targeted', 'global'):
@@ -1752,6 +3432,16 @@ class Policyscope(RCObject):
 
         return errors
 
+    #############################################################################
+    def changed_batch(self, attrs, objs, dbi=None):
+        errors = super(Policyscope, self).changed_batch(attrs, objs, dbi=dbi)
+
+        for obj in objs:
+            self.obj = obj
+            self.map_self(dbi=dbi)
+
+        return errors
+
     #############################################################################
     @db_interface
     def remap_all(self, dbi=None):
@@ -1769,7 +3459,7 @@ class Policyscope(RCObject):
             pscope.map_self(dbi=dbi, cache=cache, invalidate=False, groups=groups)
 
         # at the end
-        self.master.cache.clear_type('policymap')
+        self.clear_cache(dbi, 'policymap')
 
     #############################################################################
     # pylint: disable=too-many-branches,too-many-arguments
@@ -1803,6 +3493,11 @@ class Policyscope(RCObject):
                 if not table.policy_map:
                     continue
 
+                # set based, where the matches translate to SQL
+                attribs = dict(obj_type=table.table, groups=groups)
+                if policyscope_map_sql(self.obj, dbi, attribs, table.table, debug=debug):
+                    continue
+
                 tobj = table(master=self.master)
 
                 # build the list in memory, so we can re-use the cursor later
@@ -1829,7 +3524,7 @@ class Policyscope(RCObject):
 
         # invalidate all cached data for policy maps
         if invalidate:
-            self.master.cache.clear_type('policymap')
+            self.clear_cache(dbi, 'policymap')
 
 
     ############################################################################
@@ -1849,7 +3544,8 @@ class Schema(rfx.Base):
     # NOTE: update PolicyFor enum if adding to this list
     # also: order matters
     tables = [Policy, Policyscope, Pipeline, Service, Config, Instance, Apikey,
-              Build, Group, AuthSession, State]
+              Build, Group, AuthSession, State, ChangeLog, ConfigEdge, ServiceMember,
+              InstanceStatus]
     table_names = [x.__name__.lower() for x in tables]
     master = ''
 
@@ -1879,12 +3575,123 @@ class Schema(rfx.Base):
                     continue
                 dbi.dbc.cmd_query(stmt)
 
+    ############################################################################
+    def export_tables(self, archive=False):
+        """Names of the tables carried by export/import, optionally with archives"""
+        names = list()
+        for table in self.tables:
+            if not table.exported:
+                continue
+            names.append(table.table)
+            if archive and table.archive:
+                names.append(table.table + "Archive")
+        return names
+
+    ############################################################################
+    def export_class(self, name):
+        """The object class for an exported table (or its archive), or None"""
+        for table in self.tables:
+            if table.exported and name in (table.table, table.table + "Archive"):
+                return table
+        return None
+
+    ############################################################################
+    def export_rows(self, name, dbi):
+        """
+        Generator of the raw rows of a table, as dicts.  The cursor is
+        unbuffered, so rows stream from the server and memory stays bounded.
+        Values are as stored: encrypted values keep their __$ form.  A class
+        with export_prepare() may adjust its rows (not its archive's).
+        """
+        export_row = None
+        table = self.export_class(name)
+        if table and name == table.table and hasattr(table, 'export_prepare'):
+            export_row = table(master=self.master).export_prepare(dbi)
+        cursor = dbi.do("SELECT * FROM " + name)
+        try:
+            for row in cursor:
+                row = row_to_dict(cursor, row)
+                for key, value in row.items():
+                    if isinstance(value, datetime.datetime):
+                        row[key] = str(value)
+                if export_row:
+                    row = export_row(row)
+                yield row
+        finally:
+            # if we stopped early, dump the rest so the connection is clean
+            try:
+                cursor.fetchall()
+            except: # pylint: disable=bare-except
+                pass
+            cursor.close()
+
+    ############################################################################
+    # pylint: disable=no-self-use
+    def import_rows(self, name, rows, dbi, batch_size=500):
+        """
+        Load raw rows (as from export_rows) with REPLACE INTO, committing in
+        batches.  Existing rows with the same key are overwritten.  Archive
+        tables have no unique key, so should be imported into an empty db.
+
+        Returns the count of rows loaded.
+        """
+        count = 0
+        batch = list()
+
+        def flush(batch):
+            """store rows, grouped by their columns"""
+            bycols = dict()
+            for row in batch:
+                bycols.setdefault(tuple(sorted(row.keys())), []).append(row)
+            dbi.begin()
+            try:
+                for cols, group in bycols.items():
+                    for col in cols:
+                        if not re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', col):
+                            raise InvalidParameter("Invalid column name: " + col)
+                    values = "(" + ",".join(["?"] * len(cols)) + ")"
+                    dbi.do_count("REPLACE INTO " + name + " (" + ",".join(cols) + ") VALUES " +
+                                 ",".join([values] * len(group)),
+                                 *[row[col] for row in group for col in cols])
+                dbi.commit()
+            except:
+                dbi.rollback()
+                raise
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush(batch)
+                count += len(batch)
+                batch = list()
+        if batch:
+            flush(batch)
+            count += len(batch)
+
+        return count
+
+    ############################################################################
+    def import_finish(self):
+        """After an import: rebuild the policy maps and drop cached state"""
+        Policyscope(master=self.master).remap_all()
+        ConfigEdge(master=self.master).rebuild()
+        ServiceMember(master=self.master).rebuild()
+        status = InstanceStatus(master=self.master)
+        if not status.count(): # an export from before the table
+            status.rebuild()
+        ChangeLog(master=self.master).reset()
+        cache = self.master.cache
+        for ctype in ('policymap', 'policyscope', 'session', 'groups', 'flattened',
+                      'pwverify', 'jwt', 'apikey'):
+            cache.clear_type(ctype)
+
     ############################################################################
     # pylint: disable=unused-argument,too-many-branches
     @db_interface
     def initialize(self, dbi=None, verbose=False, reset=True):
         """Setup the database."""
         new_master = False
+        backfill = list()
 
         for obj in self.tables:
             desc = None
@@ -1897,6 +3704,8 @@ class Schema(rfx.Base):
 
             if obj.table == 'Apikey':
                 new_master = True
+            elif not reset and hasattr(obj, 'rebuild'):
+                backfill.append(obj) # derived from an existing database
 
             schema = []
 
@@ -1916,6 +3725,9 @@ class Schema(rfx.Base):
                     continue
                 dbi.dbc.cmd_query(stmt)
 
+        for obj in backfill:
+            obj(master=self.master).rebuild(dbi=dbi)
+
         if reset or new_master:
             if verbose:
                 self.NOTIFY("Initializing new master ..\n")
@@ -66,12 +66,14 @@ class DbSaveFailed(Exception):
 def db_interface(func):
     """
     Decorator to pull a db interface and send it onto the method as a named arg.
-    Returns the dbinterface after method closes.
+    Returns the dbinterface after method closes, if it was pulled here (one
+    handed in stays with the caller, who may be mid-transaction).
     """
     def dbi_wrapper(self, *args, **kwargs):
         """Decorator Wrapper"""
-        if 'dbi' not in kwargs or not kwargs['dbi']:
-            kwargs['dbi'] = self.master.connect()
+        if kwargs.get('dbi'):
+            return func(self, *args, **kwargs)
+        kwargs['dbi'] = self.master.connect()
         try:
             result = func(self, *args, **kwargs)
         finally:
@@ -153,6 +155,9 @@ class Master(rfx.Base):
     crypto = None
     default_key = None
     cache = None # optional memstate.Cache
+    pings = None # optional pings.PingBuffer
+    policyset = None # objects.PolicySet, current
+    rotation = None # rotate.KeyRotation, the current or last job
 
     ############################################################################
     # pylint: disable=super-init-not-called
@@ -57,24 +57,43 @@ class Cache(object):
 
     cache = None
     ctypes = None
+    depends = None
+    generations = None
+    limits = None
     lock = threading.Lock()
 
     ############################################################################
     def __init__(self, **kwargs):
         self.cache = dict()
         self.ctypes = dict()
+        self.depends = dict()
+        self.generations = dict()
+        self.limits = dict()
         config = {
-            'policy': 300,
             'policymap': 300,
             'policyscope': 300,
             'session': 300,
-            'groups': 300
+            'groups': 300,
+            'flattened': 300,
+            'pwverify': 60,
+            'jwt': 60,
+            'apikey': 60,
+            'decision': 0,
+            'plaintext': 300
+        }
+        limits = {
+            'pwverify': 4096,
+            'jwt': 8192,
+            'apikey': 4096,
+            'decision': 16384,
+            'plaintext': 4096
         }
         config.update(kwargs)
+        limits.update(config.pop('limits', None) or {})
         for ctype in config:
             if ctype == 'housekeeper':
                 continue
-            self.configure(ctype, config[ctype])
+            self.configure(ctype, config[ctype], limit=limits.get(ctype, 0))
         self._clean()
 
     ############################################################################
@@ -83,10 +102,12 @@ class Cache(object):
         timeinterval.start(interval * 1000, self._clean)
 
     ############################################################################
-    def configure(self, ctype, age):
-        """configure a parameter for cache"""
+    def configure(self, ctype, age, limit=0):
+        """configure a parameter for cache, optionally bounded to limit items"""
         self.ctypes[ctype] = age
+        self.limits[ctype] = limit
         self.cache[ctype] = dict()
+        self.depends[ctype] = dict()
 
     ############################################################################
     @mutex
@@ -101,12 +122,13 @@ class Cache(object):
         if not self.ctypes:
             return
         now = time.time()
-        for ctype in ['policy']: # self.ctypes:
+        for ctype in ['flattened', 'pwverify', 'jwt', 'apikey', 'decision',
+                      'plaintext']: # self.ctypes:
             keys = list(self.cache[ctype].keys()) # to avoid RuntimeError
             for key in keys:
                 item = self.cache[ctype].get(key)
                 if item and item['expires'] < now:
-                    del self.cache[ctype][key]
+                    self._drop(ctype, key)
 
     ############################################################################
     # pylint: disable=unused-argument
@@ -115,12 +137,80 @@ class Cache(object):
         """remove an item from the cache"""
         if self.cache[ctype].get(key):
 #DEBUG#            trace("CACHE REMOVE {} {}".format(ctype, key))
-            del self.cache[ctype][key]
+            self._drop(ctype, key)
 
     def clear_type(self, ctype):
         """remove an item from the cache"""
 #DEBUG#       trace("CACHE CLEAR {}".format(ctype))
         self.cache[ctype] = dict()
+        self.depends[ctype] = dict()
+        self.generations[ctype] = self.generations.get(ctype, 0) + 1
+
+    def generation(self, ctype):
+        """
+        changes with every invalidate() or clear_type(), so an item computed
+        while one happened can be left out (see set_cache)
+        """
+        return self.generations.get(ctype, 0)
+
+    ############################################################################
+    def _drop(self, ctype, key):
+        """remove an item and its dependency entries (call with the lock held)"""
+        item = self.cache[ctype].pop(key, None)
+        if item:
+            for dep in item.get('deps', []):
+                keys = self.depends[ctype].get(dep)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self.depends[ctype][dep]
+
+    ############################################################################
+    def _bound(self, ctype, now):
+        """
+        make room for one more item: drop expired items, then the oldest
+        (call with the lock held)
+
+        >>> cache = Cache(limits={'pwverify': 2})
+        >>> for key in ('a', 'b', 'c'):
+        ...     exp = cache.set_cache('pwverify', key, True)
+        >>> sorted(cache.cache['pwverify'].keys())
+        ['b', 'c']
+        """
+        items = self.cache[ctype]
+        if len(items) < self.limits[ctype]:
+            return
+        for key in [key for key, item in items.items() if item['expires'] < now]:
+            self._drop(ctype, key)
+        while len(items) >= self.limits[ctype]:
+            self._drop(ctype, next(iter(items)))
+
+    ############################################################################
+    @mutex
+    def invalidate(self, ctype, dep):
+        """
+        remove every item which was set with dep as one of its deps
+
+        >>> cache = Cache()
+        >>> exp = cache.set_cache('flattened', 'a', 1, deps=[1, 2])
+        >>> exp = cache.set_cache('flattened', 'b', 2, deps=[2, 3])
+        >>> cache.invalidate('flattened', 3)
+        ['b']
+        >>> cache.get_cache('flattened', 'a'), cache.get_cache('flattened', 'b')
+        (1, None)
+        >>> sorted(cache.depends['flattened'].keys())
+        [1, 2]
+        >>> gen = cache.generation('flattened')
+        >>> cache.invalidate('flattened', 1)
+        ['a']
+        >>> cache.set_cache('flattened', 'a', 1, deps=[1], generation=gen)
+        0
+        """
+        self.generations[ctype] = self.generations.get(ctype, 0) + 1
+        keys = list(self.depends[ctype].get(dep, []))
+        for key in keys:
+            self._drop(ctype, key)
+        return keys
 
     def get_cache(self, ctype, key, start=None):
         """get an item from the global mutex-safe cache"""
@@ -133,12 +223,27 @@ class Cache(object):
 #DEBUG#       trace("CACHE MISS {} {}".format(ctype, key))
         return None
 
+    # pylint: disable=too-many-arguments
     @mutex
-    def set_cache(self, ctype, key, value, base_time=None):
-        """Set an item in the global mutex-safe cache"""
+    def set_cache(self, ctype, key, value, base_time=None, deps=None, generation=None):
+        """
+        Set an item in the global mutex-safe cache.  If deps are given, the
+        item is also removed by invalidate() of any of them.  If generation is
+        given and it has changed since, the item is not set (returns 0).
+        """
+        if generation is not None and generation != self.generations.get(ctype, 0):
+            return 0
         if not base_time:
             base_time = time.time()
 #DEBUG#       trace("CACHE SET {} {}".format(ctype, key))
         expires = base_time + self.ctypes[ctype]
-        self.cache[ctype][key] = dict(expires=expires, value=value)
+        if self.limits.get(ctype) and key not in self.cache[ctype]:
+            self._bound(ctype, base_time)
+        if deps is not None:
+            self._drop(ctype, key)
+            for dep in deps:
+                self.depends[ctype].setdefault(dep, set()).add(key)
+            self.cache[ctype][key] = dict(expires=expires, value=value, deps=list(deps))
+        else:
+            self.cache[ctype][key] = dict(expires=expires, value=value)
         return expires
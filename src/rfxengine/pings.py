@@ -0,0 +1,189 @@
+#$#HEADER-START
+# vim:set expandtab ts=4 sw=4 ai ft=python:
+#
+#     Reflex Configuration Event Engine
+#
+#     Copyright (C) 2016 Brandon Gillespie
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU Affero General Public License as published
+#     by the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU Affero General Public License for more details.
+#
+#     You should have received a copy of the GNU Affero General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#$#HEADER-END
+
+"""
+Write-behind buffer for instance pings.
+
+Pings taking the fast path (Instance.ping) are held in memory, keeping only
+the latest per instance, and written with multi-row statements every
+interval seconds, or sooner once max_entries are waiting: InstanceStatus
+for all, and the Instance document for those where more than the hot
+fields changed.  Only the latter are recorded in the ChangeLog, so status
+heartbeats do not flood the change feed or wake watches.  Reads of an
+instance through this engine see a pending ping right away.
+
+Durability: a ping is acknowledged before it is written, so if the engine
+process dies, pings received since the last flush (at most one interval) are
+lost.  A clean shutdown flushes.  Each engine process has its own buffer, so
+another engine may read an instance up to one interval behind.
+"""
+
+import threading
+import time
+import traceback
+from rfxengine import log
+from rfxengine.db import objects as dbo
+
+################################################################################
+# pylint: disable=too-few-public-methods
+class Ping(object):
+    """One pending ping"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, obj_id, name, obj, data, updated_by):
+        self.obj_id = obj_id
+        self.name = name
+        self.obj = obj                # merged object, for reads
+        self.data = data              # encoded data column, or None if unchanged
+        self.updated_by = updated_by
+        self.updated_at = time.time()
+
+################################################################################
+class PingBuffer(object):
+    """
+    Coalesce pings per instance and flush them in batches.
+
+    >>> buf = PingBuffer(None)
+    >>> buf.add(4, 'tardis-1', {'status': 'new'}, '{}', '100')
+    >>> buf.add(4, 'tardis-1', {'status': 'ok'}, None, '100')
+    >>> buf.get(4).obj
+    {'status': 'ok'}
+    >>> len(buf.pending)
+    1
+    >>> buf.discard(4)
+    >>> buf.get(4)
+    """
+
+    def __init__(self, dbm, interval=1, max_entries=500):
+        self.dbm = dbm
+        self.interval = interval
+        self.max_entries = max_entries
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+
+    ############################################################################
+    def start(self):
+        """start the flush thread"""
+        self.running = True
+        thread = threading.Thread(target=self._run, name="pings")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    ############################################################################
+    def stop(self):
+        """stop the flush thread, writing what is pending"""
+        self.running = False
+        self.wakeup.set()
+        self.flush()
+
+    ############################################################################
+    # pylint: disable=too-many-arguments
+    def add(self, obj_id, name, obj, data, updated_by):
+        """hold a ping, replacing any pending one for the same instance"""
+        with self.lock:
+            prior = self.pending.get(obj_id)
+            if data is None and prior:
+                data = prior.data # keep a document change not yet written
+            self.pending[obj_id] = Ping(obj_id, name, obj, data, updated_by)
+            full = len(self.pending) >= self.max_entries
+        if full:
+            self.wakeup.set()
+
+    ############################################################################
+    def get(self, obj_id):
+        """the pending ping for an instance, or None"""
+        with self.lock:
+            return self.pending.get(obj_id)
+
+    ############################################################################
+    def discard(self, obj_id):
+        """drop a pending ping, as a full update of the instance supersedes it"""
+        with self.lock:
+            self.pending.pop(obj_id, None)
+
+    ############################################################################
+    def _run(self):
+        """thread body"""
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception: # pylint: disable=broad-except
+                log("error", traceback=traceback.format_exc())
+
+    ############################################################################
+    def flush(self):
+        """write pending pings, returning the count written"""
+        with self.lock:
+            if not self.pending:
+                return 0
+            pings = list(self.pending.values())
+            self.pending = dict()
+
+        # join against the rows, so an instance deleted meanwhile stays deleted,
+        # and one fully updated since the ping keeps that update
+        docs = [ping for ping in pings if ping.data is not None]
+        select = " UNION ALL ".join(["SELECT ? AS id, ? AS data, ? AS updated_by, ? AS ts"] *
+                                    len(docs))
+        args = list()
+        for ping in docs:
+            args += [ping.obj_id, ping.data, ping.updated_by, ping.updated_at]
+
+        dbi = self.dbm.connect()
+        dbi.begin()
+        try:
+            if docs:
+                dbi.do_count("UPDATE Instance i JOIN (" + select + ") p ON i.id = p.id" +
+                             "   SET i.data = p.data, i.updated_by = p.updated_by," +
+                             "       i.updated_at = FROM_UNIXTIME(p.ts)" +
+                             " WHERE i.updated_at <= FROM_UNIXTIME(p.ts)", *args)
+            alive = set([row[0] for row in dbi.do_getlist(
+                "SELECT id FROM Instance WHERE id IN (" + ",".join(["?"] * len(pings)) + ")",
+                *[ping.obj_id for ping in pings])])
+            dbo.InstanceStatus(master=self.dbm).store(
+                dbi, [dbo.InstanceStatus.row(ping.obj) for ping in pings
+                      if ping.obj_id in alive])
+            # only document changes go to the ChangeLog, not status heartbeats
+            changes = [('Instance', ping.obj_id, ping.name, 'put')
+                       for ping in docs if ping.obj_id in alive]
+            if changes:
+                dbo.changelog_records(dbi, changes)
+            dbi.commit()
+        except:
+            dbi.rollback()
+            self._requeue(pings)
+            raise
+        finally:
+            dbi.done()
+        return len(pings)
+
+    ############################################################################
+    def _requeue(self, pings):
+        """put back pings which failed to write, unless a newer one arrived"""
+        with self.lock:
+            for ping in pings:
+                if ping.obj_id not in self.pending:
+                    self.pending[ping.obj_id] = ping
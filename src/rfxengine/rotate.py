@@ -0,0 +1,313 @@
+#$#HEADER-START
+# vim:set expandtab ts=4 sw=4 ai ft=python:
+#
+#     Reflex Configuration Event Engine
+#
+#     Copyright (C) 2016 Brandon Gillespie
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU Affero General Public License as published
+#     by the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU Affero General Public License for more details.
+#
+#     You should have received a copy of the GNU Affero General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#$#HEADER-END
+
+"""
+Online re-encryption of stored values with the default crypto key, so that
+older keys can be retired after a rotation.
+
+Each table with encrypted columns, and its Archive, is streamed through an
+unbuffered cursor.  Values under another key are re-encrypted on a pool of
+worker threads and written back in batched transactions on a second
+connection, pausing between batches so live traffic is not starved.
+
+Rows in the live table are replaced (REPLACE INTO), rather than updated, so
+the archive triggers do not copy them, and only if unchanged since they were
+read.  A row changed meanwhile was written with the default key anyway.
+
+Progress is checkpointed per table (the id to resume from), so a job which
+failed or was stopped resumes where it left off when started again.  One
+which completed starts over from the beginning, for a later rotation.
+Running it again is harmless: values already under the default key are
+skipped.
+"""
+
+import time
+import threading
+import traceback
+import concurrent.futures
+import nacl.exceptions
+from rfx import json2data, json4store
+from rfxengine import log
+from rfxengine.db import objects as dbo
+from rfxengine.db.mxsql import row_to_dict
+
+################################################################################
+class KeyRotation(object):
+    """
+    Re-encrypt every stored value which is not under the default key.
+
+    >>> job = KeyRotation(None)
+    >>> job.status()['running'], job.status()['tables']
+    (False, {})
+    >>> job.start(batch_size=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: batch and workers must be positive, pause zero or more
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, dbm, batch_size=200, pause=0.1, workers=4):
+        self.dbm = dbm
+        self.batch_size = batch_size
+        self.pause = pause
+        self.workers = workers
+        self.tables = dict()    # name -> progress, including 'after' to resume from
+        self.running = False
+        self.stopping = False
+        self.complete = False   # did the last run go through every table?
+        self.started = 0
+        self.finished = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    ############################################################################
+    def start(self, batch_size=None, pause=None, workers=None):
+        """
+        run in a thread, with any parameters given, unless already running
+        (when the parameters are left alone); returns True if started
+        """
+        batch_size = self.batch_size if batch_size is None else int(batch_size)
+        pause = self.pause if pause is None else float(pause)
+        workers = self.workers if workers is None else int(workers)
+        if batch_size < 1 or pause < 0 or workers < 1:
+            raise ValueError("batch and workers must be positive, pause zero or more")
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.stopping = False
+            self.batch_size, self.pause, self.workers = batch_size, pause, workers
+            if self.complete: # start over, rather than resume past the end
+                self.tables = dict()
+                self.complete = False
+        thread = threading.Thread(target=self.run, name="rotate")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    ############################################################################
+    def stop(self):
+        """stop after the current batch, keeping the checkpoints"""
+        if self.running:
+            self.stopping = True
+
+    ############################################################################
+    def status(self):
+        """progress so far"""
+        return {
+            'running': self.running,
+            'key': self.dbm.default_key if self.dbm else None,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+            'tables': dict([(name, dict(progress)) for name, progress in self.tables.items()])
+        }
+
+    ############################################################################
+    def run(self):
+        """thread body: each table, then its archive"""
+        self.running = True
+        self.started = time.time()
+        self.finished = 0
+        self.error = None
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for table, cols in self.encrypted_tables():
+                    self._rotate(pool, table.table, cols, live=True)
+                    if table.archive:
+                        self._rotate(pool, table.table + "Archive", cols, live=False)
+                    if self.stopping:
+                        break
+            self.finished = time.time()
+            self.complete = not self.stopping
+            log("type=rotate", status="finished" if not self.stopping else "stopped",
+                tables=self.tables)
+        except Exception as err: # pylint: disable=broad-except
+            self.error = str(err)
+            log("error", traceback=traceback.format_exc())
+        finally:
+            self.running = False
+
+    ############################################################################
+    def encrypted_tables(self):
+        """(class, [encrypted columns]) for each table which has them"""
+        for table in dbo.Schema.tables:
+            obj = table(master=self.dbm)
+            cols = [(name, col.stored) for name, col in obj.omap.items() if col.encrypt]
+            if cols:
+                yield table, cols
+
+    ############################################################################
+    def reencrypt(self, value):
+        """
+        value under the default key, or None if it already is (or is not
+        encrypted); raises KeyError if its key is not configured, or
+        CryptoError if it is not the key the value was encrypted with
+        """
+        if not isinstance(value, str) or value[:3] != '__$':
+            return None
+        key_name = value[3:6]
+        default = self.dbm.default_key
+        if key_name in (default, '___'):
+            return None
+        crypto = self.dbm.crypto
+        plain = crypto[key_name]['cipher'].key_decrypt(value[6:])
+        return '__$' + default + crypto[default]['cipher'].key_encrypt(plain)
+
+    ############################################################################
+    def _row(self, row, cols):
+        """(row, changes) where changes are the new stored columns, or None"""
+        changes = dict()
+        data = None
+        for name, stored in cols:
+            if stored == 'data':
+                if data is None:
+                    data = json2data(row['data']) if row.get('data') else dict()
+                value = self.reencrypt(data.get(name))
+                if value:
+                    data[name] = value
+                    changes['data'] = data
+            else:
+                value = self.reencrypt(row.get(stored))
+                if value:
+                    changes[stored] = value
+        if 'data' in changes:
+            changes['data'] = json4store(changes['data'])
+        return row, changes or None
+
+    ############################################################################
+    # pylint: disable=too-many-locals
+    def _rotate(self, pool, name, cols, live):
+        """stream one table, writing changed rows in batches"""
+        progress = self.tables.setdefault(name, dict(after=0, scanned=0, rotated=0,
+                                                     changed=0, failed=0))
+        columns = sorted(set(['id'] + [stored for _, stored in cols]))
+        if not live:
+            columns.append('updated_at')
+        stored_cols = sorted(set([stored for _, stored in cols]))
+        where = " OR ".join([col + " LIKE ?" for col in stored_cols])
+
+        dbi = self.dbm.connect()
+        dbi2 = self.dbm.connect()
+        try:
+            # resume from the checkpoint; an archive may have several rows per id
+            cursor = dbi.do("SELECT " + ",".join(columns) + " FROM " + name +
+                            " WHERE id >= ? AND (" + where + ") ORDER BY id",
+                            progress['after'], *([r'%\_\_$%'] * len(stored_cols)))
+            batch = list()
+            try:
+                for row in cursor:
+                    batch.append(row_to_dict(cursor, row))
+                    if len(batch) >= self.batch_size:
+                        self._batch(pool, dbi2, name, cols, batch, live, progress)
+                        batch = list()
+                        if self.stopping:
+                            break
+                        time.sleep(self.pause)
+                if batch and not self.stopping:
+                    self._batch(pool, dbi2, name, cols, batch, live, progress)
+            finally:
+                try:
+                    cursor.fetchall()
+                except: # pylint: disable=bare-except
+                    pass
+                cursor.close()
+        finally:
+            dbi2.done()
+            dbi.done()
+
+    ############################################################################
+    # pylint: disable=too-many-arguments
+    def _batch(self, pool, dbi, name, cols, batch, live, progress):
+        """re-encrypt a batch on the pool and write it in one transaction"""
+        results = list()
+        for row in batch:
+            results.append(pool.submit(self._row, row, cols))
+        todo = list()
+        for result in results:
+            try:
+                row, changes = result.result()
+            except (KeyError, nacl.exceptions.CryptoError):
+                progress['failed'] += 1 # its key is missing or wrong, leave it
+                continue
+            if changes:
+                todo.append((row, changes))
+
+        dbi.begin()
+        try:
+            if live:
+                self._write_live(dbi, name, todo, progress)
+            else:
+                self._write_archive(dbi, name, todo, progress)
+            dbi.commit()
+        except:
+            dbi.rollback()
+            raise
+        progress['scanned'] += len(batch)
+        progress['after'] = batch[-1]['id']
+
+    ############################################################################
+    @staticmethod
+    def _write_live(dbi, name, todo, progress):
+        """replace rows still as they were read"""
+        if not todo:
+            return
+        ids = [row['id'] for row, _ in todo]
+        cursor = dbi.do("SELECT * FROM " + name + " WHERE id IN (" +
+                        ",".join(["?"] * len(ids)) + ") FOR UPDATE", *ids)
+        current = dict()
+        for row in cursor:
+            row = row_to_dict(cursor, row)
+            current[row['id']] = row
+        cursor.close()
+
+        rows = list()
+        for row, changes in todo:
+            now = current.get(row['id'])
+            if not now or any([now[col] != row[col] for col in changes]):
+                progress['changed'] += 1
+                continue
+            now.update(changes)
+            rows.append(now)
+        if not rows:
+            return
+        cols = sorted(rows[0].keys())
+        values = "(" + ",".join(["?"] * len(cols)) + ")"
+        dbi.do_count("REPLACE INTO " + name + " (" + ",".join(cols) + ") VALUES " +
+                     ",".join([values] * len(rows)),
+                     *[row[col] for row in rows for col in cols])
+        progress['rotated'] += len(rows)
+
+    ############################################################################
+    @staticmethod
+    def _write_archive(dbi, name, todo, progress):
+        """update archived rows in place (archives have no triggers)"""
+        for row, changes in todo:
+            sets = sorted(changes.keys())
+            count = dbi.do_count("UPDATE " + name + " SET " +
+                                 ", ".join([col + " = ?" for col in sets]) +
+                                 " WHERE id = ? AND updated_at = ? AND " +
+                                 " AND ".join([col + " = ?" for col in sets]),
+                                 *([changes[col] for col in sets] +
+                                   [row['id'], row['updated_at']] +
+                                   [row[col] for col in sets]))
+            progress['rotated'] += count
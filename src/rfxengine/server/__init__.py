@@ -28,9 +28,11 @@ plus basic REST handlers.
 #import logging # for testing
 import re
 import time
+import threading
 import traceback
 import random
 import cherrypy
+from cherrypy.lib import jsontools
 from rfxengine import json2data, log, do_DEBUG, set_DEBUG#, trace
 from rfxengine import exceptions
 
@@ -44,12 +46,155 @@ def secureheaders():
 
 cherrypy.tools.secureheaders = cherrypy.Tool('before_finalize', secureheaders, priority=60)
 
+################################################################################
+NDJSON = 'application/x-ndjson'
+JSON_TYPES = ['application/json', 'text/javascript', NDJSON]
+
+def json_processor(entity):
+    """
+    json_in processor which leaves NDJSON bodies unread, so bulk handlers
+    can stream them a line at a time from cherrypy.request.body
+    """
+    if entity.content_type.value == NDJSON:
+        return
+    jsontools.json_processor(entity)
+
 ###############################################################################
 # I like this as server.Error, this is why it isn't in exceptions
 class Error(Exception):
     """Return an HTTP Error"""
     pass
 
+################################################################################
+class Tarpit(object):
+    """
+    Escalating backoff after authentication failures, per client key (the
+    source address, and the apikey or token whose signature failed).  Past
+    a few free failures, each one doubles how long the key is refused: a
+    failure in that time is answered 429 with Retry-After, rather than
+    holding a worker thread asleep.  Only failures are refused, so a
+    client whose credentials verify is never locked out by another
+    sending bad ones under its address or token.  Keys are forgotten once
+    idle.
+
+    >>> pit = Tarpit(grace=2, base=1, limit=4)
+    >>> [pit.failed(['ip:a'], now=100) for _ in range(0, 5)]
+    [0, 0, 1, 2, 4]
+    >>> pit.blocked(['ip:b', 'ip:a'], now=103)
+    1
+    >>> pit.blocked(['ip:a'], now=104)
+    0
+    >>> pit.blocked(['ip:a'], now=104 + pit.forget) or len(pit.table)
+    0
+    >>> pit.configure(proxies=['10.0.0.1'])
+    >>> pit.client_ip('10.0.0.9', '6.6.6.6')
+    '10.0.0.9'
+    >>> pit.client_ip('10.0.0.1', '6.6.6.6, 192.0.2.7, 10.0.0.1')
+    '192.0.2.7'
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, grace=3, base=1, limit=60, forget=600, size=16384, proxies=None):
+        self.table = dict() # key -> [failures, refused until, last failure]
+        self.lock = threading.Lock()
+        self.configure(grace=grace, base=base, limit=limit, forget=forget, size=size,
+                       proxies=proxies)
+
+    ############################################################################
+    # pylint: disable=too-many-arguments,attribute-defined-outside-init
+    def configure(self, grace=3, base=1, limit=60, forget=600, size=16384, proxies=None):
+        """change the settings"""
+        self.grace = grace
+        self.base = base
+        self.limit = limit
+        self.forget = forget
+        self.size = size
+        self.proxies = frozenset(proxies or [])
+
+    ############################################################################
+    def client_ip(self, remote, forwarded=None):
+        """
+        the client address: the peer, unless it is a trusted proxy, when
+        X-Forwarded-For is read from the right, past any other trusted proxies
+        """
+        if remote not in self.proxies or not forwarded:
+            return remote
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        while hops and hops[-1] in self.proxies:
+            hops.pop()
+        return hops[-1] if hops else remote
+
+    ############################################################################
+    def failed(self, keys, now=None):
+        """record a failure for each key, returns the seconds now refused"""
+        now = now or time.time()
+        delay = 0
+        with self.lock:
+            if len(self.table) >= self.size:
+                self._prune(now)
+            for key in keys:
+                entry = self.table.get(key)
+                if not entry or entry[2] + self.forget < now:
+                    entry = self.table[key] = [0, 0, now]
+                entry[0] += 1
+                entry[2] = now
+                if entry[0] > self.grace:
+                    wait = min(self.base * 2 ** (entry[0] - self.grace - 1), self.limit)
+                    entry[1] = now + wait
+                    delay = max(delay, wait)
+        return delay
+
+    ############################################################################
+    def blocked(self, keys, now=None):
+        """seconds until the keys are accepted again, 0 if they are"""
+        if not self.table:
+            return 0
+        now = now or time.time()
+        wait = 0
+        with self.lock:
+            for key in keys:
+                entry = self.table.get(key)
+                if not entry:
+                    continue
+                if entry[2] + self.forget < now:
+                    del self.table[key]
+                elif entry[1] > now:
+                    wait = max(wait, entry[1] - now)
+        return int(wait + 0.999)
+
+    ############################################################################
+    def _prune(self, now):
+        """drop idle keys, then the oldest half if still full"""
+        for key in [key for key, entry in self.table.items() if entry[2] + self.forget < now]:
+            del self.table[key]
+        if len(self.table) >= self.size:
+            oldest = sorted(self.table.items(), key=lambda item: item[1][2])
+            for key, _ in oldest[0:len(oldest) // 2 + 1]:
+                del self.table[key]
+
+TARPIT = Tarpit()
+
+def client_keys():
+    """
+    tarpit keys for the current request: its source address, and the apikey
+    or token named by signature_failed(), if any
+    """
+    request = cherrypy.serving.request
+    keys = ['ip:' + TARPIT.client_ip(request.remote.ip,
+                                     request.headers.get('X-Forwarded-For'))]
+    token = getattr(request, 'tarpit_token', None)
+    if token:
+        keys.append(token)
+    return keys
+
+def signature_failed(header, jti):
+    """
+    the credential in header names a real apikey or session, but its signature
+    did not verify: count the failure against jti as well as the address (an
+    unverified jti is not, as anyone may send one)
+    """
+    cherrypy.serving.request.tarpit_token = header + ':' + jti
+
 ################################################################################
 # random id
 def uniqueid():
@@ -84,12 +229,28 @@ class Rest(object):
     # pylint: disable=no-self-use
     def respond_failure(self, message, status=400):
         """Respond with a failure"""
-        if status == 401:
-            time.sleep(5) # Future: could add to memcache and increase logarithmically?
+        if status == 401 and self._tarpit():
+            raise Error("Too Many Requests", 429)
         if not message:
             raise Error("Failure", status)
         raise Error(message, status)
 
+    ###########################################################################
+    # pylint: disable=no-self-use
+    def _tarpit(self):
+        """
+        an authentication failure: refuse this client a while, if repeated.
+        Returns the seconds it was already refused for, when this failure
+        is to be answered 429 rather than 401.
+        """
+        keys = client_keys()
+        wait = TARPIT.blocked(keys)
+        delay = TARPIT.failed(keys)
+        if delay:
+            cherrypy.response.headers['Retry-After'] = str(delay)
+            log("tarpit", client=keys, retry=delay)
+        return wait
+
     ###########################################################################
     # pylint: disable=dangerous-default-value,unused-argument,no-self-use
     def respond(self, content, status=200):
@@ -113,6 +274,9 @@ class Rest(object):
             return getattr(self, method)(*args, **kwargs)
         except exceptions.AuthFailed as err:
             log("authfail", reason=err.args[1])
+            if self._tarpit():
+                cherrypy.response.status = 429
+                return {"status": "failed", "message": "Too Many Requests"}
             cherrypy.response.status = 401
             return {"status": "failed", "message": "Unauthorized"}
 
@@ -147,7 +311,7 @@ class Rest(object):
     ###########################################################################
     # could decorate these, but .. this is shorter code
     #@cherrypy.tools.accept(media='application/json')
-    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_in(content_type=JSON_TYPES, processor=json_processor)
     @cherrypy.tools.json_out()
     def POST(self, *args, **kwargs):
         """Wrapper for REST calls"""
@@ -29,6 +29,8 @@ import rfxengine.memstate
 import rfxengine.server.endpoints as endpoints
 import rfxengine.db.objects as dbo
 import rfxengine.db.mxsql as mxsql
+import rfxengine.watch as watch
+import rfxengine.pings as pings
 
 ################################################################################
 # pylint: disable=protected-access
@@ -135,6 +137,7 @@ class Server(rfx.Base):
                        next_report=0, last_rusage=None)
     mgr = None
     cherry = None
+    watcher = None
 
     def __init__(self, *args, **kwargs):
         super(Server, self).__init__(*args, **kwargs)
@@ -192,6 +195,8 @@ class Server(rfx.Base):
             "dbr":self.stat.dbm.dead,
             "threads":threading.active_count()
         }
+        if self.dbm.pings:
+            report['pings'] = len(self.dbm.pings.pending)
 
         self.stat.last_rusage = cur
         self.stat.next_report = self.stat.heartbeat.last + self.conf['status_report']
@@ -260,7 +265,13 @@ class Server(rfx.Base):
                 'housekeeper': 60,
                 'policies': 300,
                 'sessions': 300,
-                'groups': 300
+                'groups': 300,
+                'flattened': 300,
+                'pwverify': 60, # verified group passwords (never the password)
+                'jwt': 60, # verified api tokens, held until their exp at most
+                'apikey': 60, # apikey secrets for /token, dropped on apikey changes
+                'decision': 0, # read decisions per token across requests, 0 is off
+                'plaintext': 300 # decrypted values, by ciphertext digest
             },
             'crypto': {
 # pylint: disable=bad-continuation
@@ -275,7 +286,38 @@ class Server(rfx.Base):
                 'user': 'root'
             },
             'auth': {
-                'expires': 300
+                'expires': 300,
+                # sessions are not stored, but signed with the default crypto
+                # key, so any engine validates them without the database
+                'stateless': False
+            },
+            'changelog': {
+                'retention': 604800 # one week
+            },
+            'pings': {
+                # write-behind for instance pings: a crash loses up to interval
+                'buffer': False,
+                'interval': 1,
+                'max_entries': 500
+            },
+            'watch': {
+                'port': 0, # long-poll watches are off unless a port is given
+                # plain HTTP with bearer tickets: serve other hosts through a
+                # TLS proxy (given as url), rather than binding publicly
+                'host': '127.0.0.1',
+                'url': '' # as seen by clients, if behind a proxy
+            },
+            'tarpit': {
+                # after grace auth failures, a client (by address, and by apikey
+                # or token) is refused for base seconds, doubling up to limit
+                'grace': 3,
+                'base': 1,
+                'limit': 60,
+                'forget': 600, # seconds idle before failures are forgotten
+                'size': 16384,
+                # addresses of proxies trusted to set X-Forwarded-For; from
+                # anyone else, the header is ignored
+                'proxies': []
             }
         }
 
@@ -332,6 +374,15 @@ class Server(rfx.Base):
         self.dbm.cache = rfxengine.memstate.Cache(**conf.cache.__export__())
         self.dbm.cache.start_housekeeper(conf.cache.housekeeper)
 
+        # auth failure backoff
+        rfxengine.server.TARPIT.configure(**conf.tarpit.__export__())
+
+        # buffer instance pings
+        if conf.pings.buffer:
+            self.dbm.pings = pings.PingBuffer(self.dbm, interval=conf.pings.interval,
+                                              max_entries=conf.pings.max_entries).start()
+            cherrypy.engine.subscribe('stop', self.dbm.pings.stop)
+
         # schema
         schema = dbo.Schema(master=self.dbm)
         schema.initialize(verbose=False, reset=False)
@@ -367,6 +418,18 @@ class Server(rfx.Base):
 
         timeinterval.start(conf.refresh_maps * 1000, check_policymaps, self.dbm)
 
+        # drop old change feed entries
+        def prune_changes(dbm):
+            """periodically called to purge old entries from the change log"""
+            dbo.ChangeLog(master=dbm).prune(conf.changelog.retention)
+
+        timeinterval.start(3600 * 1000, prune_changes, self.dbm)
+
+        # long-poll watch server
+        if conf.watch.port:
+            self.watcher = watch.Watcher(self.dbm, int(conf.watch.port),
+                                         host=conf.watch.host).start()
+
         # mount routes
         cherrypy.tree.mount(endpoints.Health(conf, server=self),
                             conf.server.route_base + "/health",
@@ -417,6 +480,21 @@ class Server(rfx.Base):
         cherrypy.tree.mount(endpoints.InstancePing(conf, server=self),
                             conf.server.route_base + "/instance-ping",
                             endpoint_conf)
+        cherrypy.tree.mount(endpoints.Export(conf, server=self),
+                            conf.server.route_base + "/_export",
+                            endpoint_conf)
+        cherrypy.tree.mount(endpoints.Import(conf, server=self),
+                            conf.server.route_base + "/_import",
+                            endpoint_conf)
+        cherrypy.tree.mount(endpoints.Changes(conf, server=self),
+                            conf.server.route_base + "/_changes",
+                            endpoint_conf)
+        cherrypy.tree.mount(endpoints.AbacProfile(conf, server=self),
+                            conf.server.route_base + "/_abac",
+                            endpoint_conf)
+        cherrypy.tree.mount(endpoints.Rotate(conf, server=self),
+                            conf.server.route_base + "/_rotate",
+                            endpoint_conf)
 #        cherrypy.tree.mount(endpoints.Compose(conf, server=self),
 #                            conf.server.route_base + "/compose",
 #                            endpoint_conf)
@@ -7,20 +7,26 @@
 Endpoints for Reflex Engine API
 """
 
+import gzip
+import zlib
 import time
 import base64
+import hashlib
+import hmac
 import traceback
 import re
 import cherrypy
 import jwt
 import nacl.pwhash
 import nacl.exceptions
+import nacl.utils
 import dictlib
-from rfx import json2data#, json4human#, json4store #, json2data
+from rfx import json2data, json4store#, json4human
 from rfxengine import log, get_jti#, trace
 from rfxengine import server # pylint: disable=cyclic-import
 from rfxengine import abac
 from rfxengine.db import objects as dbo
+from rfxengine import rotate
 from rfxengine import exceptions
 
 ################################################################################
@@ -38,6 +44,52 @@ def get_json_body():
         return json2data(body)
     return body
 
+################################################################################
+# per process, so digests of passwords are of no use outside of it
+PWVERIFY_KEY = nacl.utils.random(32)
+
+def pw_verify(cache, pwhash, pwd):
+    """
+    scrypt verify of a password against a group hash (both bytes).  Successes
+    are remembered briefly, keyed by the hash and a keyed digest of the
+    password (never the password itself).  Group changes clear them.
+    """
+    key = (pwhash, hmac.new(PWVERIFY_KEY, pwd, hashlib.sha256).digest())
+    if cache and cache.get_cache('pwverify', key):
+        return True
+    try:
+        if not nacl.pwhash.verify_scryptsalsa208sha256(pwhash, pwd):
+            return False
+    except nacl.exceptions.InvalidkeyError:
+        return False
+    if cache:
+        cache.set_cache('pwverify', key, True)
+    return True
+
+################################################################################
+def get_ndjson_body():
+    """
+    Helper to iterate bulk content as (line number, object).  NDJSON is read a
+    line at a time from the request body; a JSON array is also accepted.
+    Lines which do not decode are given as the ValueError instead.
+    """
+    body = getattr(cherrypy.request, 'json', None)
+    if body is not None:
+        if not isinstance(body, list):
+            raise server.Error("Bulk content must be NDJSON or a JSON array", 400)
+        for lineno, data in enumerate(body, 1):
+            yield lineno, data
+        return
+
+    for lineno, line in enumerate(cherrypy.request.body, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield lineno, json2data(line.decode())
+        except ValueError as err:
+            yield lineno, err
+
 ################################################################################
 class Attributes(abac.AuthService): # gives us self.auth_fail
     """
@@ -58,9 +110,12 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
 
     ############################################################################
     def abac_gather(self):
-        """Gather attributes"""
+        """
+        Gather attributes.  Costly ones (headers, groups) are lazy, and only
+        computed if a policy reads them.
+        """
 
-        attrs = abac.attrs_skeleton()
+        attrs = abac.lazy_attrs()
 
         # future: figure out a plugin framework for this
         self._abac_token(attrs)
@@ -78,7 +133,8 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
         """http headers as dictobj"""
 
         # Note: Lowercase keys option to dictlib?
-        attrs['http_headers'] = dictlib.Obj(cherrypy.request.headers)
+        headers = cherrypy.request.headers
+        attrs.lazy('http_headers', lambda: dictlib.Obj(headers))
 
     def _user_login(self, attrs):
         """conventional user login"""
@@ -112,13 +168,26 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
 
         try:
             jwt_token = cherrypy.request.headers['X-ApiToken']
-            token_name = get_jti(jwt_token)
             session = cherrypy.request.cookie.get('sid', None)
             if not session:
                 self.auth_fail("No session defined")
             session_id = session.value
+
+            # clients reuse a JWT for its lifetime: skip verifying it again
+            cache = self.server.dbm.cache
+            key = (session_id, hashlib.sha256(jwt_token.encode()).digest())
+            known = cache.get_cache('jwt', key)
+            if known and known['expires'] > time.time():
+                attrs['token_nbr'] = known['token_nbr']
+                attrs['token_name'] = known['token_name']
+                return
+
+            token_name = get_jti(jwt_token)
             auth_session = dbo.AuthSession(master=self.server.dbm)
-            auth_session = auth_session.get_session(token_name, session_id)
+            if self.server.conf.auth.stateless and session_id[:2] == "s.":
+                auth_session = auth_session.get_stateless(token_name, session_id)
+            else:
+                auth_session = auth_session.get_session(token_name, session_id)
             if not auth_session:
                 self.auth_fail("Session not found")
 
@@ -134,6 +203,7 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
                     self.auth_fail("JWT expired")
 
             if not jwt_data:
+                server.signature_failed('X-ApiToken', token_name)
                 self.auth_fail("JWT cannot be decoded")
             if not jwt_data.get('exp'):
                 self.auth_fail("JWT missing expiration")
@@ -144,6 +214,10 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
             # nbr instead of id, to avoid confusion with token_uuid
             attrs['token_nbr'] = auth_session.obj['data']['token_id'] # pylint: disable=no-member
             attrs['token_name'] = auth_session.obj['data']['token_name'] # pylint: disable=no-member
+            cache.set_cache('jwt', key, dict(
+                expires=min(jwt_data['exp'], auth_session.obj['expires_at']),
+                token_nbr=attrs['token_nbr'],
+                token_name=attrs['token_name']))
 
         except exceptions.AuthFailed:
             raise
@@ -155,15 +229,16 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
     ############################################################################
     # pylint: disable=no-self-use, unused-argument
     def _groups(self, attrs):
-        """http headers as dictobj"""
+        """groups (loaded when first read), and the pwin/pwsin helpers"""
 
-        groups = dbo.Group(master=self.server.dbm).get_for_attrs()
+        dbm = self.server.dbm
+        cache = dbm.cache
 
         # inline method
         def pwin(hdrs, ingrp):
             """closure for single password input in as X-Password"""
             try:
-                grp = groups.get(ingrp)
+                grp = attrs['groups'].get(ingrp)
                 hdr = hdrs.get('X-Password')
                 if not hdr:
                     log("Missing X-Password header, try adding --password", type="error")
@@ -173,12 +248,8 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
                     log("policy cannot find group={}".format(grp), type="error")
                 else:
                     for pwhash in grp:
-                        pwhash = pwhash.encode()
-                        try:
-                            if nacl.pwhash.verify_scryptsalsa208sha256(pwhash, pwd):
-                                return True
-                        except nacl.exceptions.InvalidkeyError:
-                            pass
+                        if pw_verify(cache, pwhash.encode(), pwd):
+                            return True
             except Exception as err: # pylint: disable=broad-except
                 log("pwin() error=" + str(err), type="error")
             return False
@@ -188,7 +259,7 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
             """closure for multiple passwords input in as X-Passwords"""
             # pylint: disable=too-many-nested-blocks
             try:
-                grp = groups.get(ingrp)
+                grp = attrs['groups'].get(ingrp)
                 hdr = hdrs.get('X-Passwords')
                 if not hdr:
                     log("Missing X-Passwords header, try adding --password --password",
@@ -205,19 +276,15 @@ class Attributes(abac.AuthService): # gives us self.auth_fail
                     for pwhash in grp:
                         pwhash = pwhash.encode()
                         for pwd in pwds:
-                            pwd = pwd.encode()
-                            try:
-                                if nacl.pwhash.verify_scryptsalsa208sha256(pwhash, pwd):
-                                    matches += 1
-                                    if matches == len(pwds):
-                                        return True
-                            except nacl.exceptions.InvalidkeyError:
-                                pass
+                            if pw_verify(cache, pwhash, pwd.encode()):
+                                matches += 1
+                                if matches == len(pwds):
+                                    return True
             except Exception as err: # pylint: disable=broad-except
                 log("pwsin() error=" + str(err), type="error")
             return False
 
-        attrs['groups'] = groups
+        attrs.lazy('groups', lambda: dbo.Group(master=dbm).get_for_attrs())
         attrs['pwin'] = pwin
         attrs['pwsin'] = pwsin
 
@@ -275,28 +342,26 @@ class Token(server.Rest, abac.AuthService):
         try:
             jwt_apikey = cherrypy.request.headers['X-ApiKey']
             token_id = get_jti(jwt_apikey)
+            token = dbo.Apikey(master=self.server.dbm)
             try:
-                token = dbo.Apikey(master=self.server.dbm).get(token_id, True)
+                secrets = token.login_secrets(token_id)
             except dbo.ObjectNotFound:
                 return self.auth_fail("Apikey not found")
 
             # validate base on array of secrets
             jwt_data = None
-            for secret_raw in token.obj.get('secrets', []):
-                # there is a problem with binary secrets across language bases
-                for secret in (secret_raw, base64.b64decode(secret_raw)):
-                    try:
-                        # pylint: disable=no-member
-                        jwt_data = jwt.decode(jwt_apikey, secret)
-                        break
-                    except jwt.exceptions.DecodeError:
-                        continue
-                    except jwt.exceptions.ExpiredSignatureError: # pylint: disable=no-member
-                        self.auth_fail("JWT expired")
-                if jwt_data:
+            for secret in secrets:
+                try:
+                    # pylint: disable=no-member
+                    jwt_data = jwt.decode(jwt_apikey, secret)
                     break
+                except jwt.exceptions.DecodeError:
+                    continue
+                except jwt.exceptions.ExpiredSignatureError: # pylint: disable=no-member
+                    self.auth_fail("JWT expired")
 
             if not jwt_data:
+                server.signature_failed('X-ApiKey', token_id)
                 self.auth_fail("JWT cannot be decoded")
             if not jwt_data.get('exp'):
                 self.auth_fail("JWT missing expiration")
@@ -312,10 +377,13 @@ class Token(server.Rest, abac.AuthService):
             expires_at = time.time() + self.server.conf.auth.expires
 
             auth_session = dbo.AuthSession(master=self.server.dbm)
-            auth_session.new_session(token, expires_at, {
-                'token_id': token.obj['id'],
-                'token_name': token.obj['name']
-            })
+            if self.server.conf.auth.stateless:
+                auth_session.new_stateless(token, expires_at)
+            else:
+                auth_session.new_session(token, expires_at, {
+                    'token_id': token.obj['id'],
+                    'token_name': token.obj['name']
+                })
 
             cookie = cherrypy.response.cookie
             cookie['sid'] = auth_session.obj['session_id']
@@ -348,6 +416,7 @@ class Object(server.Rest, Attributes):
     General object interface
     """
     obj = ''
+    bulk_batch = 500
 
     def __init__(self, *args, **kwargs):
         self.obj = getattr(dbo, kwargs['obj'].capitalize())
@@ -407,9 +476,46 @@ class Object(server.Rest, Attributes):
 
         else:
             target = args[0]
+            if len(args) > 1 and args[1] == '_watch':
+                return self._rest_watch(obj, target, attrs)
+            if len(args) > 1 and args[1] == '_flattened' and self.obj == dbo.Config:
+                try:
+                    return self.respond(obj.flatten(target, attrs))
+                except dbo.ObjectNotFound as err:
+                    self.respond_failure({"status":"failed", "message": str(err)}, status=404)
+                except TypeError as err: # merging mismatched values
+                    self.respond_failure({"status":"failed", "message": str(err)}, status=400)
+            if len(args) > 1 and args[1] == '_members' and self.obj == dbo.Service:
+                try:
+                    obj.get(target, attrs)
+                except dbo.ObjectNotFound as err:
+                    self.respond_failure({"status":"failed", "message": str(err)}, status=404)
+                return self.respond(dict([(key, obj.obj.get(key, []))
+                                          for key in dbo.ServiceMember.kinds]))
+            if len(args) > 1 and args[1] in ('_ancestors', '_descendants') \
+               and self.obj == dbo.Config:
+                try:
+                    return self.respond(obj.relatives_visible(target, args[1][1:], attrs))
+                except dbo.ObjectNotFound as err:
+                    self.respond_failure({"status":"failed", "message": str(err)}, status=404)
             try:
+                # conditional get: answer from the cheap tag lookup if we can
+                match_etag = cherrypy.request.headers.get('If-None-Match')
+                if match_etag and not archive:
+                    etag = obj.get_etag(target, attrs)
+                    if etag and (match_etag.strip() == '*' or
+                                 etag in [tag.strip() for tag in match_etag.split(',')]):
+                        cherrypy.response.headers['ETag'] = etag
+                        cherrypy.response.status = 304
+                        return None
+
 #                trace("READ: obj.get")
-                data = obj.get(target, attrs, archive=archive).dump()
+                obj.get(target, attrs, archive=archive)
+                if not archive:
+                    etag = obj.etag(attrs)
+                    if etag:
+                        cherrypy.response.headers['ETag'] = etag
+                data = obj.dump()
 #                trace("READ: obj.get (done)")
             except dbo.ObjectNotFound as err:
                 self.respond_failure({"status":"failed", "message": str(err)}, status=404)
@@ -420,6 +526,29 @@ class Object(server.Rest, Attributes):
         return self.respond(data, status=200)
 
     ############################################################################
+    def _rest_watch(self, obj, target, attrs):
+        """
+        Register a long-poll watch on an object (and for configs, everything
+        in its extends/imports/exports chain).  Waiting is done against the
+        watch server, with the returned ticket.
+        """
+        watcher = self.server.watcher
+        if not watcher:
+            return self.respond_failure({"status": "failed",
+                                         "message": "Watches are not enabled"}, status=404)
+        try:
+            obj.get(target, attrs)
+        except dbo.ObjectNotFound as err:
+            self.respond_failure({"status":"failed", "message": str(err)}, status=404)
+
+        watch = watcher.register(obj.table, obj.obj['id'],
+                                 watcher.dependencies(obj.table, obj.obj['id']))
+        url = self.server.conf.watch.get('url')
+        if not url:
+            url = re.sub(r':\d+$', '', cherrypy.request.base) + ":" + str(watcher.port)
+        return self.respond({"ticket": watch.ticket, "token": watch.token,
+                             "url": url + "/_watch/" + watch.ticket})
+
     # pylint: disable=unused-argument
     def rest_create(self, *args, **kwargs):
         """
@@ -429,6 +558,11 @@ class Object(server.Rest, Attributes):
         if not attrs.token_nbr: # check policy instead
             self.auth_fail("Unauthorized")
 
+        if args and args[0] == '_bulk':
+            return self._rest_bulk(attrs, **kwargs)
+        if len(args) == 3 and args[1] == '_members' and self.obj == dbo.Service:
+            return self._rest_members(attrs, args[0], args[2])
+
         body = get_json_body()
         try:
             obj = self.obj(master=self.server.dbm, reqid=self.reqid)
@@ -441,6 +575,58 @@ class Object(server.Rest, Attributes):
                                 status=201)
         return self.respond({"status":"created"}, status=201)
 
+    ############################################################################
+    def _rest_members(self, attrs, target, key):
+        """
+        Add and remove service members, without rewriting the service:
+
+            POST path/service/{name}/_members/{list}
+            {"add": [instance, ...], "remove": [instance, ...]}
+
+        Where list is one of dynamic-instances, active-instances or
+        static-instances.
+        """
+        body = get_json_body()
+        add = body.get('add', [])
+        remove = body.get('remove', [])
+        if not isinstance(add, list) or not isinstance(remove, list):
+            return self.respond_failure({"status": "failed",
+                                         "message": "add and remove must be lists"})
+        try:
+            obj = self.obj(master=self.server.dbm, reqid=self.reqid)
+            warnings = obj.update_members(target, key, attrs, add=add, remove=remove)
+        except dbo.ObjectNotFound as err:
+            self.respond_failure({"status":"failed", "message": str(err)}, status=404)
+        except dbo.InvalidParameter as err:
+            self.respond_failure({"status":"failed", "message": str(err)}, status=400)
+        if warnings:
+            return self.respond({"status":"updated", "warning":"; ".join(warnings)},
+                                status=201)
+        return self.respond({"status":"updated"}, status=201)
+
+    ############################################################################
+    def _rest_bulk(self, attrs, **kwargs):
+        """
+        bulk create or update, from NDJSON -- POST /{type}/_bulk[?batch=N][&merge=true]
+        """
+        try:
+            batch = int(kwargs.get('batch', self.bulk_batch))
+        except ValueError:
+            return self.respond_failure({"status":"failed", "message": "batch is not a number"})
+        if batch < 1:
+            return self.respond_failure({"status":"failed", "message": "batch must be positive"})
+
+        obj = self.obj(master=self.server.dbm, reqid=self.reqid)
+        merge = kwargs.get('merge', '').lower() == 'true'
+        results = obj.bulk_upsert(attrs, get_ndjson_body(), batch_size=batch, merge=merge)
+
+        status = {"status": "done", "results": results}
+        for key in ("created", "updated", "unchanged", "failed"):
+            status[key] = 0
+        for result in results:
+            status[result['status']] += 1
+        return self.respond(status, status=200)
+
     ############################################################################
     # pylint: disable=unused-argument
     def rest_update(self, *args, **kwargs):
@@ -453,6 +639,8 @@ class Object(server.Rest, Attributes):
 
         if not args:
             return self.respond({"status":"failed"}, status=404)
+        if len(args) == 2 and args[1] == '_status' and self.obj == dbo.Instance:
+            return self._rest_status(attrs, args[0])
 
         body = get_json_body()
         target = args[0]
@@ -480,6 +668,25 @@ class Object(server.Rest, Attributes):
                                 status=201)
         return self.respond({"status":"updated"}, status=201)
 
+    ############################################################################
+    def _rest_status(self, attrs, target):
+        """
+        Set just the status of an instance:
+
+            PUT path/instance/{name}/_status
+            {"status": "..."}
+        """
+        status = get_json_body().get('status')
+        if not isinstance(status, str) or not status:
+            return self.respond_failure({"status": "failed",
+                                         "message": "status must be a string"})
+        try:
+            obj = self.obj(master=self.server.dbm, reqid=self.reqid)
+            obj.set_status(target, status, attrs)
+        except dbo.ObjectNotFound as err:
+            self.respond_failure({"status":"failed", "message": str(err)}, status=404)
+        return self.respond({"status":"updated"}, status=201)
+
     ############################################################################
     # pylint: disable=unused-argument
     def rest_delete(self, *args, **kwargs):
@@ -549,7 +756,8 @@ class InstancePing(Object):
     {optional merge data}
 
     Similar to an object update, but we include meta-information, such as the
-    ping-from-ip we saw them come in from.
+    ping-from-ip we saw them come in from.  Pings which only carry status and
+    address for a known instance take the fast path (Instance.ping).
     """
     obj = ''
 
@@ -585,6 +793,13 @@ class InstancePing(Object):
         body['address']['ping-from-ip'] = attrs['ip']
 
         obj = self.obj(master=self.server.dbm, reqid=self.reqid)
+        try:
+            warnings = obj.ping(target, body, attrs)
+        except dbo.InvalidParameter as err:
+            self.respond_failure({"status":"failed", "message": str(err)}, status=400)
+        if warnings is not None:
+            return self.respond({"status":"updated"}, status=201)
+
         try:
             # merge the new info with the current object
             data = obj.get(target, attrs).dump()
@@ -604,3 +819,307 @@ class InstancePing(Object):
             return self.respond({"status":"updated", "warning":"; ".join(warnings)},
                                 status=201)
         return self.respond({"status":"updated"}, status=201)
+
+################################################################################
+class Export(server.Rest, Attributes):
+    """
+    Admin export of raw table contents, as gzipped NDJSON
+
+        GET path/_export[?archive=true]  -- list of tables to export
+        GET path/_export/{table}          -- stream rows for one table
+
+    Rows are as stored, so sensitive values stay encrypted.  Requires admin
+    on the object type.  Pair with Import.
+    """
+    chunk_size = 65536
+
+    ############################################################################
+    def GET(self, *args, **kwargs):
+        """Streaming wrapper, as the rows are not sent through json_out"""
+        result = self._rest_crud('rest_read', *args, **kwargs)
+        if isinstance(result, dict):
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json4store(result).encode()
+        return result
+    GET._cp_config = {'response.stream': True}
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_read(self, *args, **kwargs):
+        """
+        read
+        """
+        attrs = self.abac_gather()
+        if not attrs.token_nbr: # check policy instead
+            self.auth_fail("Unauthorized")
+
+        schema = dbo.Schema(master=self.server.dbm)
+        if not args:
+            archive = kwargs.get('archive') == 'true'
+            return self.respond({"tables": schema.export_tables(archive=archive)})
+
+        name = args[0]
+        table = schema.export_class(name)
+        if not table:
+            return self.respond_failure({"status": "failed",
+                                         "message": "Table not found: " + name},
+                                        status=404)
+        table(master=self.server.dbm, reqid=self.reqid).authorize_table("admin", attrs)
+
+        cherrypy.response.headers['Content-Type'] = 'application/gzip'
+        return self._stream(schema, name)
+
+    ############################################################################
+    def _stream(self, schema, name):
+        """generator of compressed chunks, holding a db interface until done"""
+        dbi = self.server.dbm.connect()
+        try:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31 is gzip framing
+            buf = list()
+            size = 0
+            for row in schema.export_rows(name, dbi):
+                line = json4store(row) + "\n"
+                buf.append(line)
+                size += len(line)
+                if size >= self.chunk_size:
+                    chunk = compressor.compress("".join(buf).encode())
+                    buf = list()
+                    size = 0
+                    if chunk:
+                        yield chunk
+            yield compressor.compress("".join(buf).encode()) + compressor.flush()
+        except Exception: # headers are sent, all we can do is log it
+            log("error", traceback=json2data(traceback.format_exc()))
+            raise
+        finally:
+            dbi.done()
+
+################################################################################
+class Import(server.Rest, Attributes):
+    """
+    Admin import of raw table contents, as from Export
+
+        POST path/_import/{table}  -- body is gzipped NDJSON (or plain NDJSON)
+        POST path/_import          -- finish: remap policies and clear caches
+
+    Rows replace any existing row with the same key.  Requires admin on the
+    object type.
+    """
+
+    ############################################################################
+    @cherrypy.tools.json_out()
+    def POST(self, *args, **kwargs):
+        """Wrapper for REST calls, the body is read as a stream"""
+        return self._rest_crud('rest_create', *args, **kwargs)
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_create(self, *args, **kwargs):
+        """
+        create
+        """
+        attrs = self.abac_gather()
+        if not attrs.token_nbr: # check policy instead
+            self.auth_fail("Unauthorized")
+
+        schema = dbo.Schema(master=self.server.dbm)
+        if not args:
+            dbo.Policy(master=self.server.dbm, reqid=self.reqid).authorize_table("admin", attrs)
+            schema.import_finish()
+            return self.respond({"status": "finished"})
+
+        name = args[0]
+        table = schema.export_class(name)
+        if not table:
+            return self.respond_failure({"status": "failed",
+                                         "message": "Table not found: " + name},
+                                        status=404)
+        table(master=self.server.dbm, reqid=self.reqid).authorize_table("admin", attrs)
+
+        body = cherrypy.request.body
+        if cherrypy.request.headers.get('Content-Type', '') != server.NDJSON:
+            body = gzip.GzipFile(fileobj=body, mode='rb')
+
+        def rows():
+            """decode the lines"""
+            for line in body:
+                line = line.strip()
+                if line:
+                    yield json2data(line.decode())
+
+        dbi = self.server.dbm.connect()
+        try:
+            count = schema.import_rows(name, rows(), dbi)
+        except (OSError, EOFError) as err:
+            return self.respond_failure({"status": "failed",
+                                         "message": "Cannot read body: " + str(err)})
+        except dbo.DatabaseError as err:
+            return self.respond_failure({"status": "failed", "message": str(err)})
+        finally:
+            dbi.done()
+
+        log("type=import", table=name, rows=count)
+        return self.respond({"status": "imported", "rows": count}, status=201)
+
+################################################################################
+class Changes(server.Rest, Attributes):
+    """
+    Change feed, for clients keeping a local copy in sync
+
+        GET path/_changes                 -- just the current token
+        GET path/_changes?since={token}   -- changes after token
+
+    Optional: limit={count}, types={type,type...} (such as service,instance)
+
+    Each change is the latest for its object, with the object included for
+    puts.  Continue with the returned token; if reset is true, reload
+    everything (the token was pruned or there was an import).
+    """
+    limit = 1000
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_read(self, *args, **kwargs):
+        """
+        read
+        """
+        attrs = self.abac_gather()
+        if not attrs.token_nbr: # check policy instead
+            self.auth_fail("Unauthorized")
+
+        changelog = dbo.ChangeLog(master=self.server.dbm, reqid=self.reqid)
+        if kwargs.get('since') is None:
+            return self.respond({"token": changelog.token(), "more": False,
+                                 "reset": False, "changes": []})
+
+        try:
+            since = int(kwargs['since'])
+            limit = int(kwargs.get('limit', self.limit))
+            if since < 0 or limit < 1 or limit > self.limit:
+                raise ValueError()
+        except ValueError:
+            return self.respond_failure({"status": "failed",
+                                         "message": "since must be a token, and limit 1.." +
+                                                    str(self.limit)})
+
+        types = None
+        if kwargs.get('types'):
+            types = kwargs['types'].lower().split(",")
+            for name in types:
+                if name not in dbo.Schema.table_names:
+                    return self.respond_failure({"status": "failed",
+                                                 "message": "Invalid type: " + name})
+
+        return self.respond(changelog.changes(attrs, since, limit=limit, types=types))
+
+################################################################################
+class AbacProfile(server.Rest, Attributes):
+    """
+    Admin view of policy and policyscope evaluation counters, to find costly
+    or failing expressions
+
+        GET path/_abac[?limit=count]  -- counters, most cpu first
+        DELETE path/_abac             -- zero the counters
+
+    Counters are for this engine process, since it started or was reset.
+    cpu and avg are seconds of thread cpu time.  Requires admin on Policy.
+    """
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_read(self, *args, **kwargs):
+        """
+        read
+        """
+        attrs = self.abac_gather()
+        if not attrs.token_nbr: # check policy instead
+            self.auth_fail("Unauthorized")
+        dbo.Policy(master=self.server.dbm, reqid=self.reqid).authorize_table("admin", attrs)
+
+        try:
+            limit = int(kwargs.get('limit', 0))
+        except ValueError:
+            return self.respond_failure({"status": "failed", "message": "limit must be a number"})
+
+        return self.respond({"policies": abac.PROFILE.report('policy', limit=limit),
+                             "scopes": abac.PROFILE.report('scope', limit=limit)})
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_delete(self, *args, **kwargs):
+        """
+        delete
+        """
+        attrs = self.abac_gather()
+        if not attrs.token_nbr: # check policy instead
+            self.auth_fail("Unauthorized")
+        dbo.Policy(master=self.server.dbm, reqid=self.reqid).authorize_table("admin", attrs)
+
+        abac.PROFILE.reset()
+        return self.respond({"status": "reset"})
+
+################################################################################
+class Rotate(server.Rest, Attributes):
+    """
+    Admin job re-encrypting stored values with the default crypto key, after
+    a key rotation, so older keys may be retired once it has finished
+
+        GET path/_rotate     -- progress of the current or last job
+        POST path/_rotate    -- start the job (resuming one which was stopped or
+                                failed), body optionally
+                                {"batch": rows, "pause": seconds, "workers": threads}
+        DELETE path/_rotate  -- stop after the current batch
+
+    The job runs in this engine process.  Requires admin on every table
+    with encrypted values.
+    """
+
+    ############################################################################
+    def _authorize(self):
+        """admin on the tables the job touches"""
+        attrs = self.abac_gather()
+        if not attrs.token_nbr: # check policy instead
+            self.auth_fail("Unauthorized")
+        job = self.server.dbm.rotation or rotate.KeyRotation(self.server.dbm)
+        for table, _ in job.encrypted_tables():
+            table(master=self.server.dbm, reqid=self.reqid).authorize_table("admin", attrs)
+        return job
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_read(self, *args, **kwargs):
+        """
+        read
+        """
+        return self.respond(self._authorize().status())
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_create(self, *args, **kwargs):
+        """
+        create
+        """
+        job = self._authorize()
+        body = get_json_body() or {}
+        try:
+            started = job.start(batch_size=body.get('batch'), pause=body.get('pause'),
+                                workers=body.get('workers'))
+        except (TypeError, ValueError):
+            return self.respond_failure({"status": "failed",
+                                         "message": "batch and workers must be positive, " +
+                                                    "pause zero or more"})
+        self.server.dbm.rotation = job
+        if not started:
+            return self.respond_failure({"status": "failed", "message": "Already running"},
+                                        status=409)
+        return self.respond(job.status(), status=202)
+
+    ############################################################################
+    # pylint: disable=unused-argument
+    def rest_delete(self, *args, **kwargs):
+        """
+        delete
+        """
+        job = self._authorize()
+        job.stop()
+        return self.respond(job.status())
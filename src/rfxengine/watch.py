@@ -0,0 +1,242 @@
+#$#HEADER-START
+# vim:set expandtab ts=4 sw=4 ai ft=python:
+#
+#     Reflex Configuration Event Engine
+#
+#     Copyright (C) 2016 Brandon Gillespie
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU Affero General Public License as published
+#     by the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU Affero General Public License for more details.
+#
+#     You should have received a copy of the GNU Affero General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#$#HEADER-END
+
+"""
+Long-poll watches on objects.
+
+A watch is registered through the REST api, which does the authorization
+and gives back a ticket.  Waiting on a ticket is served by a small asyncio
+server on its own port, so a waiting client costs a socket and a future
+rather than a CherryPy worker thread.  One task follows the ChangeLog and
+wakes the watches an entry matches.
+
+    GET /_watch/{ticket}?since={token}&timeout={seconds}
+
+Answers as soon as a watched object changed after since, or at timeout:
+
+    {"changed": true|false, "token": N}
+
+Tickets are held in memory by the engine which issued them, and expire when
+not waited on for idle seconds; a 404 means register again.
+
+The watch server speaks plain HTTP and a ticket is a bearer credential, so
+it listens on localhost by default.  To serve other hosts, put it behind a
+TLS terminating proxy and give the proxy's address as watch.url; do not
+bind it to a public interface directly.
+"""
+
+import asyncio
+import secrets
+import threading
+import time
+import traceback
+import urllib.parse
+from rfx import json4store
+from rfxengine import log
+from rfxengine.db import objects as dbo
+
+################################################################################
+# pylint: disable=too-few-public-methods
+class Watch(object):
+    """One registered watch"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, ticket, table, target_id, ids, token, expires):
+        self.ticket = ticket
+        self.table = table
+        self.target_id = target_id
+        self.ids = ids            # set of (table, id) being watched
+        self.changed = 0          # seq of the last change seen
+        self.token = token
+        self.expires = expires
+        self.waiters = list()
+
+    ############################################################################
+    def wake(self):
+        """resolve anybody waiting"""
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+        self.waiters = list()
+
+################################################################################
+# pylint: disable=too-many-instance-attributes
+class Watcher(object):
+    """
+    The watch server.  register() is called from CherryPy threads, everything
+    else runs on the watcher's own event loop thread.
+    """
+
+    max_timeout = 300
+    default_timeout = 60
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, dbm, port, host='127.0.0.1', poll=1, idle=300):
+        self.dbm = dbm
+        self.port = port
+        self.host = host
+        self.poll = poll
+        self.idle = idle
+        self.watches = dict()
+        self.last = 0
+        self.loop = None
+        self.lock = threading.Lock()
+
+    ############################################################################
+    def start(self):
+        """start the event loop in a background thread"""
+        self.last = dbo.ChangeLog(master=self.dbm).token()
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._run, name="watcher")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    ############################################################################
+    def _run(self):
+        """thread body"""
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port))
+        log("Watch server listening", port=self.port, type="notice")
+        self.loop.create_task(self._follow())
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+
+    ############################################################################
+    def register(self, table, target_id, ids):
+        """
+        Add a watch on the (table, id) pairs in ids.  Called after the caller
+        is authorized to read the object at target_id.
+        """
+        ticket = secrets.token_urlsafe(24)
+        watch = Watch(ticket, table, target_id, set(ids), self.last,
+                      time.time() + self.idle)
+        with self.lock:
+            self.watches[ticket] = watch
+        return watch
+
+    ############################################################################
+    def dependencies(self, table, target_id):
+        """(table, id) pairs to watch for an object, including config dependencies"""
+        if table == dbo.Config.table:
+            deps = dbo.Config(master=self.dbm).dependencies(target_id)
+            return set([(table, dep_id) for dep_id in deps])
+        return set([(table, target_id)])
+
+    ############################################################################
+    async def _follow(self):
+        """follow the ChangeLog, waking matching watches"""
+        loop = asyncio.get_event_loop()
+        changelog = dbo.ChangeLog(master=self.dbm)
+        while True:
+            await asyncio.sleep(self.poll)
+            try:
+                rows = await loop.run_in_executor(None, changelog.after, self.last)
+                now = time.time()
+                with self.lock:
+                    watches = list(self.watches.values())
+                woken, chains = set(), set()
+                for seq, table, target_id, action in rows:
+                    self.last = seq
+                    for watch in watches:
+                        if action == 'reset' or (table, target_id) in watch.ids:
+                            watch.changed = seq
+                            woken.add(watch)
+                            # any config in a chain may have changed its
+                            # extends/imports/exports, an import all of them
+                            if watch.table == dbo.Config.table and \
+                               table in (dbo.Config.table, '*'):
+                                chains.add(watch)
+                for watch in chains:
+                    watch.ids = await loop.run_in_executor(
+                        None, self.dependencies, watch.table, watch.target_id)
+                for watch in woken:
+                    watch.wake()
+                with self.lock:
+                    for watch in watches:
+                        if watch.expires < now and not watch.waiters:
+                            self.watches.pop(watch.ticket, None)
+            except Exception: # pylint: disable=broad-except
+                log("error", traceback=traceback.format_exc())
+
+    ############################################################################
+    async def _wait(self, watch, since, timeout):
+        """wait for a change after since"""
+        if watch.changed <= since:
+            waiter = self.loop.create_future()
+            watch.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in watch.waiters:
+                    watch.waiters.remove(waiter)
+        watch.expires = time.time() + self.idle
+        if watch.changed > since:
+            return dict(changed=True, token=watch.changed)
+        return dict(changed=False, token=max(since, self.last))
+
+    ############################################################################
+    async def _handle(self, reader, writer):
+        """minimal HTTP: one GET per connection"""
+        status, body = 200, None
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while True: # headers are not needed
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            method, target = request.decode().split(" ")[0:2]
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            path = url.path.strip("/").split("/")
+            watch = None
+            if method == 'GET' and len(path) == 2 and path[0] == '_watch':
+                with self.lock:
+                    watch = self.watches.get(path[1])
+            if not watch:
+                status, body = 404, dict(status="failed", message="Watch not found")
+            else:
+                since = int(query.get('since', watch.token))
+                timeout = min(float(query.get('timeout', self.default_timeout)),
+                              self.max_timeout)
+                body = await self._wait(watch, since, timeout)
+        except (ValueError, asyncio.TimeoutError):
+            status, body = 400, dict(status="failed", message="Bad request")
+        except ConnectionError:
+            writer.close()
+            return
+
+        content = json4store(body).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n"
+                     .format(status, "OK" if status == 200 else "Failed", len(content))
+                     .encode() + content)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
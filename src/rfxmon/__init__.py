@@ -81,6 +81,7 @@ class Monitor(rfx.Base):
     reporting_stopper = None
     thread_stopper = threading.Event()
     rcs = None
+    change_token = None
 
     ###########################################################################
     # pylint: disable=super-init-not-called
@@ -160,13 +161,23 @@ class Monitor(rfx.Base):
         """
         self.thread_debug("Starting monitor refresh", module="update_monitors")
 
-        # need to make a more efficient way of doing this via Reflex Engine
+        # after the first load, only pull what changed since
         monitors = []
-        self.rcs.cache_reset()
+        token = None
+        if self.change_token is not None:
+            token = self.rcs.cache_changes(self.change_token,
+                                           types=['service', 'pipeline', 'instance'])
+        if token is None:
+            # note the token first, so changes during the load are not lost
+            token = self.rcs.changes()['token']
+            self.rcs.cache_reset()
+            svcs = self.rcs.cache_list('service',
+                                       cols=['pipeline', 'name',
+                                             'active-instances'])
+        else:
+            svcs = list(self.rcs._cache.get('service', {}).values()) # pylint: disable=protected-access
+        self.change_token = token
 
-        svcs = self.rcs.cache_list('service',
-                                   cols=['pipeline', 'name',
-                                         'active-instances'])
         for svc in svcs:
             try:
                 pipeline = self.rcs.cache_get('pipeline', svc['pipeline'])
@@ -334,9 +345,7 @@ class Monitor(rfx.Base):
         if result['status'] != self.instances[monitor['instance']]['status']:
             # do some retry/counter steps on failure?
             self.instances[monitor['instance']]['status'] = result['status']
-            self.rcs.patch('instance',
-                           monitor['instance'],
-                           {'status': result['status']})
+            self.rcs.instance_status(monitor['instance'], result['status'])
 
     ############################################################################
     def reporting(self):
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Evaluations per second of ABAC expressions, compiled (abac.Expression) versus
+the former eval() with a fresh context per call:
+
+    bench-abac.py [count]
+
+Runs in process, no engine needed (PYTHONPATH=src).  Each expression is
+first checked to give the same result both ways.
+"""
+
+import re
+import sys
+import time
+import dictlib
+from rfxengine import abac, log
+
+EXPRESSIONS = [
+    "token_name == 'master'",
+    "token_name in groups['admin-super']",
+    "not sensitive and (token_name in groups.devs or token_name in groups['admin-super'])",
+    "obj_type in ('Config', 'Pipeline', 'Service') and rx(r'^bench-', obj['name'])",
+    "obj_type == 'Config' and obj['name'][-12:] == '-keymaterial'",
+]
+
+def old_context():
+    """abac_context() as it was: a new dict and closure per call"""
+    def debug_hook(*args):
+        """debug hook"""
+        log("ABAC DEBUG", *args, type="debug")
+
+    return {
+        '__builtins__':{},
+        'true': True,
+        'false': False,
+        're': re,
+        'rx': re.search,
+        'debug': debug_hook
+    }
+
+def old_allowed(code, attrs):
+    """Policy.allowed as it was"""
+    try:
+        # pylint: disable=eval-used
+        if eval(code, old_context(), attrs):
+            return True
+    except Exception: # pylint: disable=broad-except
+        pass
+    return False
+
+def new_allowed(expr, attrs):
+    """Policy.allowed now"""
+    try:
+        if expr.func(attrs):
+            return True
+    except Exception: # pylint: disable=broad-except
+        pass
+    return False
+
+def rate(count, func, arg, attrs):
+    """evaluations per second"""
+    start = time.time()
+    for _ in range(0, count):
+        func(arg, attrs)
+    return count / (time.time() - start)
+
+def main():
+    """main"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    attrs = abac.LazyAttrs(abac.MASTER_ATTRS)
+    attrs.update(sensitive=False, obj_type='Config', obj={'name': 'bench-keymaterial'},
+                 groups=dictlib.Obj({'admin-super': ['master'], 'devs': []}))
+    total_old = total_new = 0
+    for source in EXPRESSIONS:
+        code = compile(source, '<bench>', 'eval')
+        expr = abac.Expression(source, '<bench>')
+        if old_allowed(code, attrs) != new_allowed(expr, attrs):
+            sys.exit("results differ: " + source)
+        old = rate(count, old_allowed, code, attrs)
+        new = rate(count, new_allowed, expr, attrs)
+        total_old += count / old
+        total_new += count / new
+        print("{:>10.0f}/s {:>10.0f}/s {:5.1f}x  {}".format(old, new, new / old, source))
+    print("{:>10.0f}/s {:>10.0f}/s {:5.1f}x  (all)".format(
+        len(EXPRESSIONS) * count / total_old, len(EXPRESSIONS) * count / total_new,
+        total_old / total_new))
+
+if __name__ == "__main__":
+    main()
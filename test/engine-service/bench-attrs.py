@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Per-request overhead of the Health and Object endpoints, to compare engine
+builds (such as before and after lazy ABAC attributes):
+
+    bench-attrs.py {count} {config-name}
+
+Uses REFLEX_URL and REFLEX_APIKEY.  Health does no attribute gathering, so
+it is the baseline; the difference to a config read is the authorization
+cost.  Run against each build on the same host and compare.
+"""
+
+import sys
+import time
+import requests
+import rfx
+import rfx.client
+
+def measure(label, count, func):
+    """time count calls, report ms per call"""
+    func() # warm up the session and any caches
+    times = []
+    for _ in range(0, count):
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    print("{:8} n={} mean={:.2f}ms p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms".format(
+        label, count, sum(times) / count, times[int(count * .5)],
+        times[int(count * .9)], times[min(int(count * .99), count - 1)]))
+    return times
+
+def main():
+    """main"""
+    if len(sys.argv) != 3:
+        sys.exit("Syntax: bench-attrs.py {count} {config-name}")
+    count = int(sys.argv[1])
+    name = sys.argv[2]
+    base = rfx.Base().cfg_load()
+    rcs = rfx.client.Session(base=base)
+
+    # raw calls, so object reads are not answered by the client's ETag cache
+    health = measure("health", count,
+                     lambda: rcs._call_raw(requests.get, "health")) # pylint: disable=protected-access
+    config = measure("config", count,
+                     lambda: rcs._call_raw(requests.get, "config/" + name)) # pylint: disable=protected-access
+    print("overhead p50={:.2f}ms".format(config[int(count * .5)] - health[int(count * .5)]))
+
+if __name__ == "__main__":
+    main()
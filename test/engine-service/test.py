@@ -33,6 +33,7 @@ import shutil
 import json
 import re
 import base64
+import gzip
 import nacl.utils
 import requests
 import onetimejwt
@@ -794,6 +795,23 @@ def test_full_stack(schema, base, tester, baseurl, args):
                  [rcs_master.get, "instance", "test-instance"], {},
                  r"'ping-from-ip': '127.0.0.1'")
 
+    # an existing instance takes the fast path, merging the address
+    tester.okcmp("Reflex Instance Ping (existing)", tester, tester.rcs,
+                 [rcs_master.instance_ping, "test-instance", {
+                     "status": "ok",
+                     "address": {"ip1": "10.0.0.1"}
+                 }], {},
+                 r"'status': 'updated'")
+    tester.okcmp("Reflex Instance Ping Verify (existing)", tester, tester.rcs,
+                 [rcs_master.get, "instance", "test-instance"], {},
+                 r"'ip0': '10.0.0.0'", r"'ip1': '10.0.0.1'", r"'status': 'ok'")
+
+    # status alone goes to the hot status table
+    tester.okcmp("Reflex Instance Status", tester, tester.rcs,
+                 [lambda: rcs_master.instance_status("test-instance", "failed") and
+                  rcs_master.get("instance", "test-instance")], {},
+                 r"'status': 'failed'", r"'ip1': '10.0.0.1'", r"'last-seen': ")
+
     # create a new apikey
     tester.okcmp("Reflex Apikey Create", tester, tester.rcs,
                  [rcs_master.create, "apikey", {
@@ -1011,6 +1029,268 @@ def test_full_stack(schema, base, tester, baseurl, args):
 
     # test a list as master, amy pond, and after policy is deleted
 
+    # bulk upsert: one new, one existing, one bad
+    tester.okcmp("Reflex Bulk Upsert", tester, tester.rcs,
+                 [rcs_master.bulk, "config", [{
+                     "name": "tardis-bulk",
+                     "type": "parameter",
+                     "extends": ["tardis-main"]
+                 }, {
+                     "name": "tardis-main-sub",
+                     "type": "parameter",
+                     "sensitive": {"config": "bulk"},
+                     "extends": ["tardis-main"]
+                 }, {
+                     "name": "tardis-bad",
+                     "type": "nope"
+                 }]], {},
+                 r"'created': 1",
+                 r"'updated': 1",
+                 r"'failed': 1",
+                 r"'line': 3, 'name': 'tardis-bad', 'status': 'failed'")
+
+    tester.okcmp("Reflex Bulk Upsert Verify", tester, tester.rcs,
+                 [rcs_master.get, "config", "tardis-main-sub"], {},
+                 r"'sensitive': {'config': 'bulk'}")
+
+    # merged into the stored object; an unknown id is not created
+    tester.okcmp("Reflex Bulk Upsert (merge)", tester, tester.rcs,
+                 [rcs_master.bulk, "config", [{
+                     "name": "tardis-main-sub",
+                     "setenv": {"BULK": "merged"}
+                 }, {
+                     "id": 999999,
+                     "name": "tardis-ghost",
+                     "type": "parameter"
+                 }]], {'merge': True},
+                 r"'updated': 1",
+                 r"'failed': 1",
+                 r"'message': 'No Config with id 999999'")
+    tester.okcmp("Reflex Bulk Upsert (merge) Verify", tester, tester.rcs,
+                 [rcs_master.get, "config", "tardis-main-sub"], {},
+                 r"'sensitive': {'config': 'bulk'}",
+                 r"'BULK': 'merged'")
+
+    # new apikeys get their own uuid and secrets, as with create
+    tester.okcmp("Reflex Bulk Upsert (apikey)", tester, tester.rcs,
+                 [lambda: rcs_master.bulk("apikey", [{
+                     "name": "bulk-key",
+                     "uuid": "chosen",
+                     "secrets": ["chosen"]
+                 }]) and rcs_master.get("apikey", "bulk-key")], {},
+                 r"'name': 'bulk-key'")
+    tester.okcmp("Reflex Bulk Upsert (apikey) Verify", tester, tester.rcs,
+                 [lambda: "chosen" not in str(rcs_master.get("apikey", "bulk-key"))], {},
+                 r"True")
+
+    # export a table and load it back; sensitive values stay encrypted
+    def export_table(table):
+        out = strio.BytesIO()
+        rcs_master.export_table(table, out)
+        return gzip.decompress(out.getvalue()).decode()
+
+    tester.okcmp("Reflex Export Tables", tester, tester.rcs,
+                 [rcs_master.export_tables], {'archive': True},
+                 r"'ConfigArchive'")
+    tester.okcmp("Reflex Export Config", tester, tester.rcs,
+                 [export_table, "Config"], {},
+                 r'"name":"tardis-main"',
+                 r'sensitive.{1,4}__\$')
+    tester.okcmp("Reflex Import Config", tester, tester.rcs,
+                 [rcs_master.import_table, "Config",
+                  gzip.compress(export_table("Config").encode())], {},
+                 r"'status': 'imported'")
+    tester.okcmp("Reflex Import Finish", tester, tester.rcs,
+                 [rcs_master.import_finish], {},
+                 r"'status': 'finished'")
+
+    # the hot fields are exported apart from the document, and kept on import
+    def status_round_trip():
+        before = rcs_master.get("instance", "test-instance")
+        rows = export_table("InstanceStatus")
+        rcs_master.import_table("InstanceStatus", gzip.compress(rows.encode()))
+        rcs_master.import_finish()
+        after = rcs_master.get("instance", "test-instance")
+        return {'exported': '"instance_id"' in rows,
+                'same': [before['status'], before['last-seen']] ==
+                        [after['status'], after['last-seen']]}
+
+    tester.okcmp("Reflex Export InstanceStatus (round trip)", tester, tester.rcs,
+                 [status_round_trip], {},
+                 r"'exported': True",
+                 r"'same': True")
+
+    # conditional get: an unchanged object revalidates as 304
+    def get_conditional(obj_type, target):
+        first = rcs_master.get(obj_type, target)
+        etag = rcs_master._etags[obj_type + "/" + target][0]
+        result = rcs_master._call_raw(requests.get, obj_type + "/" + target,
+                                      headers={'If-None-Match': etag})
+        return {'status': result.status_code,
+                'same': rcs_master.get(obj_type, target) == first}
+
+    tester.okcmp("Reflex Conditional Get", tester, tester.rcs,
+                 [get_conditional, "config", "tardis-main"], {},
+                 r"'status': 304",
+                 r"'same': True")
+
+    # change feed: a create then a delete shows as just the delete
+    token = rcs_master.changes()['token']
+    tester.okcmp("Reflex Changes (put)", tester, tester.rcs,
+                 [lambda: rcs_master.create("config", {"name": "tardis-feed",
+                                                       "type": "parameter"}) and
+                  rcs_master.changes(since=token)], {},
+                 r"'type': 'config'",
+                 r"'name': 'tardis-feed', 'action': 'put', 'object': {")
+    tester.okcmp("Reflex Changes (delete)", tester, tester.rcs,
+                 [lambda: rcs_master.delete("config", "tardis-feed") and
+                  rcs_master.changes(since=token, types=["config"])], {},
+                 r"'name': 'tardis-feed', 'action': 'delete'")
+
+    # watch: a change to a parent wakes a watch on the child
+    def watch_parent_change():
+        token = rcs_master.watch("config", "tardis-main-sub", timeout=1)['token']
+        rcs_master.patch("config", "tardis-main", {"setenv": {"WATCHED": "yes"}})
+        return rcs_master.watch("config", "tardis-main-sub", since=token, timeout=10)
+
+    tester.okcmp("Reflex Watch (timeout)", tester, tester.rcs,
+                 [rcs_master.watch, "config", "tardis-main-sub"], {'timeout': 1},
+                 r"'changed': False")
+    tester.okcmp("Reflex Watch (parent changed)", tester, tester.rcs,
+                 [watch_parent_change], {},
+                 r"'changed': True")
+
+    # a parent which gains an extends: the watch follows the new grandparent
+    def watch_grandparent_change():
+        rcs_master.create("config", {"name": "tardis-grand", "type": "parameter"})
+        token = rcs_master.watch("config", "tardis-main-sub", timeout=1)['token']
+        rcs_master.patch("config", "tardis-main", {"extends": ["tardis-grand"]})
+        token = rcs_master.watch("config", "tardis-main-sub", since=token, timeout=10)['token']
+        rcs_master.patch("config", "tardis-grand", {"setenv": {"GRAND": "yes"}})
+        return rcs_master.watch("config", "tardis-main-sub", since=token, timeout=10)
+
+    tester.okcmp("Reflex Watch (grandparent changed)", tester, tester.rcs,
+                 [watch_grandparent_change], {},
+                 r"'changed': True")
+
+    # server side flatten: parent merged in, with the configs read
+    tester.okcmp("Reflex Config Flattened", tester, tester.rcs,
+                 [rcs_master.get_flattened, "tardis-main-sub"], {},
+                 r"'WATCHED': 'yes'",
+                 r"'objects': \{'tardis-main-sub': \{")
+
+    # the flattened result is cached; a change to the parent drops it
+    tester.okcmp("Reflex Config Flattened (after parent change)", tester, tester.rcs,
+                 [lambda: rcs_master.patch("config", "tardis-main",
+                                           {"setenv": {"WATCHED": "again"}}) and
+                  rcs_master.get_flattened("tardis-main-sub")], {},
+                 r"'WATCHED': 'again'")
+
+    # a parent created after a flatten which could not find it
+    tester.okcmp("Reflex Config Flattened (missing parent)", tester, tester.rcs,
+                 [lambda: rcs_master.create("config", {"name": "tardis-orphan",
+                                                       "type": "parameter",
+                                                       "extends": ["tardis-later"]}) and
+                  rcs_master.get_flattened("tardis-orphan")], {},
+                 r"ClientError: Endpoint or object not found")
+    tester.okcmp("Reflex Config Flattened (parent created)", tester, tester.rcs,
+                 [lambda: rcs_master.create("config", {"name": "tardis-later",
+                                                       "type": "parameter",
+                                                       "setenv": {"LATER": "yes"}}) and
+                  rcs_master.get_flattened("tardis-orphan")], {},
+                 r"'LATER': 'yes'")
+
+    # reverse dependency index
+    tester.okcmp("Reflex Config Descendants", tester, tester.rcs,
+                 [rcs_master.relatives, "tardis-main", "descendants"], {},
+                 r"'name': 'tardis-main-sub'", r"'kind': 'extends'")
+    tester.okcmp("Reflex Config Ancestors", tester, tester.rcs,
+                 [rcs_master.relatives, "tardis-main-sub", "ancestors"], {},
+                 r"'name': 'tardis-main'", r"'kind': 'extends'")
+
+    # service membership, without rewriting the service
+    tester.okcmp("Reflex Service Create (members)", tester, tester.rcs,
+                 [rcs_master.create, "service", {
+                     "name": "tardis-svc",
+                     "pipeline": "tardis",
+                     "config": "tardis-main",
+                     "dynamic-instances": ["test-instance"]
+                 }], {},
+                 r"'status': 'created'")
+    tester.okcmp("Reflex Service Members Add", tester, tester.rcs,
+                 [rcs_master.update_members, "tardis-svc", "active-instances",
+                  ["test-instance", "not-an-instance"]], {},
+                 r"'status': 'updated'", r"Instance:not-an-instance not found")
+    tester.okcmp("Reflex Service Members", tester, tester.rcs,
+                 [rcs_master.members, "tardis-svc"], {},
+                 r"'active-instances': \['not-an-instance.notfound', 'test-instance.\d+'\]",
+                 r"'dynamic-instances': \['test-instance.\d+'\]")
+    tester.okcmp("Reflex Service Members Remove", tester, tester.rcs,
+                 [lambda: rcs_master.update_members("tardis-svc", "dynamic-instances",
+                                                    remove=["test-instance"]) and
+                  rcs_master.get("service", "tardis-svc")], {},
+                 r"'dynamic-instances': \[\]")
+    tester.okcmp("Reflex Service Members List", tester, tester.rcs,
+                 [rcs_master.list, "service"], {'match': "tardis-svc",
+                                                'cols': ["name", "active-instances",
+                                                         "dynamic-instances"]},
+                 r"'active-instances': \['not-an-instance.notfound', 'test-instance.\d+'\]",
+                 r"'dynamic-instances': \[\]")
+
+    # every table offered for export can be exported
+    def export_all():
+        return dict([(table, len(export_table(table).splitlines()))
+                     for table in rcs_master.export_tables(archive=True)])
+
+    tester.okcmp("Reflex Export All Tables", tester, tester.rcs,
+                 [export_all], {},
+                 r"'Service': \d+", r"'InstanceStatus': \d+")
+
+    # membership is carried by the service rows, and rebuilt on import
+    def members_round_trip():
+        before = rcs_master.members("tardis-svc")
+        rows = export_table("Service")
+        rcs_master.import_table("Service", gzip.compress(rows.encode()))
+        rcs_master.import_finish()
+        return rcs_master.members("tardis-svc") == before
+
+    tester.okcmp("Reflex Export Service Members (round trip)", tester, tester.rcs,
+                 [members_round_trip], {},
+                 r"True")
+
+    # policy evaluation counters; the master policy has been evaluated by now
+    tester.okcmp("Reflex ABAC Profile", tester, tester.rcs,
+                 [rcs_master.abac_profile], {},
+                 r"'policies': \[\{", r"'name': 'master'", r"'count': \d+")
+    tester.okcmp("Reflex ABAC Profile (limited)", tester, tester.rcs,
+                 [rcs_pond.abac_profile], {},
+                 r"rfx.client.ClientError: Forbidden")
+
+    # re-encrypt with the default key; with one key there is nothing to change
+    tester.okcmp("Reflex Rotate Keys", tester, tester.rcs,
+                 [lambda: rcs_master.rotate_keys(start=True, pause=0) and
+                  time.sleep(1) or rcs_master.rotate_keys()], {},
+                 r"'running': False", r"'Config': \{[^}]*'rotated': 0",
+                 r"'ConfigArchive': \{")
+    tester.okcmp("Reflex Rotate Keys (limited)", tester, tester.rcs,
+                 [rcs_pond.rotate_keys], {},
+                 r"rfx.client.ClientError: Forbidden")
+
+    # logins are answered from cached apikey secrets, dropped when it changes
+    # pylint: disable=protected-access
+    tester.okcmp("Reflex Apikey Login (cached)", tester, tester.rcs,
+                 [lambda: rcs_pond._login(force=True) or rcs_pond._login(force=True) or
+                  "authorized"], {},
+                 r"authorized")
+    tester.okcmp("Reflex Apikey Change Secrets", tester, tester.rcs,
+                 [rcs_master.patch, "apikey", "amy-pond", {
+                     "secrets": [base64.b64encode(nacl.utils.random(Apikey.keysize)).decode()]
+                 }], {},
+                 r"'status': 'updated'")
+    tester.okcmp("Reflex Apikey Login (old secret)", tester, tester.rcs,
+                 [rcs_pond._login, True], {},
+                 r"Unable to authorize session")
+
 ################################################################################
 def main():
     parser = argparse.ArgumentParser()